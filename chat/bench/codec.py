@@ -0,0 +1,101 @@
+"""
+Benchmark of writing and reading wire protocol packets.
+
+Times writing a batch of packets to a socket by joining them into one bytes
+object (as the server did before) against send_packets' scatter-gather
+write, and reading them by slicing each packet out of the stream against
+the PacketDecoder the servers use. Python has no counter of allocations,
+so the peak memory traced by tracemalloc while each one runs is reported
+instead.
+
+Usage (from the chat folder):
+    python -m bench.codec [--messages 100000] [--size 64] [--batch 64]
+"""
+import argparse
+import json
+import socket
+import threading
+import time
+import tracemalloc
+
+from wire.wire_protocol import PacketDecoder, pack_packet, send_packets, unpack_packet
+
+
+def joined_write(sock, packets: list, batch: int):
+    for start in range(0, len(packets), batch):
+        sock.sendall(b"".join(packets[start:start + batch]))
+
+
+def gathered_write(sock, packets: list, batch: int):
+    for start in range(0, len(packets), batch):
+        send_packets(sock, packets[start:start + batch])
+
+
+def copying_decode(stream: bytes, count: int):
+    offset = 0
+    for _ in range(count):
+        data_len = int.from_bytes(stream[offset:offset + 4], 'big')
+        end = offset + 5 + data_len
+        unpack_packet(stream[offset:end])
+        offset = end
+
+
+def decoder_decode(stream: bytes, count: int):
+    decoder = PacketDecoder()
+    # Feed the stream in socket sized reads
+    for start in range(0, len(stream), 4096):
+        decoder.feed(stream[start:start + 4096])
+
+
+def drain(sock):
+    # Reads everything written to the other end so writes never block
+    while sock.recv(65536):
+        pass
+
+
+def measure(function, *args) -> dict:
+    start = time.perf_counter()
+    function(*args)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": seconds, "peak_bytes": peak}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--size', type=int, default=64, help="characters in each message")
+    parser.add_argument('--batch', type=int, default=64, help="packets written together")
+    args = parser.parse_args()
+
+    messages = [f"user{i}|" + "x" * args.size for i in range(args.messages)]
+    packets = [pack_packet(5, message) for message in messages]
+    stream = b"".join(packets)
+
+    writer, reader = socket.socketpair()
+    threading.Thread(target=drain, args=(reader,), daemon=True).start()
+
+    codecs = [
+        ("joined_write", joined_write, (writer, packets, args.batch)),
+        ("gathered_write", gathered_write, (writer, packets, args.batch)),
+        ("copying_decode", copying_decode, (stream, args.messages)),
+        ("decoder_decode", decoder_decode, (stream, args.messages)),
+    ]
+    for name, function, function_args in codecs:
+        result = measure(function, *function_args)
+        print(json.dumps({
+            "codec": name,
+            "messages": args.messages,
+            "ns_per_message": round(result["seconds"] * 1e9 / args.messages),
+            "peak_bytes": result["peak_bytes"],
+        }))
+
+    writer.close()
+
+
+if __name__ == "__main__":
+    main()
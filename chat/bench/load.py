@@ -0,0 +1,392 @@
+"""
+Load generation and latency benchmark for the chat servers.
+
+Starts a server in its own process, then runs simulated clients that each
+create a home account and loop over a weighted mix of operations until the
+time is up. Wire clients speak the protocol with pack_packet and grpc clients
+use ChatClient. Throughput and p50/p99/p999 latency of every operation are
+reported as JSON.
+
+Operations:
+    create  -> create a new account (then return to the home account)
+    login   -> log back in to the home account (after logging out)
+    send    -> send a message to a random client's home account
+    deliver -> deliver the home account's queued messages
+
+Usage (from the chat folder):
+    python -m bench.load [--transport wire] [--clients 32] [--processes 4]
+                         [--seconds 10] [--mix create=1,login=1,send=8,deliver=2]
+                         [--output results.json] [--workers 1]
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from collections import deque
+from concurrent import futures
+
+from wire.wire_protocol import PacketDecoder, pack_packet
+
+TRANSPORTS = ["wire", "wire-async", "grpc", "grpc-async"]
+OPERATIONS = ["create", "login", "send", "deliver"]
+
+
+def run_server(transport: str, port: int, workers: int = 1):
+    """
+    Runs a chat server on localhost until the process is terminated
+    """
+    # Servers print every request, which would dominate the measurements
+    sys.stdout = open(os.devnull, 'w')
+
+    if transport == "wire" and workers > 1:
+        from wire.workers import start_workers
+
+        # Workers are daemons, so they stop along with this process
+        for process in start_workers("127.0.0.1", port, workers):
+            process.join()
+    elif transport == "wire":
+        from _thread import start_new_thread
+        from wire.chat_service import Chat
+        from wire.server import client_thread
+
+        chat_app = Chat()
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind(("127.0.0.1", port))
+        server.listen(1024)
+        while True:
+            conn, addr = server.accept()
+            start_new_thread(client_thread, (chat_app, conn, addr))
+    elif transport == "wire-async":
+        from wire.async_server import serve
+        from wire.chat_service import Chat
+
+        asyncio.run(serve(Chat(), "127.0.0.1", port))
+    elif transport == "grpc":
+        import grpc
+        import grpc_proto.chat_pb2_grpc as chat_pb2_grpc
+        from grpc_proto.server import ChatServer
+
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=1024))
+        chat_pb2_grpc.add_ChatServerServicer_to_server(ChatServer(), server)
+        server.add_insecure_port(f"127.0.0.1:{port}")
+        server.start()
+        server.wait_for_termination()
+    elif transport == "grpc-async":
+        from grpc_proto.aio_server import AsyncChatServer, serve
+
+        asyncio.run(serve(AsyncChatServer(), f"127.0.0.1:{port}"))
+
+
+class WireLoadClient:
+    """
+    A class used to drive the wire protocol server like a user would
+    ...
+
+    Replies from the server start with "<server>", every other packet is a
+    message pushed by another client. Queued messages carry no end marker, so
+    a deliver is pipelined with a one account list request and only finishes
+    once that reply arrives.
+    """
+
+    def __init__(self, port: int):
+        self.sock = socket.create_connection(("127.0.0.1", port))
+        self.decoder = PacketDecoder()
+        self.pending = deque()
+        self.reply()
+
+    def receive(self) -> str:
+        while not self.pending:
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            self.pending.extend(self.decoder.feed(data))
+        return self.pending.popleft()[1]
+
+    def reply(self, prefix: str = "<server>") -> str:
+        while True:
+            data = self.receive()
+            if data.startswith(prefix):
+                return data
+
+    def request(self, op_code: int, content: str = "") -> bool:
+        """
+        Sends a request and returns whether the server reported success
+        """
+        self.sock.sendall(pack_packet(op_code, content))
+        response = self.reply()
+        return not any(error in response for error in ("Failed", "Invalid", "not permitted"))
+
+    def setup(self, home: str):
+        self.request(1, home)
+
+    def create(self, home: str, username: str) -> float:
+        self.request(3)
+        start = time.perf_counter()
+        ok = self.request(1, username)
+        elapsed = time.perf_counter() - start
+        self.request(3)
+        self.request(2, home)
+        return elapsed if ok else None
+
+    def login(self, home: str) -> float:
+        self.request(3)
+        start = time.perf_counter()
+        ok = self.request(2, home)
+        return time.perf_counter() - start if ok else None
+
+    def send(self, recipient: str) -> float:
+        start = time.perf_counter()
+        ok = self.request(5, f"{recipient}|benchmark message")
+        return time.perf_counter() - start if ok else None
+
+    def deliver(self) -> float:
+        start = time.perf_counter()
+        self.sock.sendall(pack_packet(6, "") + pack_packet(8, "1||"))
+        self.reply("<server> List of accounts")
+        return time.perf_counter() - start
+
+    def close(self):
+        self.sock.close()
+
+
+class GrpcLoadClient:
+    """
+    A class used to drive the grpc server through ChatClient
+    """
+
+    def __init__(self, port: int):
+        from grpc_proto.client import ChatClient
+
+        self.client = ChatClient("127.0.0.1", port)
+
+    def timed(self, call, *args) -> float:
+        import grpc
+
+        start = time.perf_counter()
+        try:
+            call(*args)
+        except grpc.RpcError:
+            return None
+        return time.perf_counter() - start
+
+    def setup(self, home: str):
+        self.client.create_account(home)
+
+    def create(self, home: str, username: str) -> float:
+        self.client.logout_account()
+        elapsed = self.timed(self.client.create_account, username)
+        if elapsed is not None:
+            self.client.logout_account()
+        self.client.login_account(home)
+        return elapsed
+
+    def login(self, home: str) -> float:
+        self.client.logout_account()
+        return self.timed(self.client.login_account, home)
+
+    def send(self, recipient: str) -> float:
+        return self.timed(self.client.send_message, recipient, "benchmark message")
+
+    def deliver(self) -> float:
+        return self.timed(self.client.deliver_undelivered)
+
+    def close(self):
+        if self.client.is_connected:
+            self.client.logout_account()
+
+
+def run_clients(transport: str, port: int, client_ids: list, n_clients: int,
+                mix: dict, seconds: float, barrier, results):
+    """
+    Runs a group of simulated clients in threads and puts their latencies
+    on the results queue as {operation: (latencies, errors)}
+    """
+    # ChatClient prints every reply
+    sys.stdout = open(os.devnull, 'w')
+    client_class = WireLoadClient if transport.startswith("wire") else GrpcLoadClient
+
+    clients = []
+    for client_id in client_ids:
+        client = client_class(port)
+        client.setup(f"bench{client_id}")
+        clients.append((client_id, client))
+
+    latencies = {operation: [] for operation in mix}
+    errors = {operation: 0 for operation in mix}
+    lock = threading.Lock()
+    operations, weights = list(mix), list(mix.values())
+
+    def worker(client_id, client):
+        rng = random.Random(client_id)
+        local = {operation: [] for operation in mix}
+        local_errors = {operation: 0 for operation in mix}
+        created = 0
+
+        while time.perf_counter() < deadline:
+            operation = rng.choices(operations, weights)[0]
+            home = f"bench{client_id}"
+            try:
+                if operation == "create":
+                    created += 1
+                    elapsed = client.create(home, f"bench{client_id}_{created}")
+                elif operation == "login":
+                    elapsed = client.login(home)
+                elif operation == "send":
+                    elapsed = client.send(f"bench{rng.randrange(n_clients)}")
+                else:
+                    elapsed = client.deliver()
+            except (OSError, ConnectionError):
+                local_errors[operation] += 1
+                break
+
+            if elapsed is None:
+                local_errors[operation] += 1
+            else:
+                local[operation].append(elapsed)
+
+        with lock:
+            for operation in mix:
+                latencies[operation] += local[operation]
+                errors[operation] += local_errors[operation]
+
+    # Every process starts measuring at the same moment
+    barrier.wait()
+    deadline = time.perf_counter() + seconds
+    threads = [threading.Thread(target=worker, args=client) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for _, client in clients:
+        with contextlib.suppress(Exception):
+            client.close()
+    results.put({operation: (latencies[operation], errors[operation]) for operation in mix})
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return round(sorted_values[index] * 1000, 3)
+
+
+def summarize(latencies: list, errors: int, seconds: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / seconds, 1),
+        "p50_ms": percentile(latencies, 0.5),
+        "p99_ms": percentile(latencies, 0.99),
+        "p999_ms": percentile(latencies, 0.999),
+    }
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for entry in mix.split(","):
+        operation, _, weight = entry.partition("=")
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"{operation} is not one of {OPERATIONS}")
+        if float(weight) > 0:
+            weights[operation] = float(weight)
+    return weights
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(port: int, timeout: float = 10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def benchmark(transport: str, n_clients: int, n_processes: int, seconds: float, mix: dict,
+              server_workers: int = 1) -> dict:
+    """
+    Runs a benchmark against a freshly started server and returns the report
+    """
+    port = free_port()
+    server = multiprocessing.Process(target=run_server, args=(transport, port, server_workers))
+    server.start()
+
+    try:
+        wait_for_server(port)
+
+        n_processes = max(1, min(n_processes, n_clients))
+        barrier = multiprocessing.Barrier(n_processes)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=run_clients, args=(
+            transport, port, list(range(i, n_clients, n_processes)), n_clients,
+            mix, seconds, barrier, results)) for i in range(n_processes)]
+        for worker in workers:
+            worker.start()
+
+        latencies = {operation: [] for operation in mix}
+        errors = {operation: 0 for operation in mix}
+        for _ in workers:
+            for operation, (worker_latencies, worker_errors) in results.get().items():
+                latencies[operation] += worker_latencies
+                errors[operation] += worker_errors
+        for worker in workers:
+            worker.join()
+    finally:
+        server.terminate()
+
+    every_latency = [latency for values in latencies.values() for latency in values]
+    return {
+        "transport": transport,
+        "server_workers": server_workers,
+        "clients": n_clients,
+        "processes": n_processes,
+        "seconds": seconds,
+        "mix": mix,
+        "operations": {operation: summarize(latencies[operation], errors[operation], seconds)
+                       for operation in mix},
+        "total": summarize(every_latency, sum(errors.values()), seconds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--transport', choices=TRANSPORTS, default="wire")
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--mix', type=parse_mix, default="create=1,login=1,send=8,deliver=2")
+    parser.add_argument('--output', help="file to also write the JSON report to")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="processes accepting clients for the wire transport")
+    args = parser.parse_args()
+
+    report = benchmark(args.transport, args.clients, args.processes, args.seconds, args.mix,
+                       args.workers)
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark of wire Chat throughput as the number of client threads grows.
+
+Each thread plays one connection of the threaded wire server: it sends
+messages through Chat.handler to its own online recipient and writes every
+reply to a socket as a version 2 frame, like client_thread does. Threads never share a
+recipient, so with striped locks they only contend for the interpreter.
+Running with a single stripe reproduces the old global lock. With --report
+the lock contention report of each run is printed to stderr.
+
+Usage (from the chat folder):
+    python -m bench.lock_scaling [--threads 1 2 4 8] [--seconds 2] [--stripes 1 64] [--report]
+"""
+import argparse
+import json
+import socket
+import sys
+import threading
+import time
+
+from contention import PROFILER
+from wire.chat_service import Chat, User
+from wire.server import pack_reply
+
+
+def drain(sock):
+    try:
+        while sock.recv(65536):
+            pass
+    except OSError:
+        pass
+
+
+def run(n_threads: int, seconds: float, stripes: int) -> float:
+    """
+    Returns the number of messages sent per second by n_threads threads
+    """
+    chat_app = Chat(stripes=stripes)
+    socks = []
+    senders = []
+
+    for i in range(n_threads):
+        # Every response goes through a real socket, drained by another thread
+        send_sock, recv_sock = socket.socketpair()
+        threading.Thread(target=drain, args=(recv_sock,), daemon=True).start()
+        socks += [send_sock, recv_sock]
+
+        chat_app.create_account(User(send_sock), f"recipient{i}")
+        sender = User(send_sock)
+        chat_app.create_account(sender, f"sender{i}")
+        senders.append((sender, f"recipient{i}|hello from sender{i}"))
+
+    counts = [0] * n_threads
+    start_barrier = threading.Barrier(n_threads + 1)
+    deadline = [0.0]
+
+    def worker(index):
+        sender, content = senders[index]
+        start_barrier.wait()
+        count = 0
+        while time.perf_counter() < deadline[0]:
+            for recip_conn, response in chat_app.handler(sender, 5, content):
+                recip_conn.sendall(pack_reply(2, 5, response))
+            count += 1
+        counts[index] = count
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    deadline[0] = time.perf_counter() + seconds
+    start_barrier.wait()
+    for thread in threads:
+        thread.join()
+
+    for sock in socks:
+        sock.close()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--seconds', type=float, default=2.0)
+    parser.add_argument('--stripes', type=int, nargs='+', default=[1, 64])
+    parser.add_argument('--report', action='store_true')
+    args = parser.parse_args()
+
+    results = []
+    for stripes in args.stripes:
+        for n_threads in args.threads:
+            PROFILER.reset()
+            results.append({
+                "stripes": stripes,
+                "threads": n_threads,
+                "messages_per_second": round(run(n_threads, args.seconds, stripes)),
+            })
+            print(json.dumps(results[-1]))
+            if args.report:
+                print(PROFILER.report(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
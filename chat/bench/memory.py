@@ -0,0 +1,116 @@
+"""
+Benchmark of the memory used by queued messages and accounts.
+
+Builds many queued messages and accounts in the layouts the chat services
+used before (tuples with a parsed sender string for the wire service,
+ChatMessage protobufs and dicts of dicts for the grpc service) and in the
+shared __slots__ records, and reports the bytes each one adds. Every layout
+is measured in a fresh process from the growth of its resident memory,
+since protobuf messages are allocated outside of tracemalloc's view.
+
+Usage (from the chat folder):
+    python -m bench.memory [--messages 200000] [--accounts 50000] [--size 32]
+"""
+import argparse
+import json
+import multiprocessing
+import resource
+import sys
+import threading
+
+from offline import OfflineQueue
+from records import Account, Message
+
+
+def parsed(name: str) -> str:
+    # A sender name parsed out of a request is a new string every time
+    return "".join([name])
+
+
+def wire_tuple(i: int, sender: str, text: str):
+    return (parsed(sender), text)
+
+
+def grpc_protobuf(i: int, sender: str, text: str):
+    import grpc_proto.chat_pb2 as chat_pb2
+    return chat_pb2.ChatMessage(username=parsed(sender), recip_username="recipient", message=text)
+
+
+def message_record(i: int, sender: str, text: str):
+    return Message(parsed(sender), text)
+
+
+def wire_dicts(username: str):
+    # The queue and its lock were kept in two dictionaries keyed by username
+    return {"queue": OfflineQueue(), "lock": threading.Lock()}
+
+
+def grpc_dicts(username: str):
+    from grpc_proto.server import Mailbox
+    return {"messages": Mailbox(), "queue": OfflineQueue()}
+
+
+def account_record(username: str):
+    # Both services keep the same record, a mailbox only exists while online
+    return Account(username, OfflineQueue(), threading.Lock())
+
+
+MESSAGE_LAYOUTS = {"wire_tuple": wire_tuple, "grpc_protobuf": grpc_protobuf, "message_record": message_record}
+ACCOUNT_LAYOUTS = {"wire_dicts": wire_dicts, "grpc_dicts": grpc_dicts, "account_record": account_record}
+
+
+def resident_bytes() -> int:
+    """
+    Gets the peak resident memory of the process, which only grows while
+    the objects are built
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measure(kind: str, layout: str, count: int, size: int) -> float:
+    """
+    Builds count objects in one layout, returning the bytes added by each
+    """
+    objects = [None] * count
+    if kind == "message":
+        build = MESSAGE_LAYOUTS[layout]
+        texts = ["x" * size + str(i) for i in range(count)]
+        build(0, "sender", "warm up")
+        start = resident_bytes()
+        for i in range(count):
+            objects[i] = build(i, f"sender{i % 100}", texts[i])
+    else:
+        build = ACCOUNT_LAYOUTS[layout]
+        usernames = [f"user{i}" for i in range(count)]
+        build("warm up")
+        start = resident_bytes()
+        for i in range(count):
+            objects[i] = build(usernames[i])
+    return (resident_bytes() - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--accounts', type=int, default=50000)
+    parser.add_argument('--size', type=int, default=32, help="characters in each message")
+    args = parser.parse_args()
+
+    # A fresh process for each layout keeps freed memory from being reused
+    context = multiprocessing.get_context("spawn")
+    runs = [("message", layout, args.messages) for layout in MESSAGE_LAYOUTS]
+    runs += [("account", layout, args.accounts) for layout in ACCOUNT_LAYOUTS]
+    for kind, layout, count in runs:
+        with context.Pool(1) as pool:
+            per_object = pool.apply(measure, (kind, layout, count, args.size))
+        print(json.dumps({
+            "kind": kind,
+            "layout": layout,
+            "count": count,
+            "bytes_per_" + kind: round(per_object),
+        }))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Benchmark of rebuilding chat state from the message log.
+
+Writes a log of queued messages spread over a number of offline accounts,
+then times how long a wire Chat takes to replay it on startup.
+
+Usage (from the chat folder):
+    python -m bench.replay [--messages 1000000] [--accounts 1000]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from storage import LogStorage
+from wire.chat_service import Chat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=1000000)
+    parser.add_argument('--accounts', type=int, default=1000)
+    args = parser.parse_args()
+
+    log_path = os.path.join(tempfile.mkdtemp(), "chat.log")
+    storage = LogStorage(log_path)
+
+    start = time.perf_counter()
+    for i in range(args.accounts):
+        storage.create_account(f"user{i}")
+    for i in range(args.messages):
+        storage.queue_message(f"user{i % args.accounts}", "sender", f"message number {i}")
+    storage.close()
+    write_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    chat_app = Chat(storage=LogStorage(log_path))
+    replay_seconds = time.perf_counter() - start
+    chat_app.core.storage.close()
+
+    assert sum(len(account.queue) for account in chat_app.core.accounts.values()) == args.messages
+    print(json.dumps({
+        "messages": args.messages,
+        "log_bytes": os.path.getsize(log_path),
+        "write_seconds": round(write_seconds, 3),
+        "replay_seconds": round(replay_seconds, 3),
+    }))
+    os.remove(log_path)
+
+
+if __name__ == "__main__":
+    main()
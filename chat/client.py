@@ -1,11 +1,10 @@
-import re
 import socket
 import sys
 
 from grpc_proto.client import ChatClient
 from utils import get_server_config_from_file
-from wire.client import ReceiveMessages
-from wire.wire_protocol import pack_packet
+from wire.client import ReceiveMessages, negotiate
+from wire.wire_protocol import PacketDecoder, pack_fields_request, pack_packet, pack_request, parse_send
 
 # global variables
 YAML_CONFIG_PATH = '../config.yaml'
@@ -17,7 +16,20 @@ ERROR_MSG = """<client> Invalid input string, please use format <command>|<text>
     3|                  -> logout from current account
     4|                  -> delete current account
     5|<username>|<text> -> send message to username
-    6|                  -> deliver all unsent messages to current user"""
+    6|<offset>          -> deliver the next batch of unsent messages, optionally resuming from offset
+    7|<usernames>|<text> -> send message to every username in a space separated list
+    8|<size>|<after>|<regex> -> list a page of user accounts after the username after"""
+
+
+def parse_command(usr_input: str):
+    """
+    Splits a line typed by the user into its op code and content in one
+    pass, or returns None if it does not start with a digit and "|"
+    """
+    op_code, separator, content = usr_input.partition("|")
+    if not separator or len(op_code) != 1 or not op_code.isdecimal():
+        return None
+    return int(op_code), content
 
 
 def main():
@@ -33,8 +45,14 @@ def main():
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.connect((IP_ADDRESS, PORT))
 
+        # Switch to version 2 framing if the server supports it
+        decoder = PacketDecoder()
+        for _, data, *_ in negotiate(server, decoder):
+            print(data)
+        request_id = 0
+
         # Separate thread for processing incomming messages from the server
-        server_listening = ReceiveMessages(server)
+        server_listening = ReceiveMessages(server, decoder)
         server_listening.start()
 
         # Continuously listen for user inputs in the terminal
@@ -46,17 +64,26 @@ def main():
             # Parse message if non-empty
             elif usr_input != '':
                 # Parses the user input to see if it is a valid input
-                match = re.match(r"(\d)\|((\S| )*)", usr_input)
+                command = parse_command(usr_input)
                 # Check if the input is valid
-                if match:
+                if command:
                     # Parse the user input into op_code and content
-                    op_code, content = int(match.group(1)), match.group(2)
+                    op_code, content = command
+                    send = parse_send(content) if op_code == 5 else None
                     if len(content) >= 280:
                         print('<client> Message too long, please keep messages under 280 characters')
                     else:
-                        # Pack the op_code and content and send it to the server
-                        output = pack_packet(op_code, content)
-                        server.send(output)
+                        # Pack the op_code and content and send it to the server,
+                        # a version 2 send carries the recipient and message as fields
+                        if decoder.version == 1:
+                            output = pack_packet(op_code, content)
+                        elif send:
+                            request_id += 1
+                            output = pack_fields_request(op_code, send, request_id)
+                        else:
+                            request_id += 1
+                            output = pack_request(op_code, content, request_id)
+                        server.sendall(output)
                 else:
                     print(ERROR_MSG)
 
@@ -77,10 +104,10 @@ def main():
             # Parse message if non-empty
             elif usr_input != '':
                 # Parses the user input to see if it is a valid input
-                match = re.match(r"(\d)\|((\S| )*)", usr_input)
-                if match:
+                command = parse_command(usr_input)
+                if command:
                     # Parse the user input into op_code and content
-                    op_code, message = int(match.group(1)), match.group(2)
+                    op_code, message = command
                     chat.handler(op_code, message)
                 else:
                     print(ERROR_MSG)
@@ -0,0 +1,206 @@
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+REPORT_ROWS = 20
+
+
+class LockProfiler:
+    """
+    A class used to collect the wait and hold times of profiled locks by call
+    site
+    ...
+
+    Each thread adds to its own table, so recording never takes a lock that
+    would serialize the threads being measured. Tables are keyed by thread
+    id, so a new thread reuses the table of a finished one with the same id
+    and the tables never outnumber the threads alive at once.
+
+    Attributes
+    ----------
+    tables : dict
+        table of each thread by thread id, holding [acquisitions, contended
+        acquisitions, total wait, max wait, total hold, max hold] for each
+        (lock name, code object, line number)
+
+    Methods
+    -------
+    record(name, site, wait, hold)
+        Adds one acquisition of a lock
+
+    snapshot()
+        Gets the stats of every call site merged over all threads
+
+    report(rows=REPORT_ROWS)
+        Formats the call sites that waited the longest as a table
+
+    reset()
+        Forgets every acquisition recorded so far
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.local = threading.local()
+
+    def record(self, name: str, site: tuple, wait: float, hold: float):
+        try:
+            table = self.local.table
+        except AttributeError:
+            table = self.local.table = self.tables.setdefault(threading.get_ident(), {})
+
+        key = (name, *site)
+        stats = table.get(key)
+        if stats is None:
+            stats = table[key] = [0, 0, 0.0, 0.0, 0.0, 0.0]
+
+        stats[0] += 1
+        if wait:
+            stats[1] += 1
+            stats[2] += wait
+            if wait > stats[3]:
+                stats[3] = wait
+        stats[4] += hold
+        if hold > stats[5]:
+            stats[5] = hold
+
+    def snapshot(self) -> dict:
+        merged = {}
+        # Other threads keep recording, copying each table is atomic
+        for table in list(self.tables.values()):
+            for key, stats in list(table.items()):
+                total = merged.setdefault(key, [0, 0, 0.0, 0.0, 0.0, 0.0])
+                for i in (0, 1, 2, 4):
+                    total[i] += stats[i]
+                total[3] = max(total[3], stats[3])
+                total[5] = max(total[5], stats[5])
+        return merged
+
+    def report(self, rows: int = REPORT_ROWS) -> str:
+        """
+        Formats the call sites that spent the most time waiting for their
+        lock, followed by those that held it the longest
+
+        Parameters
+        ----------
+        rows: int
+            Maximum number of call sites listed
+        """
+        sites = sorted(self.snapshot().items(), key=lambda item: (item[1][2], item[1][4]), reverse=True)
+        lines = ['Lock contention by call site, longest total wait first',
+                 f'{"lock":<10}{"acquired":>10}{"contended":>11}{"wait ms":>12}{"max wait ms":>13}'
+                 f'{"hold ms":>12}{"max hold ms":>13}  call site']
+        for (name, code, line), (acquired, contended, wait, max_wait, hold, max_hold) in sites[:rows]:
+            site = f'{os.path.basename(code.co_filename)}:{line} ({code.co_name})'
+            lines.append(f'{name:<10}{acquired:>10}{contended:>11}{wait * 1000:>12.3f}{max_wait * 1000:>13.3f}'
+                         f'{hold * 1000:>12.3f}{max_hold * 1000:>13.3f}  {site}')
+        return "\n".join(lines)
+
+    def reset(self):
+        for table in list(self.tables.values()):
+            table.clear()
+
+
+# Profiler shared by every lock that is not given its own
+PROFILER = LockProfiler()
+
+
+class ProfiledLock:
+    """
+    A class used to wrap a lock, recording how long each acquisition waited
+    for it and held it, and where it was acquired
+    ...
+
+    It is used like a threading.Lock, either as a context manager or with
+    acquire and release. The lock is first tried without blocking, so an
+    uncontended acquisition reads the clock only to time the hold.
+
+    Attributes
+    ----------
+    name : str
+        name the lock's call sites are reported under
+
+    lock : Lock()
+        wrapped lock
+
+    profiler : LockProfiler
+        profiler the acquisitions are recorded in
+
+    metrics : Metrics
+        metrics the contended waits are also observed in, or None
+
+    Methods
+    -------
+    acquire(blocking=True, timeout=-1)
+        Acquires the lock, recording the caller as the call site
+
+    release()
+        Releases the lock and records the acquisition
+    """
+
+    __slots__ = ('name', 'lock', 'profiler', 'metrics', 'site', 'wait', 'acquired_at')
+
+    def __init__(self, name: str, profiler: LockProfiler = None, metrics=None, lock=None):
+        self.name = name
+        self.lock = lock or threading.Lock()
+        self.profiler = profiler or PROFILER
+        self.metrics = metrics
+
+    def take(self, frame, blocking: bool = True, timeout: float = -1) -> bool:
+        if self.lock.acquire(False):
+            wait = 0.0
+        elif not blocking:
+            return False
+        else:
+            start = time.perf_counter()
+            if not self.lock.acquire(True, timeout):
+                return False
+            wait = time.perf_counter() - start
+            if self.metrics is not None:
+                self.metrics.observe_lock_wait(wait)
+
+        # Only the holder writes these, and reads them back before releasing
+        self.site = (frame.f_code, frame.f_lineno)
+        self.wait = wait
+        self.acquired_at = time.perf_counter()
+        return True
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        return self.take(sys._getframe(1), blocking, timeout)
+
+    def release(self):
+        hold = time.perf_counter() - self.acquired_at
+        site, wait = self.site, self.wait
+        self.lock.release()
+        self.profiler.record(self.name, site, wait, hold)
+
+    def locked(self) -> bool:
+        return self.lock.locked()
+
+    def __enter__(self):
+        self.take(sys._getframe(1))
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def report_on_signal(profiler: LockProfiler = None, signum: int = None) -> bool:
+    """
+    Logs the profiler's report whenever the process gets a signal, SIGUSR1
+    by default. It must be called from the main thread.
+
+    Returns
+    -------
+    Whether the handler was installed, which needs SIGUSR1 unless another
+    signal is given
+    """
+    profiler = profiler or PROFILER
+    signum = signum if signum is not None else getattr(signal, 'SIGUSR1', None)
+    if signum is None:
+        return False
+
+    signal.signal(signum, lambda *_: logging.info('\n' + profiler.report()))
+    return True
@@ -0,0 +1,402 @@
+from contention import LockProfiler, ProfiledLock
+from index import UsernameIndex
+from metrics import Metrics
+from offline import REJECT, OfflineQueue
+from records import Account, Message, decode_message, encode_message
+from storage import ACK_MESSAGES, CLEAR_QUEUE, CREATE_ACCOUNT, DELETE_ACCOUNT, QUEUE_MESSAGE, Storage
+from wire.replies import *
+
+STRIPES = 64
+DELIVER_BATCH = 100
+
+
+class ChatCore:
+    """
+    A class used to hold all chat state, shared by every transport
+    ...
+
+    The wire and grpc services are adapters that turn their requests into
+    calls on the core and its replies back into packets or protobufs. An
+    online user is represented by a session, which is whatever the adapter
+    delivers messages through: a socket for the wire service and a mailbox
+    for the grpc service. Every method is thread safe.
+
+    Attributes
+    ----------
+    accounts : dict
+        dictionary of all accounts, holding each account's Account record
+        with its OfflineQueue of Message records and the lock guarding it
+
+    online_users : dict
+        dictionary of online users, holding each user's session
+
+    stripes: list[ProfiledLock]
+        Striped locks guarding the account directory, a username is always
+        guarded by the same stripe so unrelated users rarely contend
+
+    index: UsernameIndex
+        Sorted index of all usernames used to list accounts
+
+    storage: Storage
+        Storage that accounts and queued messages are persisted to
+
+    mailbox_config: tuple
+        Cap, overflow policy and spill folder of every account's queue
+
+    metrics: Metrics
+        Request, lock wait and mailbox depth metrics of the adapters and core
+
+    profiler: LockProfiler
+        Profiler recording where the core's locks are waited on and held
+
+    Methods
+    -------
+    create_account(username, session)
+        Creates an account and logs it in
+
+    login(username, session, previous=None)
+        Logs a user in, logging out of the account they were using
+
+    logout(username, acknowledge=True)
+        Logs a user out
+
+    delete_account(username)
+        Deletes an online user's account
+
+    route_message(username, send_user, message)
+        Finds where a message goes, queueing it if the recipient is offline
+
+    deliver(username, offset=None, batch_size=DELIVER_BATCH)
+        Gets the next batch of a user's queued messages
+
+    export_account(username)
+        Removes an account to move it to another core
+
+    import_account(username, messages, session=None)
+        Adds an account moved from another core
+    """
+
+    def __init__(self, stripes: int = STRIPES, storage: Storage = None,
+                 max_messages: int = None, overflow: str = REJECT, spill_dir: str = None,
+                 metrics: Metrics = None, profiler: LockProfiler = None):
+        self.accounts = {}
+        self.online_users = {}
+        self.metrics = metrics or Metrics()
+        self.profiler = profiler
+        self.stripes = [ProfiledLock('stripe', profiler, self.metrics) for _ in range(stripes)]
+        self.index = UsernameIndex(ProfiledLock('index', profiler))
+        self.storage = storage or Storage()
+        self.mailbox_config = (max_messages, overflow, spill_dir)
+        self.restore()
+
+    def new_account(self, username: str) -> Account:
+        """
+        Creates the record and queue of messages for a new account
+        """
+        queue = OfflineQueue(*self.mailbox_config, encode=encode_message, decode=decode_message)
+        return Account(username, queue, ProfiledLock('mailbox', self.profiler))
+
+    def restore(self):
+        """
+        Rebuilds accounts and queued messages from the storage. Records for
+        an account that does not exist, which logs written before sends
+        checked for deleted accounts can hold, are skipped.
+        """
+        for operation, fields in self.storage.replay():
+            if operation != CREATE_ACCOUNT and fields[0] not in self.accounts:
+                continue
+            if operation == CREATE_ACCOUNT:
+                self.accounts[fields[0]] = self.new_account(fields[0])
+                self.index.add(fields[0])
+            elif operation == DELETE_ACCOUNT:
+                del self.accounts[fields[0]]
+                self.index.remove(fields[0])
+            elif operation == QUEUE_MESSAGE:
+                recip_username, username, message = fields
+                self.accounts[recip_username].queue.append(Message(username, message))
+            elif operation == CLEAR_QUEUE:
+                self.accounts[fields[0]].queue.clear()
+            elif operation == ACK_MESSAGES:
+                queue = self.accounts[fields[0]].queue
+                queue.ack(queue.first_offset + int(fields[1]))
+
+    def stripe(self, username: str) -> ProfiledLock:
+        """
+        Gets the lock guarding a username in the account directory
+        """
+        return self.stripes[hash(username) % len(self.stripes)]
+
+    def create_account(self, username: str, session) -> Reply:
+        """
+        Creates an account given a specified username, logging it in
+
+        Parameters
+        ----------
+        username: str
+            Username for the new account
+
+        session:
+            Session the user is reached through once online
+        """
+        # Checks if the passed-in username is valid
+        if " " in username or "|" in username:
+            return (INVALID_USERNAME,)
+
+        # Checks if the username is empty
+        if "" == username:
+            return (EMPTY_USERNAME,)
+
+        with self.stripe(username):
+            # Checks if the username is already in use
+            if username in self.accounts:
+                return (USERNAME_IN_USE, username)
+
+            # Updates chat state for the new account
+            self.storage.create_account(username)
+            self.index.add(username)
+            self.accounts[username] = self.new_account(username)
+            self.online_users[username] = session
+
+        return (ACCOUNT_CREATED, username)
+
+    def login(self, username: str, session, previous: str = None) -> Reply:
+        """
+        Logs a user into the server
+
+        Parameters
+        ----------
+        username: str
+            Account username
+
+        session:
+            Session the user is reached through once online
+
+        previous: str, optional
+            Account the user was logged in to before, which is logged out
+            without acknowledging its delivered messages
+        """
+        with self.stripe(username):
+            # Check if the username is not in accounts
+            if username not in self.accounts:
+                return (ACCOUNT_NOT_FOUND, username)
+            # Check if another user is already logged in
+            elif username in self.online_users:
+                return (ALREADY_LOGGED_IN, username)
+
+            # Updates chat state with the new session
+            self.online_users[username] = session
+            account = self.accounts[username]
+
+        # A new session delivers again from the oldest unacknowledged message
+        with account.lock:
+            account.queue.sent_offset = account.queue.first_offset
+
+        # if the user is logged-in to a different account, we need to log them out
+        if previous is not None and previous != username:
+            with self.stripe(previous):
+                self.online_users.pop(previous, None)
+
+        return (LOGGED_IN, username)
+
+    def logout(self, username: str, acknowledge: bool = True) -> tuple:
+        """
+        Logs a user out of the server
+
+        Parameters
+        ----------
+        username: str
+            Account username
+
+        acknowledge: bool
+            Whether messages already delivered to the user are acknowledged,
+            False when the connection was lost and they may not have arrived
+
+        Returns
+        -------
+        The reply, and the session that was logged out or None
+        """
+        with self.stripe(username):
+            # Checks if the user is logged in or exists
+            if username not in self.accounts or username not in self.online_users:
+                return (LOGOUT_FAILED, username), None
+
+            # Deletes the user from the online users
+            session = self.online_users.pop(username)
+            account = self.accounts[username]
+
+        if acknowledge:
+            with account.lock:
+                self.acknowledge(username, account.queue, account.queue.sent_offset)
+
+        return (LOGGED_OUT, username), session
+
+    def delete_account(self, username: str) -> tuple:
+        """
+        Deletes the account of an online user
+
+        Returns
+        -------
+        The reply, and the session that was logged out or None
+        """
+        with self.stripe(username):
+            if username not in self.accounts or username not in self.online_users:
+                return (DELETE_FAILED, username), None
+
+            # A send that already found the account either queues its message
+            # before the deletion is logged or sees the account deleted
+            account = self.accounts.pop(username)
+            with account.lock:
+                account.deleted = True
+                self.storage.delete_account(username)
+            self.index.remove(username)
+            session = self.online_users.pop(username)
+
+        return (ACCOUNT_DELETED, username), session
+
+    def route_message(self, username: str, send_user: str, message: str) -> tuple:
+        """
+        Queues a message if the recipient is offline
+
+        Parameters
+        ----------
+        username: str
+            Username of the sender
+
+        send_user: str
+            Username of the intended recipient
+
+        message: str
+            Chat message
+
+        Returns
+        -------
+        The delivery status, and the recipient's session if the message
+        should be sent to them directly
+        """
+        # Look up the recipient, holding only the stripe for their username
+        with self.stripe(send_user):
+            account = self.accounts.get(send_user)
+            is_online = send_user in self.online_users
+            session = self.online_users.get(send_user)
+
+        if account is None:
+            return NOT_FOUND, None
+
+        if is_online:
+            return SENT, session
+
+        # queue the message if the user is not online, only logging it once
+        # the mailbox has accepted it
+        with account.lock:
+            # The account was deleted after it was looked up
+            if account.deleted:
+                return NOT_FOUND, None
+            if not account.queue.append(Message(username, message)):
+                return MAILBOX_FULL, None
+            self.storage.queue_message(send_user, username, message)
+            self.metrics.observe_mailbox_depth(len(account.queue))
+        return QUEUED, None
+
+    def deliver(self, username: str, offset: int = None, batch_size: int = DELIVER_BATCH) -> tuple:
+        """
+        Gets the next batch of queued messages for a user
+
+        Messages stay queued until they are acknowledged, which a request
+        for the next batch or a logout does for every message sent so far.
+        A client that lost a batch in a disconnect resumes by passing the
+        offset after the last message it received.
+
+        Parameters
+        ----------
+        username: str
+            Account username
+
+        offset: int, optional
+            Acknowledge every message before this offset and deliver from
+            it, instead of from after the last batch sent
+
+        batch_size: int
+            Maximum number of messages to deliver
+
+        Returns
+        -------
+        The Message records, the offset to resume from and the number of
+        messages still queued after them
+        """
+        account = self.accounts[username]
+        queue = account.queue
+
+        # only hold the mailbox lock while copying one batch
+        with account.lock:
+            if offset is None:
+                offset = queue.sent_offset
+            # A client cannot acknowledge or skip past the end of its queue
+            offset = min(max(offset, queue.first_offset), queue.end_offset)
+            self.acknowledge(username, queue, offset)
+            start = offset
+            messages = queue.peek(start, batch_size)
+            queue.sent_offset = start + len(messages)
+            remaining = queue.end_offset - queue.sent_offset
+
+        return messages, start + len(messages), remaining
+
+    def acknowledge(self, username: str, queue: OfflineQueue, offset: int):
+        """
+        Removes a user's queued messages before an offset and logs how many
+        were removed, the caller holds the user's mailbox lock
+        """
+        count = queue.ack(offset)
+        if count:
+            self.storage.ack_messages(username, count)
+
+    def export_account(self, username: str) -> tuple:
+        """
+        Removes an account along with its queued messages so that it can be
+        moved to another core
+
+        Returns
+        -------
+        The Message records still queued, including delivered ones that were
+        not acknowledged, and the account's session or None if offline
+        """
+        with self.stripe(username):
+            account = self.accounts.pop(username)
+            session = self.online_users.pop(username, None)
+            self.index.remove(username)
+            with account.lock:
+                account.deleted = True
+                self.storage.delete_account(username)
+
+        with account.lock:
+            messages = account.queue.take()
+        return messages, session
+
+    def import_account(self, username: str, messages: list, session=None):
+        """
+        Adds an account moved from another core, appending to its queue if
+        it was already imported so a long queue can arrive in several parts
+
+        Parameters
+        ----------
+        username: str
+            Account username
+
+        messages: list
+            (sender, text) pairs queued for the account
+
+        session: optional
+            Session of the user if they are online
+        """
+        with self.stripe(username):
+            if username not in self.accounts:
+                self.storage.create_account(username)
+                self.index.add(username)
+                self.accounts[username] = self.new_account(username)
+            account = self.accounts[username]
+            if session is not None:
+                self.online_users[username] = session
+
+        with account.lock:
+            for sender, text in messages:
+                if account.queue.append(Message(sender, text)):
+                    self.storage.queue_message(username, sender, text)
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+from collections import deque
+
+import grpc
+import grpc_proto.chat_pb2_grpc as chat_pb2_grpc
+from grpc_proto.server import ChatServer
+
+
+class AsyncMailbox:
+    """
+    A class used to hold the messages waiting on a user's chat stream
+    ...
+
+    Same interface as Mailbox, except that get() is a coroutine that waits
+    on an asyncio event. It must only be used from the server's event loop.
+
+    Attributes
+    ----------
+    messages : deque
+        messages waiting to be streamed to the user
+
+    session : int
+        id of the chat stream currently allowed to read the mailbox
+
+    changed: Event()
+        Event that is set whenever the mailbox changes
+
+    Methods
+    -------
+    open()
+        Starts a new session, ending any previous one
+
+    close()
+        Ends the current session
+
+    release(session)
+        Ends the session if it is still the current one
+
+    put(message)
+        Adds a message and wakes the chat stream
+
+    get(session)
+        Waits until a message arrives or the session ends
+    """
+
+    def __init__(self):
+        self.messages = deque()
+        self.session = 0
+        self.changed = asyncio.Event()
+
+    def open(self) -> int:
+        self.session += 1
+        self.changed.set()
+        return self.session
+
+    def close(self):
+        self.session += 1
+        self.changed.set()
+
+    def release(self, session: int):
+        if self.session == session:
+            self.close()
+
+    def put(self, message):
+        self.messages.append(message)
+        self.changed.set()
+
+    async def get(self, session: int):
+        """
+        Returns the next message, or None once the session has ended
+        """
+        while not self.messages and self.session == session:
+            self.changed.clear()
+            await self.changed.wait()
+
+        if self.session != session:
+            return None
+        return self.messages.popleft()
+
+
+class AsyncChatServer(ChatServer):
+    """
+    grpc.aio ChatServer implementation
+    ...
+
+    Every RPC runs as a coroutine on one event loop, so a chat stream waiting
+    for messages does not hold a worker thread. The unary RPCs reuse the
+    ChatServer logic, which never blocks.
+    """
+
+    mailbox_class = AsyncMailbox
+
+    async def ListAccounts(self, request, context):
+        return super().ListAccounts(request, context)
+
+    async def ListAccountsStream(self, request, context):
+        for page in super().ListAccountsStream(request, context):
+            yield page
+
+    async def CreateAccount(self, request, context):
+        return super().CreateAccount(request, context)
+
+    async def Login(self, request, context):
+        return super().Login(request, context)
+
+    async def Logout(self, request, context):
+        return super().Logout(request, context)
+
+    async def DeleteAccount(self, request, context):
+        return super().DeleteAccount(request, context)
+
+    async def SendMessage(self, request, context):
+        return super().SendMessage(request, context)
+
+    async def SendMessageBatch(self, request, context):
+        return super().SendMessageBatch(request, context)
+
+    async def DeliverMessages(self, request, context):
+        return super().DeliverMessages(request, context)
+
+    async def ChatStream(self, request, context):
+        """
+        This is a response-stream type call. The coroutine waits on the user's
+        mailbox and yields each message as it arrives
+        """
+        logging.debug('ChatStream initialized for "%s"', request.username)
+
+        # If the user is not online, we cannot send them messages
+        mailbox = self.core.online_users.get(request.username)
+        if mailbox is None:
+            return
+        session = mailbox.open()
+
+        # End the session if the client cancels the stream or disconnects
+        context.add_done_callback(lambda _: mailbox.release(session))
+
+        while self.is_connected:
+            message = await mailbox.get(session)
+            if message is None:
+                break
+            yield message
+
+
+async def serve(service, address: str, max_concurrent_rpcs: int = None):
+    """
+    Runs a grpc.aio server until it is cancelled
+
+    Parameters
+    ----------
+    service: AsyncChatServer
+        Servicer handling all the chat logic
+
+    address: str
+        Address and port to bind the server to
+
+    max_concurrent_rpcs: int, optional
+        RPCs in flight before new ones are rejected, None for no limit
+    """
+    server = grpc.aio.server(maximum_concurrent_rpcs=max_concurrent_rpcs)
+    chat_pb2_grpc.add_ChatServerServicer_to_server(service, server)
+    server.add_insecure_port(address)
+    await server.start()
+
+    try:
+        await server.wait_for_termination()
+    finally:
+        # Set the service to not connected so that each stream is ended
+        service.is_connected = False
+        await server.stop(None)
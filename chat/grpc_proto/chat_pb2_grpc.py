@@ -30,6 +30,11 @@ class ChatServerStub(object):
                 request_serializer=chat__pb2.Wildcard.SerializeToString,
                 response_deserializer=chat__pb2.ListofUsernames.FromString,
                 )
+        self.ListAccountsStream = channel.unary_stream(
+                '/chatservice.ChatServer/ListAccountsStream',
+                request_serializer=chat__pb2.Wildcard.SerializeToString,
+                response_deserializer=chat__pb2.ListofUsernames.FromString,
+                )
         self.ChatStream = channel.unary_stream(
                 '/chatservice.ChatServer/ChatStream',
                 request_serializer=chat__pb2.User.SerializeToString,
@@ -40,10 +45,15 @@ class ChatServerStub(object):
                 request_serializer=chat__pb2.ChatMessage.SerializeToString,
                 response_deserializer=chat__pb2.MessageStatus.FromString,
                 )
+        self.SendMessageBatch = channel.unary_unary(
+                '/chatservice.ChatServer/SendMessageBatch',
+                request_serializer=chat__pb2.ChatMessageBatch.SerializeToString,
+                response_deserializer=chat__pb2.MessageStatusBatch.FromString,
+                )
         self.DeliverMessages = channel.unary_unary(
                 '/chatservice.ChatServer/DeliverMessages',
-                request_serializer=chat__pb2.User.SerializeToString,
-                response_deserializer=chat__pb2.Empty.FromString,
+                request_serializer=chat__pb2.Delivery.SerializeToString,
+                response_deserializer=chat__pb2.DeliveredMessages.FromString,
                 )
         self.Login = channel.unary_unary(
                 '/chatservice.ChatServer/Login',
@@ -79,6 +89,12 @@ class ChatServerServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def ListAccountsStream(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def ChatStream(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -91,6 +107,12 @@ class ChatServerServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def SendMessageBatch(self, request, context):
+        """Missing associated documentation comment in .proto file."""
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
     def DeliverMessages(self, request, context):
         """Missing associated documentation comment in .proto file."""
         context.set_code(grpc.StatusCode.UNIMPLEMENTED)
@@ -127,6 +149,11 @@ def add_ChatServerServicer_to_server(servicer, server):
                     request_deserializer=chat__pb2.Wildcard.FromString,
                     response_serializer=chat__pb2.ListofUsernames.SerializeToString,
             ),
+            'ListAccountsStream': grpc.unary_stream_rpc_method_handler(
+                    servicer.ListAccountsStream,
+                    request_deserializer=chat__pb2.Wildcard.FromString,
+                    response_serializer=chat__pb2.ListofUsernames.SerializeToString,
+            ),
             'ChatStream': grpc.unary_stream_rpc_method_handler(
                     servicer.ChatStream,
                     request_deserializer=chat__pb2.User.FromString,
@@ -137,10 +164,15 @@ def add_ChatServerServicer_to_server(servicer, server):
                     request_deserializer=chat__pb2.ChatMessage.FromString,
                     response_serializer=chat__pb2.MessageStatus.SerializeToString,
             ),
+            'SendMessageBatch': grpc.unary_unary_rpc_method_handler(
+                    servicer.SendMessageBatch,
+                    request_deserializer=chat__pb2.ChatMessageBatch.FromString,
+                    response_serializer=chat__pb2.MessageStatusBatch.SerializeToString,
+            ),
             'DeliverMessages': grpc.unary_unary_rpc_method_handler(
                     servicer.DeliverMessages,
-                    request_deserializer=chat__pb2.User.FromString,
-                    response_serializer=chat__pb2.Empty.SerializeToString,
+                    request_deserializer=chat__pb2.Delivery.FromString,
+                    response_serializer=chat__pb2.DeliveredMessages.SerializeToString,
             ),
             'Login': grpc.unary_unary_rpc_method_handler(
                     servicer.Login,
@@ -214,6 +246,23 @@ class ChatServer(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def ListAccountsStream(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(request, target, '/chatservice.ChatServer/ListAccountsStream',
+            chat__pb2.Wildcard.SerializeToString,
+            chat__pb2.ListofUsernames.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def ChatStream(request,
             target,
@@ -248,6 +297,23 @@ class ChatServer(object):
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
+    @staticmethod
+    def SendMessageBatch(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(request, target, '/chatservice.ChatServer/SendMessageBatch',
+            chat__pb2.ChatMessageBatch.SerializeToString,
+            chat__pb2.MessageStatusBatch.FromString,
+            options, channel_credentials,
+            insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
+
     @staticmethod
     def DeliverMessages(request,
             target,
@@ -260,8 +326,8 @@ class ChatServer(object):
             timeout=None,
             metadata=None):
         return grpc.experimental.unary_unary(request, target, '/chatservice.ChatServer/DeliverMessages',
-            chat__pb2.User.SerializeToString,
-            chat__pb2.Empty.FromString,
+            chat__pb2.Delivery.SerializeToString,
+            chat__pb2.DeliveredMessages.FromString,
             options, channel_credentials,
             insecure, call_credentials, compression, wait_for_ready, timeout, metadata)
 
@@ -4,7 +4,9 @@ import grpc_proto.chat_pb2_grpc as chat_pb2_grpc
 
 import threading
 
-import re
+from wire.wire_protocol import parse_send
+
+LIST_PAGE_SIZE = 100
 
 
 class ChatClient:
@@ -40,6 +42,13 @@ class ChatClient:
             # op code to login
             elif op_code == 2:
                 self.login_account(content)
+            # op code to list a page of accounts
+            elif op_code == 8:
+                page_size, cursor, wildcard = (content.split("|", 2) + ["", ""])[:3]
+                if page_size.isdecimal() and int(page_size) > 0:
+                    self.list_accounts_page(wildcard, int(page_size), cursor)
+                else:
+                    print(f"<server> Invalid input: {content}.")
             # op codes that should only work if authenticated
             elif self.is_connected:
                 # op code to logout
@@ -50,12 +59,11 @@ class ChatClient:
                     self.delete_account()
                 # op code to send message
                 elif op_code == 5:
-                    # check if the message is in the correct format
-                    # cannot have a pipe character in the message
-                    match = re.match(r"(\S+)\|((\S| )+)", content)
-                    if match:
-                        send_user, message = match.group(1), match.group(2)
-                        self.send_message(send_user, message)
+                    # check if the message is in the correct format,
+                    # the recipient ends at the first pipe character
+                    send = parse_send(content)
+                    if send:
+                        self.send_message(*send)
                     # if the message is not in the correct format
                     # print an error message
                     else:
@@ -63,6 +71,13 @@ class ChatClient:
                 # op code to deliver undelivered messages
                 elif op_code == 6:
                     self.deliver_undelivered()
+                # op code to send a message to several users
+                elif op_code == 7:
+                    send_users, _, message = content.partition("|")
+                    if send_users.strip() and message:
+                        self.send_message_batch(send_users.split(), message)
+                    else:
+                        print(f"<server> Invalid input: {content}.")
                 # op code is not valid
                 else:
                     print(f'<server> {op_code} is not a valid operation code.')
@@ -88,17 +103,38 @@ class ChatClient:
 
     def list_accounts(self, wildcard: str):
         """
-        List all accounts on the chat server
+        List all accounts on the chat server, printing each page of accounts
+        as it is streamed from the server
         Returns:
             str: string to indicate listing accounts was successful.
         """
+        pages = self.__stub.ListAccountsStream(
+            chat_pb2.Wildcard(wildcard=wildcard, page_size=LIST_PAGE_SIZE))
+
+        outputs = []
+        for page in pages:
+            outputs.append(f"<server> All Accounts: {str(page.usernames)}")
+            print(outputs[-1])
+
+        # return statement for unit testing verification
+        return "\n".join(outputs)
+
+    def list_accounts_page(self, wildcard: str, page_size: int, cursor: str = ""):
+        """
+        List one page of accounts on the chat server
+        Returns:
+            str: string with the accounts and the cursor of the next page.
+        """
         response = self.__stub.ListAccounts(
-            chat_pb2.Wildcard(wildcard=wildcard))
+            chat_pb2.Wildcard(wildcard=wildcard, limit=page_size, cursor=cursor))
 
-        print(f"<server> All Accounts: {str(response.usernames)}")
+        output = f"<server> All Accounts: {str(response.usernames)}"
+        if response.next_cursor:
+            output += f' More accounts after "{response.next_cursor}".'
+        print(output)
 
         # return statement for unit testing verification
-        return f"<server> All Accounts: {str(response.usernames)}"
+        return output
 
     def create_account(self, username: str):
         """
@@ -189,14 +225,49 @@ class ChatClient:
         # Check if the message was sent successfully or if it was queued
         if response.status == 1:
             print(f"<server> Message sent to \"{send_user}\".")
+        elif response.status == -2:
+            print(f"<server> Failed to send. The mailbox of account \"{send_user}\" is full.")
+            return "Mailbox full."
         else:
             print(f"<server> Account \"{send_user}\" not online. Message queued to send.")
 
         # return statement for unit testing verification
         return "Message sent."
 
+    def send_message_batch(self, send_users: list, message: str):
+        """
+        Send one message to several users in a single request
+        Returns:
+            str: string with the delivery status of every recipient.
+        """
+        response = self.__stub.SendMessageBatch(chat_pb2.ChatMessageBatch(
+            username=self.username, recip_usernames=send_users, message=message))
+
+        status_names = {-2: "mailbox full", -1: "does not exist", 0: "queued", 1: "sent"}
+        statuses = [f'"{username}": {status_names[status]}'
+                    for username, status in zip(response.recip_usernames, response.statuses)]
+        output = f"<server> Message sent to {len(statuses)} accounts. {', '.join(statuses)}."
+        print(output)
+
+        # return statement for unit testing verification
+        return output
+
     def deliver_undelivered(self):
-        self.__stub.DeliverMessages(self.__user)
+        """
+        Fetches queued messages one batch at a time, acknowledging each
+        batch when asking for the next one
+        """
+        offset = None
+        while True:
+            response = self.__stub.DeliverMessages(
+                chat_pb2.Delivery(username=self.username, offset=offset))
+            for chat_message in response.messages:
+                print(f"<{chat_message.username}> {chat_message.message}")
+
+            # An empty batch means the previous one was the last
+            if not response.messages:
+                break
+            offset = response.next_offset
 
         # return statement for unit testing verification
         return "Undelivered messages delivered."
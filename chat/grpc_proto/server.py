@@ -1,10 +1,116 @@
+import functools
 import logging
 import re
 import threading
+import time
+from collections import deque
 
 import grpc
 import grpc_proto.chat_pb2 as chat_pb2
 import grpc_proto.chat_pb2_grpc as chat_pb2_grpc
+from core import DELIVER_BATCH, ChatCore
+from offline import REJECT
+from storage import Storage
+from wire.replies import *
+
+PAGE_SIZE = 100
+
+
+def instrumented(method):
+    """
+    Counts each call of a unary RPC in the core's metrics along with its
+    latency, as an error if it raised or set an error code
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, request, context):
+        start = time.perf_counter()
+        failed = True
+        try:
+            response = method(self, request, context)
+            failed = context is not None and context.code() not in (None, grpc.StatusCode.OK)
+            return response
+        finally:
+            self.core.metrics.observe(name, time.perf_counter() - start, failed)
+    return wrapper
+
+
+class Mailbox:
+    """
+    A class used to hold the messages waiting on a user's chat stream
+    ...
+
+    A chat stream blocks on the mailbox's condition variable until a message
+    arrives or its session ends, so idle streams use no CPU.
+
+    Attributes
+    ----------
+    messages : deque
+        messages waiting to be streamed to the user
+
+    session : int
+        id of the chat stream currently allowed to read the mailbox
+
+    condition: Condition()
+        Condition variable that is notified whenever the mailbox changes
+
+    Methods
+    -------
+    open()
+        Starts a new session, ending any previous one
+
+    close()
+        Ends the current session
+
+    release(session)
+        Ends the session if it is still the current one
+
+    put(message)
+        Adds a message and wakes the chat stream
+
+    get(session)
+        Blocks until a message arrives or the session ends
+    """
+
+    def __init__(self):
+        self.messages = deque()
+        self.session = 0
+        self.condition = threading.Condition()
+
+    def open(self) -> int:
+        with self.condition:
+            self.session += 1
+            self.condition.notify_all()
+            return self.session
+
+    def close(self):
+        with self.condition:
+            self.session += 1
+            self.condition.notify_all()
+
+    def release(self, session: int):
+        with self.condition:
+            if self.session == session:
+                self.session += 1
+                self.condition.notify_all()
+
+    def put(self, message):
+        with self.condition:
+            self.messages.append(message)
+            self.condition.notify_all()
+
+    def get(self, session: int):
+        """
+        Returns the next message, or None once the session has ended
+        """
+        with self.condition:
+            while not self.messages and self.session == session:
+                self.condition.wait()
+
+            if self.session != session:
+                return None
+            return self.messages.popleft()
 
 
 class ChatServer(chat_pb2_grpc.ChatServer):
@@ -12,42 +118,56 @@ class ChatServer(chat_pb2_grpc.ChatServer):
     grpc ChatServer implementation
     ...
 
+    Adapts grpc requests to the ChatCore holding all chat state. A user's
+    session is a new mailbox for each login, which their chat stream reads
+    from, so offline users never hold one.
+
     Attributes
     ----------
-    users : dict
-        dictionary of all accounts
-
-    online_users : set
-        set of online users
+    core : ChatCore
+        chat state shared by every RPC
 
     is_connected: bool
         Boolean representing whether the server is up and connected
 
-    lock: Lock()
-        Primative lock for multithread synchronization
-
     Methods
     -------
-    says(sound=None)
-        Prints the animals name and what sound it makes
+    ChatStream(request, context)
+        Streams the messages sent to an online user
     """
 
-    def __init__(self):
-        self.users = {}
-        self.online_users = set()
-        self.is_connected = True
-        self.lock = threading.Lock()
+    mailbox_class = Mailbox
+
+    def __init__(self, storage: Storage = None,
+                 max_messages: int = None, overflow: str = REJECT, spill_dir: str = None):
+        self.core = ChatCore(storage=storage, max_messages=max_messages,
+                             overflow=overflow, spill_dir=spill_dir)
+        self._is_connected = True
+
+    @property
+    def is_connected(self):
+        return self._is_connected
+
+    @is_connected.setter
+    def is_connected(self, value: bool):
+        self._is_connected = value
+
+        # Wake every chat stream so that it ends when the server stops
+        if not value:
+            for mailbox in list(self.core.online_users.values()):
+                mailbox.close()
 
     # helper function to send a message to a user
     def server_message(self, recip_username, message):
-        chat_message = {"username": "server", "message": message}
-        self.users[recip_username]["messages"].append(chat_message)
+        chat_message = chat_pb2.ChatMessage(username="server", message=message)
+        self.core.online_users[recip_username].put(chat_message)
 
+    @instrumented
     def ListAccounts(self, request, context):
         '''
-        Lists an accounts with the given regex pattern
+        Lists a page of accounts with the given regex pattern
         Returns:
-            ListofUsernames: ListofUsernames object  
+            ListofUsernames: ListofUsernames object with the cursor of the next page
         '''
         # Checks if the passed-in expression is a valid regex pattern
         try:
@@ -58,16 +178,34 @@ class ChatServer(chat_pb2_grpc.ChatServer):
                 f'"{request.wildcard}" is not a valid regex pattern.')
             return chat_pb2.ListofUsernames()
 
-        list_of_usernames = chat_pb2.ListofUsernames()
+        # Only usernames starting with the pattern's literal prefix are checked
+        usernames, next_cursor = self.core.index.search(
+            filter, request.limit or None, request.cursor or None)
 
-        self.lock.acquire()
-        for username in self.users:
-            if filter.match(username):
-                list_of_usernames.usernames.append(username)
-        self.lock.release()
+        return chat_pb2.ListofUsernames(usernames=usernames, next_cursor=next_cursor or "")
 
-        return list_of_usernames
+    def ListAccountsStream(self, request, context):
+        '''
+        Streams the accounts matching the given regex pattern, one page of
+        page_size accounts at a time
+        Returns:
+            ListofUsernames: stream of pages with the cursor to resume from
+        '''
+        # Checks if the passed-in expression is a valid regex pattern
+        try:
+            filter = re.compile(request.wildcard)
+        except:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(
+                f'"{request.wildcard}" is not a valid regex pattern.')
+            return
+
+        # Each page is only found once the client is ready for it
+        for usernames, next_cursor in self.core.index.pages(
+                filter, request.page_size or PAGE_SIZE, request.cursor or None):
+            yield chat_pb2.ListofUsernames(usernames=usernames, next_cursor=next_cursor or "")
 
+    @instrumented
     def CreateAccount(self, request, context):
         '''
         Creates an account with the given username
@@ -75,35 +213,31 @@ class ChatServer(chat_pb2_grpc.ChatServer):
             User: User object
         '''
         username = request.username
+        code, *_ = self.core.create_account(username, self.mailbox_class())
 
         # Checks if the passed-in username is valid
-        if " " in username or "|" in username:
+        if code == INVALID_USERNAME:
             context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
             context.set_details('Username cannot have " " or "|".')
             return chat_pb2.ListofUsernames()
 
         # Checks if the username is empty
-        if "" == username:
+        if code == EMPTY_USERNAME:
             context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
             context.set_details('Username cannot be empty')
             return chat_pb2.ListofUsernames()
 
         # Checks if the username is already in use
-        if username in self.users:
+        if code == USERNAME_IN_USE:
             context.set_code(grpc.StatusCode.ALREADY_EXISTS)
             context.set_details(
                 f'Username "{username}" is already in use.')
             return chat_pb2.ListofUsernames()
 
-        # Updates chat server state for the new account
-        self.lock.acquire()
-        self.users[username] = {"messages": [], "queue": []}
-        self.online_users.add(username)
-        self.lock.release()
-
-        logging.info(f'User "{username}" has been created')
+        logging.debug('User "%s" has been created', username)
         return chat_pb2.User(username=username)
 
+    @instrumented
     def Login(self, request, context):
         """
         Logs a user into the server
@@ -111,52 +245,48 @@ class ChatServer(chat_pb2_grpc.ChatServer):
             User: User object
         """
         username = request.username
+        code, *_ = self.core.login(username, self.mailbox_class())
 
         # Check if the username is not in accounts
-        if username not in self.users:
+        if code == ACCOUNT_NOT_FOUND:
             context.set_code(grpc.StatusCode.NOT_FOUND)
             context.set_details(
                 f'Account "{username}" not found.')
             return chat_pb2.User()
 
         # Check if another user is already logged in
-        if username in self.online_users:
+        if code == ALREADY_LOGGED_IN:
             context.set_code(grpc.StatusCode.PERMISSION_DENIED)
             context.set_details(
                 f'You cannot login "{username}" currently.')
             return chat_pb2.User()
 
-        # Updates chat server state with account connection
-        self.lock.acquire()
-        self.online_users.add(username)
-        self.lock.release()
-
-        logging.info(f'User has logged into "{username}"')
+        logging.debug('User has logged into "%s"', username)
         return chat_pb2.User(username=username)
 
+    @instrumented
     def Logout(self, request, context):
         """
-        Logs a user out of the server
+        Logs a user out of the server, acknowledging every message delivered
+        to them and ending their chat stream
         Returns:
             User: User object
         """
         username = request.username
+        (code, *_), mailbox = self.core.logout(username)
 
         # Checks if the user is logged in
-        if username not in self.users or username not in self.online_users:
+        if code == LOGOUT_FAILED:
             context.set_code(grpc.StatusCode.NOT_FOUND)
             context.set_details(
                 f'You are not logged in, or account "{username}" does not exist.')
             return chat_pb2.User()
 
-        # Deletes the user from the online users
-        self.lock.acquire()
-        self.online_users.remove(username)
-        self.lock.release()
-
-        logging.info(f'User has logged out of "{username}"')
+        mailbox.close()
+        logging.debug('User has logged out of "%s"', username)
         return chat_pb2.User(username=username)
 
+    @instrumented
     def DeleteAccount(self, request, context):
         '''
         Deletes an account with the given username
@@ -164,72 +294,96 @@ class ChatServer(chat_pb2_grpc.ChatServer):
             User: User object     
         '''
         username = request.username
+        (code, *_), mailbox = self.core.delete_account(username)
 
         # Checks if the user is logged in or exists
-        if username not in self.online_users or username not in self.users:
+        if code == DELETE_FAILED:
             context.set_code(grpc.StatusCode.NOT_FOUND)
             context.set_details(
                 f'You are not logged in, or account "{username}" does not exist.')
             return chat_pb2.User()
 
-        # Deletes the user from the online users and the users dictionary
-        self.lock.acquire()
-        del self.users[username]
-        self.online_users.remove(username)
-        self.lock.release()
-
-        logging.info(f'User "{username}" has been deleted')
+        mailbox.close()
+        logging.debug('User "%s" has been deleted', username)
         return chat_pb2.User(username=username)
 
+    @instrumented
     def SendMessage(self, request, context):
         '''
         Sends a message to a specified user
         Returns:
-            Empty: Empty object
+            MessageStatus: 1 if the message was sent, 0 if it was queued and
+            -2 if the recipient's mailbox is full
         '''
         recip_username = request.recip_username
+        status, mailbox = self.core.route_message(request.username, recip_username, request.message)
 
         # Check if the username does not exist
-        if recip_username not in self.users:
+        if status == NOT_FOUND:
             context.set_code(grpc.StatusCode.NOT_FOUND)
             context.set_details(f'Account {recip_username} does not exist.')
             return chat_pb2.MessageStatus()
         # send the message directly if the user is online
-        elif recip_username in self.online_users:
-            self.lock.acquire()
-            self.users[recip_username]["messages"].append(request)
-            self.lock.release()
-
-            logging.info(f'Message sent to "{recip_username}"')
-            return chat_pb2.MessageStatus(status=1)
-        # queue the message if the user is not online
+        elif status == SENT:
+            mailbox.put(request)
+            logging.debug('Message sent to "%s"', recip_username)
+        elif status == MAILBOX_FULL:
+            logging.debug('Mailbox of "%s" is full', recip_username)
         else:
-            self.lock.acquire()
-            self.users[recip_username]["queue"].append(request)
-            self.lock.release()
+            logging.debug('Message queued for "%s"', recip_username)
 
-            logging.info(f'Message queued for "{recip_username}"')
-            return chat_pb2.MessageStatus(status=0)
+        return chat_pb2.MessageStatus(status=status)
 
+    @instrumented
+    def SendMessageBatch(self, request, context):
+        '''
+        Sends one message to several users
+        Returns:
+            MessageStatusBatch: status for each recipient, 1 if the message
+            was sent, 0 if it was queued, -1 if the account does not exist
+            and -2 if its mailbox is full
+        '''
+        statuses = chat_pb2.MessageStatusBatch()
+
+        # Each recipient only receives the message once, even if repeated
+        for recip_username in dict.fromkeys(request.recip_usernames):
+            status, mailbox = self.core.route_message(request.username, recip_username, request.message)
+
+            # send the message directly if the user is online
+            if status == SENT:
+                mailbox.put(chat_pb2.ChatMessage(
+                    username=request.username, recip_username=recip_username, message=request.message))
+
+            statuses.recip_usernames.append(recip_username)
+            statuses.statuses.append(status)
+
+        logging.debug('Message sent to %s accounts', len(statuses.statuses))
+        return statuses
+
+    @instrumented
     def DeliverMessages(self, request, context):
         """
-        Delivers all queued messages to the user
+        Delivers the next batch of queued messages to the user. Messages stay
+        queued until a later call or a logout acknowledges them, so a client
+        that lost a batch resumes by passing the offset it last received.
         Returns:
-            Empty: Empty object
+            DeliveredMessages: the batch and the offset to continue from
         """
-        self.lock.acquire()
+        if request.username not in self.core.accounts:
+            context.set_code(grpc.StatusCode.NOT_FOUND)
+            context.set_details(f'Account "{request.username}" not found.')
+            return chat_pb2.DeliveredMessages()
 
-        # Dump all queued messages into the user's message list
-        queue = self.users[request.username]["queue"]
-        self.users[request.username]["messages"].extend(queue)
+        offset = request.offset if request.HasField("offset") else None
+        messages, next_offset, remaining = self.core.deliver(request.username, offset, DELIVER_BATCH)
 
-        # Clear the queue
-        self.users[request.username]["queue"] = []
+        # Queued records only become protobuf messages once they are delivered
+        messages = [chat_pb2.ChatMessage(username=message.sender, recip_username=request.username,
+                                         message=message.text) for message in messages]
 
-        self.lock.release()
-        
-        logging.info(f'All queued messages delivered to "{request.username}"')
-        return chat_pb2.Empty()
+        logging.debug('%s queued messages delivered to "%s"', len(messages), request.username)
+        return chat_pb2.DeliveredMessages(
+            messages=messages, next_offset=next_offset, remaining=remaining)
 
     def ChatStream(self, request, context):
         """
@@ -240,15 +394,21 @@ class ChatServer(chat_pb2_grpc.ChatServer):
         :param context:
         :return:
         """
-        logging.info(f'ChatStream initialized for "{request.username}"')
+        logging.debug('ChatStream initialized for "%s"', request.username)
 
         # If the user is not online, we cannot send them messages
-        while self.is_connected and request.username in self.online_users:
-            # if there the user has deleted, they will not be in self.users
-            # not checking for this may cause a multi-threaded error so we should 
-            # stop streaming messages to that user since their account is deleted
-            if request.username not in self.users:
+        mailbox = self.core.online_users.get(request.username)
+        if mailbox is None:
+            return
+        session = mailbox.open()
+
+        # End the session if the client cancels the stream or disconnects
+        context.add_callback(lambda: mailbox.release(session))
+
+        # Sleep until a message arrives or the session is ended by a logout,
+        # account deletion, a newer stream, or the server stopping
+        while self.is_connected:
+            message = mailbox.get(session)
+            if message is None:
                 break
-            # Send messages to the user if they exist
-            while self.users[request.username]["messages"]:
-                yield self.users[request.username]["messages"].pop(0)
+            yield message
@@ -0,0 +1,164 @@
+import bisect
+import threading
+
+REGEX_METACHARACTERS = set(".^$*+?{}[]\\|()")
+OPTIONAL_QUANTIFIERS = set("*?{")
+SCAN_CHUNK = 1024
+
+
+def literal_prefix(exp: str) -> str:
+    """
+    Gets the literal text that every match of a regex must start with
+    Args:
+        exp: Regex expression that is matched from the start of a username
+    Returns:
+        The longest prefix that can be found without parsing the regex,
+        which is empty when the regex could match anything
+    """
+    # A top level alternation could match names with different prefixes
+    if "|" in exp:
+        return ""
+
+    prefix = []
+    for char in exp:
+        if char in REGEX_METACHARACTERS:
+            # The previous character may be repeated zero times
+            if char in OPTIONAL_QUANTIFIERS and prefix:
+                prefix.pop()
+            break
+        prefix.append(char)
+
+    return "".join(prefix)
+
+
+class UsernameIndex:
+    """
+    A class used to look up usernames in sorted order
+    ...
+
+    Usernames are kept in a sorted list, so every username starting with a
+    prefix is found by binary search and the regex only has to be run over
+    that range.
+
+    Attributes
+    ----------
+    usernames : list
+        sorted list of every username
+
+    lock: Lock()
+        Primative lock for multithread synchronization
+
+    Methods
+    -------
+    add(username)
+        Adds a username to the index
+
+    remove(username)
+        Removes a username from the index
+
+    search(pattern, limit=None, cursor=None)
+        Finds a page of usernames matching a compiled regex
+
+    pages(pattern, page_size, cursor=None)
+        Yields every page of usernames matching a compiled regex
+    """
+
+    def __init__(self, lock=None):
+        self.usernames = []
+        self.lock = lock or threading.Lock()
+
+    def __len__(self):
+        return len(self.usernames)
+
+    def add(self, username: str):
+        with self.lock:
+            position = bisect.bisect_left(self.usernames, username)
+            if position == len(self.usernames) or self.usernames[position] != username:
+                self.usernames.insert(position, username)
+
+    def remove(self, username: str):
+        with self.lock:
+            position = bisect.bisect_left(self.usernames, username)
+            if position < len(self.usernames) and self.usernames[position] == username:
+                del self.usernames[position]
+
+    def search(self, pattern, limit: int = None, cursor: str = None) -> tuple:
+        """
+        Finds usernames matching a compiled regex in sorted order
+
+        Parameters
+        ----------
+        pattern: Pattern
+            Compiled regex that usernames are matched against
+
+        limit: int, optional
+            Maximum number of usernames to return, None for no limit
+
+        cursor: str, optional
+            Only usernames after this one are returned, used to continue
+            from the previous page
+
+        Returns
+        -------
+        A tuple of the matching usernames and the cursor for the next page,
+        which is None if there are no more usernames to check
+        """
+        prefix = literal_prefix(pattern.pattern)
+        results = []
+        last = cursor
+
+        while True:
+            # Only copy a chunk at a time so the regex never runs under the lock
+            with self.lock:
+                start = bisect.bisect_left(self.usernames, prefix)
+                if last is not None:
+                    start = max(start, bisect.bisect_right(self.usernames, last))
+                chunk = self.usernames[start:start + SCAN_CHUNK]
+
+            if not chunk:
+                return results, None
+
+            for username in chunk:
+                # Usernames past the prefix range can never match
+                if not username.startswith(prefix):
+                    return results, None
+
+                last = username
+                if pattern.match(username):
+                    results.append(username)
+                    if limit is not None and len(results) >= limit:
+                        return results, username
+
+    def pages(self, pattern, page_size: int, cursor: str = None):
+        """
+        Yields pages of usernames matching a compiled regex, finding each
+        page only when it is requested
+
+        Parameters
+        ----------
+        pattern: Pattern
+            Compiled regex that usernames are matched against
+
+        page_size: int
+            Maximum number of usernames in each page
+
+        cursor: str, optional
+            Only usernames after this one are returned
+
+        Yields
+        ------
+        A tuple of the usernames in the page and the cursor to continue from,
+        which is None once no usernames are left to check. A single empty
+        page is yielded if nothing matches.
+        """
+        first = True
+        while True:
+            usernames, cursor = self.search(pattern, page_size, cursor)
+            # The previous page ended exactly on the last match
+            if not usernames and not first:
+                return
+
+            yield usernames, cursor
+            if cursor is None:
+                return
+            first = False
@@ -0,0 +1,257 @@
+import bisect
+import itertools
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the latency buckets in seconds, from 100us to 1s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# Upper bounds of the buckets for the messages in an offline mailbox
+DEPTH_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# One request in every REQUEST_LOG_EVERY is logged at INFO, 0 only logs
+# requests when DEBUG is enabled
+REQUEST_LOG_EVERY = 0
+_request_count = itertools.count(1)
+
+
+def sample_requests(every: int):
+    """
+    Logs one request in every "every" at INFO, 0 only logs them at DEBUG
+    """
+    global REQUEST_LOG_EVERY
+    REQUEST_LOG_EVERY = every
+
+
+def log_request(addr, op_code: int, contents):
+    """
+    Logs a request received from a client if it is sampled, instead of
+    printing every request on the hot path
+    """
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug(f"<{addr[0]}> {op_code}|{contents}")
+    elif REQUEST_LOG_EVERY and next(_request_count) % REQUEST_LOG_EVERY == 0:
+        logging.info(f"<{addr[0]}> {op_code}|{contents}")
+
+
+class Histogram:
+    """
+    A class used to count observations in cumulative buckets
+    ...
+
+    Attributes
+    ----------
+    bounds : tuple
+        upper bound of each bucket, observations above the last one are
+        only counted in the total
+
+    counts : list[int]
+        observations falling in each bucket, and above the last one
+
+    sum : float
+        sum of every observation
+
+    count : int
+        number of observations
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other: 'Histogram'):
+        """
+        Adds the observations of another histogram with the same bounds
+        """
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def lines(self, name: str, labels: str = "") -> list:
+        """
+        Gets the histogram in the Prometheus text format, labels being the
+        "key="value"" pairs shared by every line
+        """
+        separator = "," if labels else ""
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{{labels}{separator}le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}' if labels else f'{name}_sum {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}' if labels else f'{name}_count {self.count}')
+        return lines
+
+
+class ThreadMetrics:
+    """
+    A class used to hold the metrics recorded by one thread
+    ...
+
+    Attributes
+    ----------
+    requests : dict
+        [count, errors, latency Histogram] of each operation
+
+    lock_wait : Histogram
+        seconds spent waiting for contended account directory stripes
+
+    mailbox_depth : Histogram
+        messages in an offline mailbox after each message queued to it
+    """
+
+    __slots__ = ('requests', 'lock_wait', 'mailbox_depth')
+
+    def __init__(self):
+        self.requests = {}
+        self.lock_wait = Histogram()
+        self.mailbox_depth = Histogram(DEPTH_BUCKETS)
+
+
+class Metrics:
+    """
+    A class used to collect the counters and histograms of a chat server
+    ...
+
+    Operations are wire op codes or grpc method names. Each thread records
+    into its own ThreadMetrics, so observing never takes a lock shared by
+    the threads serving requests, and the tables are merged when read.
+    Tables are keyed by thread id like those of LockProfiler, so they never
+    outnumber the threads alive at once.
+
+    Attributes
+    ----------
+    tables : dict
+        ThreadMetrics of each thread by thread id
+
+    requests : dict
+        [count, errors, latency Histogram] of each operation, merged over
+        every thread
+
+    lock_wait : Histogram
+        seconds spent waiting for an account directory stripe that another
+        thread held, merged over every thread. Uncontended acquisitions are
+        not observed
+
+    mailbox_depth : Histogram
+        messages in an offline mailbox after each message queued to it,
+        merged over every thread
+
+    Methods
+    -------
+    observe(operation, seconds, failed=False)
+        Counts a request and its latency
+
+    render()
+        Gets every metric in the Prometheus text format
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.local = threading.local()
+
+    def table(self) -> ThreadMetrics:
+        try:
+            return self.local.table
+        except AttributeError:
+            table = self.local.table = self.tables.setdefault(threading.get_ident(), ThreadMetrics())
+            return table
+
+    def observe(self, operation, seconds: float, failed: bool = False):
+        requests = self.table().requests
+        stats = requests.get(operation)
+        if stats is None:
+            stats = requests[operation] = [0, 0, Histogram()]
+        stats[0] += 1
+        stats[1] += failed
+        stats[2].observe(seconds)
+
+    def observe_lock_wait(self, seconds: float):
+        self.table().lock_wait.observe(seconds)
+
+    def observe_mailbox_depth(self, depth: int):
+        self.table().mailbox_depth.observe(depth)
+
+    @property
+    def requests(self) -> dict:
+        merged = {}
+        # Other threads keep recording, copying each table is atomic
+        for table in list(self.tables.values()):
+            for operation, (count, errors, latency) in list(table.requests.items()):
+                total = merged.setdefault(operation, [0, 0, Histogram()])
+                total[0] += count
+                total[1] += errors
+                total[2].merge(latency)
+        return merged
+
+    @property
+    def lock_wait(self) -> Histogram:
+        merged = Histogram()
+        for table in list(self.tables.values()):
+            merged.merge(table.lock_wait)
+        return merged
+
+    @property
+    def mailbox_depth(self) -> Histogram:
+        merged = Histogram(DEPTH_BUCKETS)
+        for table in list(self.tables.values()):
+            merged.merge(table.mailbox_depth)
+        return merged
+
+    def render(self) -> str:
+        operations = sorted(self.requests.items(), key=lambda item: str(item[0]))
+        lines = ['# TYPE chat_requests_total counter']
+        lines += [f'chat_requests_total{{op="{op}"}} {count}' for op, (count, _, _) in operations]
+        lines.append('# TYPE chat_request_errors_total counter')
+        lines += [f'chat_request_errors_total{{op="{op}"}} {errors}' for op, (_, errors, _) in operations]
+        lines.append('# TYPE chat_request_seconds histogram')
+        for op, (_, _, latency) in operations:
+            lines += latency.lines('chat_request_seconds', f'op="{op}"')
+        lines.append('# TYPE chat_lock_wait_seconds histogram')
+        lines += self.lock_wait.lines('chat_lock_wait_seconds')
+        lines.append('# TYPE chat_mailbox_depth histogram')
+        lines += self.mailbox_depth.lines('chat_mailbox_depth')
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line each
+        pass
+
+
+def serve_metrics(metrics: Metrics, host: str, port: int) -> ThreadingHTTPServer:
+    """
+    Serves metrics in the Prometheus text format over HTTP from a background
+    thread, until the returned server is shut down
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,218 @@
+import struct
+import tempfile
+from collections import deque
+from itertools import islice
+
+from wire.wire_protocol import HEADER_FORMAT, HEADER_SIZE, pack_packet
+
+# What happens to a message sent to a full mailbox
+DROP_OLDEST = "drop-oldest"
+REJECT = "reject"
+SPILL = "spill"
+OVERFLOW_POLICIES = (DROP_OLDEST, REJECT, SPILL)
+
+
+class OfflineQueue:
+    """
+    A class used to hold the messages queued for an offline user
+    ...
+
+    At most max_messages messages are kept in memory. Once the queue is
+    full a new message either pushes out the oldest one, is rejected, or is
+    spilled to an anonymous file on disk that is read back on delivery.
+    The queue is not thread safe, callers hold the lock guarding the user's
+    mailbox.
+
+    Every message has an offset that counts up from 0 for the first message
+    ever queued. Messages are delivered in batches with peek() and stay in
+    the queue until they are acknowledged with ack(), so a delivery cut off
+    by a disconnect can be resumed from any offset without losing messages.
+
+    Attributes
+    ----------
+    messages : deque
+        messages kept in memory, oldest first
+
+    max_messages : int
+        messages kept in memory before the overflow policy applies, None for
+        no limit
+
+    overflow : str
+        one of OVERFLOW_POLICIES
+
+    spilled : int
+        number of messages in the spill file that are still queued
+
+    first_offset : int
+        offset of the oldest queued message
+
+    sent_offset : int
+        offset of the first message not sent yet in the current delivery
+
+    Methods
+    -------
+    append(message)
+        Queues a message, returning False if it was rejected
+
+    peek(offset, limit)
+        Gets up to limit queued messages starting at an offset
+
+    ack(offset)
+        Removes every message before an offset
+
+    take()
+        Removes and returns every queued message in order
+
+    clear()
+        Removes every queued message
+    """
+
+    __slots__ = ('messages', 'max_messages', 'overflow', 'spill_dir', 'encode', 'decode',
+                 'spill_file', 'spill_position', 'spilled', 'first_offset', 'sent_offset')
+
+    def __init__(self, max_messages: int = None, overflow: str = REJECT, spill_dir: str = None,
+                 encode=None, decode=None):
+        """
+        Parameters
+        ----------
+        spill_dir: str, optional
+            Folder to create the spill file in, the system's temporary
+            folder if None
+
+        encode: callable, optional
+            Converts a message to the str written to the spill file
+
+        decode: callable, optional
+            Converts a str read from the spill file back to a message
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'{overflow} is not one of {OVERFLOW_POLICIES}')
+
+        # A bounded deque drops the oldest message by itself
+        maxlen = max_messages if overflow == DROP_OLDEST else None
+        self.messages = deque(maxlen=maxlen)
+        self.max_messages = max_messages
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.encode = encode or str
+        self.decode = decode or str
+        self.spill_file = None
+        self.spill_position = 0
+        self.spilled = 0
+        self.first_offset = 0
+        self.sent_offset = 0
+
+    def __len__(self):
+        return len(self.messages) + self.spilled
+
+    def __iter__(self):
+        yield from self.messages
+        yield from self.read_spilled()
+
+    @property
+    def end_offset(self) -> int:
+        return self.first_offset + len(self)
+
+    def append(self, message) -> bool:
+        is_full = self.max_messages is not None and len(self.messages) >= self.max_messages
+
+        # Once anything is spilled, later messages follow it to keep the order
+        if self.spilled or (is_full and self.overflow == SPILL):
+            if self.spill_file is None:
+                self.spill_file = tempfile.TemporaryFile(dir=self.spill_dir)
+            self.spill_file.write(pack_packet(0, self.encode(message)))
+            self.spilled += 1
+            return True
+        elif is_full and self.overflow == REJECT:
+            return False
+        elif is_full:
+            # The deque is about to drop its oldest message
+            self.first_offset += 1
+            self.sent_offset = max(self.sent_offset, self.first_offset)
+
+        self.messages.append(message)
+        return True
+
+    def peek(self, offset: int, limit: int) -> list:
+        """
+        Gets queued messages without removing them, only reading messages
+        that are in memory so a batch never waits on the spill file
+        """
+        start = min(max(offset, self.first_offset), self.end_offset) - self.first_offset
+        return list(islice(self.messages, start, start + limit))
+
+    def ack(self, offset: int) -> int:
+        """
+        Removes every message before an offset, returning how many were removed
+        """
+        count = max(0, min(offset, self.end_offset) - self.first_offset)
+        in_memory = min(count, len(self.messages))
+
+        if in_memory == len(self.messages):
+            self.messages.clear()
+        else:
+            for _ in range(in_memory):
+                self.messages.popleft()
+
+        self.first_offset += count
+        self.sent_offset = max(self.sent_offset, self.first_offset)
+        if count > in_memory:
+            self.skip_spilled(count - in_memory)
+
+        # Bring spilled messages back into memory once it has been emptied
+        if not self.messages and self.spilled:
+            self.messages.extend(self.read_spilled(self.max_messages, remove=True))
+        return count
+
+    def take(self) -> list:
+        messages = list(self)
+        self.ack(self.end_offset)
+        return messages
+
+    def clear(self):
+        self.ack(self.end_offset)
+
+    def read_records(self, limit: int = None):
+        """
+        Yields the end position and data of spilled records, starting at the
+        oldest one that is still queued
+        """
+        self.spill_file.flush()
+        self.spill_file.seek(self.spill_position)
+        count = 0
+        while limit is None or count < limit:
+            header = self.spill_file.read(HEADER_SIZE)
+            if len(header) < HEADER_SIZE:
+                break
+            data_len, _ = struct.unpack(HEADER_FORMAT, header)
+            yield self.spill_file.tell() + data_len, self.spill_file.read(data_len)
+            count += 1
+        self.spill_file.seek(0, 2)
+
+    def read_spilled(self, limit: int = None, remove: bool = False) -> list:
+        if self.spill_file is None:
+            return []
+
+        messages = []
+        position = self.spill_position
+        for position, data in self.read_records(limit):
+            messages.append(self.decode(data.decode('utf-8')))
+
+        if remove:
+            self.spill_position = position
+            self.spilled -= len(messages)
+            self.close_spill_file()
+        return messages
+
+    def skip_spilled(self, count: int):
+        for self.spill_position, _ in self.read_records(count):
+            pass
+        self.spilled -= count
+        self.close_spill_file()
+
+    def close_spill_file(self):
+        # The file is only kept while it holds queued messages
+        if not self.spilled and self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+            self.spill_position = 0
@@ -0,0 +1,86 @@
+import sys
+
+# Compact records of the chat state held by ChatCore:
+# - __slots__ leaves out the per-instance __dict__, so a record only holds
+#   its fields
+# - sender names are interned, so every message from the same sender points
+#   at one string instead of a copy parsed out of each request
+
+
+class Message:
+    """
+    A class used to hold a message queued for an offline user
+    ...
+
+    The recipient is not stored, since the message is always kept in the
+    recipient's queue. A message unpacks like a (sender, text) tuple.
+
+    Attributes
+    ----------
+    sender : str
+        interned username of the sender
+
+    text : str
+        chat message
+    """
+
+    __slots__ = ('sender', 'text')
+
+    def __init__(self, sender: str, text: str):
+        self.sender = sys.intern(sender)
+        self.text = text
+
+    def __iter__(self):
+        yield self.sender
+        yield self.text
+
+    def __eq__(self, other):
+        if not isinstance(other, Message):
+            return NotImplemented
+        return self.sender == other.sender and self.text == other.text
+
+    def __repr__(self):
+        return f'Message({self.sender!r}, {self.text!r})'
+
+
+def encode_message(message: Message) -> str:
+    """
+    Converts a message to the text written to a spill file, usernames cannot
+    contain "|" so the first one ends the sender
+    """
+    return f"{message.sender}|{message.text}"
+
+
+def decode_message(data: str) -> Message:
+    sender, _, text = data.partition("|")
+    return Message(sender, text)
+
+
+class Account:
+    """
+    A class used to hold the state of one account
+    ...
+
+    Attributes
+    ----------
+    username : str
+        interned username of the account
+
+    queue : OfflineQueue
+        messages queued while the user is offline
+
+    lock : Lock()
+        lock guarding the queue
+
+    deleted : bool
+        whether the account was deleted or moved away, set under the lock so
+        that a message is never queued to it afterwards
+    """
+
+    __slots__ = ('username', 'queue', 'lock', 'deleted')
+
+    def __init__(self, username: str, queue, lock=None):
+        self.username = sys.intern(username)
+        self.queue = queue
+        self.lock = lock
+        self.deleted = False
@@ -0,0 +1,96 @@
+import bisect
+import hashlib
+import threading
+
+REPLICAS = 64
+
+
+def ring_hash(key: str) -> int:
+    """
+    Hashes a key onto the ring, the same in every process unlike hash()
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    A class used to place keys on nodes by consistent hashing
+    ...
+
+    Every node is hashed onto the ring at several points, its virtual
+    nodes, and a key belongs to the first point at or after the key's hash.
+    Adding a node only takes over the keys just before its points, so
+    only about 1/N of the keys move when a node joins N - 1 others.
+
+    Attributes
+    ----------
+    replicas : int
+        number of points each node is hashed to
+
+    points : list[int]
+        sorted hashes of every virtual node
+
+    owners : list[str]
+        node owning the point at the same position in points
+
+    Methods
+    -------
+    add(node)
+        Places a node on the ring
+
+    remove(node)
+        Takes a node off the ring
+
+    owner(key)
+        Gets the node a key belongs to
+    """
+
+    def __init__(self, nodes=(), replicas: int = REPLICAS):
+        self.replicas = replicas
+        self.points = []
+        self.owners = []
+        self.lock = threading.Lock()
+        for node in nodes:
+            self.add(node)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node: str):
+        return node in self.owners
+
+    @property
+    def nodes(self) -> list:
+        return sorted(set(self.owners))
+
+    def add(self, node: str):
+        with self.lock:
+            if node in self.owners:
+                return
+            for replica in range(self.replicas):
+                point = ring_hash(f"{node}#{replica}")
+                position = bisect.bisect_left(self.points, point)
+                self.points.insert(position, point)
+                self.owners.insert(position, node)
+
+    def remove(self, node: str):
+        with self.lock:
+            kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != node]
+            self.points = [point for point, _ in kept]
+            self.owners = [owner for _, owner in kept]
+
+    def owner(self, key: str) -> str:
+        """
+        Gets the node a key belongs to
+
+        Raises
+        ------
+        LookupError
+            If the ring has no nodes
+        """
+        with self.lock:
+            if not self.points:
+                raise LookupError('The ring has no nodes.')
+            # Keys past the last point wrap around to the first
+            position = bisect.bisect_left(self.points, ring_hash(key)) % len(self.points)
+            return self.owners[position]
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import socket
 import sys
@@ -5,27 +6,111 @@ from _thread import *
 from concurrent import futures
 
 import grpc
+import grpc_proto.aio_server as aio_server
 import grpc_proto.chat_pb2_grpc as chat_pb2_grpc
 from grpc_proto.server import ChatServer
-from utils import get_server_config_from_file
-from wire.server import client_thread
+from contention import report_on_signal
+from metrics import sample_requests, serve_metrics
+from storage import LogStorage, Storage
+from utils import get_grpc_config_from_file, get_keepalive_config_from_file, get_mailbox_config_from_file, get_metrics_config_from_file, get_server_config_from_file, get_storage_config_from_file, get_write_window_from_file
+from wire.async_server import raise_open_file_limit, serve
+from wire.server import client_thread, coalesce_writes, keep_alive
 from wire.chat_service import Chat
+from wire.cluster import ClusterChat
+from wire.workers import listen_port, start_workers, worker_name
 
 # global variables and configurations
 YAML_CONFIG_PATH = '../config.yaml'
 IP_ADDRESS, PORT = get_server_config_from_file(YAML_CONFIG_PATH)
+MAX_WORKERS, MAX_CONCURRENT_RPCS = get_grpc_config_from_file(YAML_CONFIG_PATH)
+STORAGE_PATH, COMMIT_INTERVAL, DURABLE = get_storage_config_from_file(YAML_CONFIG_PATH)
+MAX_MESSAGES, OVERFLOW, SPILL_DIR = get_mailbox_config_from_file(YAML_CONFIG_PATH)
+METRICS_HOST, METRICS_PORT, LOG_EVERY = get_metrics_config_from_file(YAML_CONFIG_PATH)
+WRITE_WINDOW = get_write_window_from_file(YAML_CONFIG_PATH)
+PING_INTERVAL, IDLE_TIMEOUT = get_keepalive_config_from_file(YAML_CONFIG_PATH)
 logging.basicConfig(format='[%(asctime)-15s]: %(message)s', level=logging.INFO)
+sample_requests(LOG_EVERY)
+coalesce_writes(WRITE_WINDOW)
+keep_alive(PING_INTERVAL, IDLE_TIMEOUT)
+
+
+def get_storage(suffix: str = None):
+    # Persist state to the log if one is configured, nodes of a cluster on
+    # one host each keep their own log
+    if STORAGE_PATH is None:
+        return Storage()
+    path = STORAGE_PATH if suffix is None else f'{STORAGE_PATH}.{suffix}'
+    logging.info(f'Replaying log {path}')
+    return LogStorage(path, COMMIT_INTERVAL, DURABLE)
+
+
+def worker_chat(name: str) -> ClusterChat:
+    # Only the first worker can serve metrics, each worker's log is named
+    # after it so a restart with as many workers replays every shard
+    chat_app = ClusterChat(name, storage=get_storage(name), max_messages=MAX_MESSAGES,
+                           overflow=OVERFLOW, spill_dir=SPILL_DIR)
+    if name == worker_name(0):
+        start_metrics(chat_app.core.metrics)
+    return chat_app
+
+
+def start_metrics(metrics):
+    # Serve metrics if an endpoint is configured, several servers on one
+    # host cannot share it
+    if METRICS_PORT is None:
+        return
+    try:
+        serve_metrics(metrics, METRICS_HOST, METRICS_PORT)
+        logging.info(f'Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics')
+    except OSError as e:
+        logging.warning(f'Could not serve metrics: {e}')
 
 
 def main():
     # Check if enough arguments are passed
-    if len(sys.argv) != 2:
+    workers = 1
+    if len(sys.argv) >= 2 and sys.argv[1] == 'cluster':
+        # A cluster node needs its port and peer port, and optionally a seed
+        if len(sys.argv) not in (4, 5) or not (sys.argv[2].isdecimal() and sys.argv[3].isdecimal()):
+            print('Error: Incorrect Usage\n\
+              Correct usage: server.py cluster [port] [peer port] [seed node]')
+            sys.exit()
+    elif len(sys.argv) == 4 and sys.argv[2] == '--workers' and sys.argv[3].isdigit():
+        workers = int(sys.argv[3])
+    elif len(sys.argv) != 2:
         print('Error: Incorrect Usage\n\
-              Correct usage: server.py [implementation]')
+              Correct usage: server.py [implementation] [--workers N]\n\
+                             server.py cluster [port] [peer port] [seed node]')
+        sys.exit()
+    if workers > 1 and sys.argv[1] != 'wire':
+        print('Error: --workers is only supported by the "wire" implementation')
         sys.exit()
 
+    # Log where the chat locks are contended when sent SIGUSR1
+    report_on_signal()
+
+    # Wire protocol implementation with several processes accepting clients
+    if sys.argv[1] == 'wire' and workers > 1:
+        raise_open_file_limit()
+
+        # Workers are forked before any state exists, each one owns a shard
+        # of the accounts and keeps its own log
+        logging.info(f'Starting Wire Protocol Server with {workers} workers')
+        processes = start_workers(IP_ADDRESS, PORT, workers, worker_chat)
+
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            logging.info('Stopping Server.')
+
+        # Workers get the interrupt too and close their logs, any left are
+        # stopped
+        for process in processes:
+            process.join(5)
+            process.terminate()
     # Wire protocol implementation of the client
-    if sys.argv[1] == 'wire':
+    elif sys.argv[1] == 'wire':
         # Setting up the server
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -34,7 +119,9 @@ def main():
 
         # Create a Chat object to handle all the chat logic
         logging.info('Starting Wire Protocol Server')
-        chat_app = Chat()
+        chat_app = Chat(storage=get_storage(), max_messages=MAX_MESSAGES,
+                        overflow=OVERFLOW, spill_dir=SPILL_DIR)
+        start_metrics(chat_app.core.metrics)
 
         while True:
             try:
@@ -53,13 +140,57 @@ def main():
         # Close the server socket
         conn.close()
         server.close()
+        chat_app.core.storage.close()
+    # One node of a sharded wire protocol cluster
+    elif sys.argv[1] == 'cluster':
+        raise_open_file_limit()
+        port, peer_port = int(sys.argv[2]), int(sys.argv[3])
+        seed = sys.argv[4] if len(sys.argv) == 5 else None
+
+        listener = listen_port(IP_ADDRESS, port)
+        peer_listener = listen_port(IP_ADDRESS, peer_port)
+
+        # Nodes are named by the address other nodes reach them on
+        name = f'{IP_ADDRESS}:{peer_port}'
+        logging.info(f'Starting Cluster Node {name}')
+        chat_app = ClusterChat(name, storage=get_storage(str(peer_port)), max_messages=MAX_MESSAGES,
+                               overflow=OVERFLOW, spill_dir=SPILL_DIR)
+        start_metrics(chat_app.core.metrics)
+        chat_app.start(peer_listener, seed)
+
+        try:
+            chat_app.serve_forever(listener)
+        except KeyboardInterrupt:
+            logging.info('Stopping Server.')
+
+        listener.close()
+        peer_listener.close()
+        chat_app.shard.storage.close()
+    # asyncio implementation of the wire protocol server
+    elif sys.argv[1] == 'wire-async':
+        raise_open_file_limit()
+
+        # Create a Chat object to handle all the chat logic
+        logging.info('Starting Async Wire Protocol Server')
+        chat_app = Chat(storage=get_storage(), max_messages=MAX_MESSAGES,
+                        overflow=OVERFLOW, spill_dir=SPILL_DIR)
+        start_metrics(chat_app.core.metrics)
+
+        try:
+            asyncio.run(serve(chat_app, IP_ADDRESS, PORT))
+        except KeyboardInterrupt:
+            logging.info('Stopping Server.')
+        chat_app.core.storage.close()
     # grpc implementation of the client
     elif sys.argv[1] == 'grpc':
         # Start a ChatServer Servicer
-        service = ChatServer()
+        service = ChatServer(storage=get_storage(), max_messages=MAX_MESSAGES,
+                             overflow=OVERFLOW, spill_dir=SPILL_DIR)
+        start_metrics(service.core.metrics)
 
         # Setup the grpc server
-        server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+        server = grpc.server(futures.ThreadPoolExecutor(max_workers=MAX_WORKERS),
+                             maximum_concurrent_rpcs=MAX_CONCURRENT_RPCS)
         chat_pb2_grpc.add_ChatServerServicer_to_server(service, server)
 
         logging.info('Starting GRPC Server')
@@ -73,9 +204,24 @@ def main():
             logging.info('Stopping Server')
             # Set the service to not connected so that each thread is ended
             service.is_connected = False
+        service.core.storage.close()
+    # grpc.aio implementation of the server
+    elif sys.argv[1] == 'grpc-async':
+        # Start an AsyncChatServer Servicer
+        service = aio_server.AsyncChatServer(storage=get_storage(), max_messages=MAX_MESSAGES,
+                                             overflow=OVERFLOW, spill_dir=SPILL_DIR)
+        start_metrics(service.core.metrics)
+
+        logging.info('Starting Async GRPC Server')
+        try:
+            asyncio.run(aio_server.serve(
+                service, f'{IP_ADDRESS}:{PORT}', MAX_CONCURRENT_RPCS))
+        except KeyboardInterrupt:
+            logging.info('Stopping Server')
+        service.core.storage.close()
     else:
         print('Error: Incorrect Usage\n\
-              Correct usage: Implementation must be either "wire" or "grpc"')
+              Correct usage: Implementation must be one of "wire", "wire-async", "cluster", "grpc" or "grpc-async"')
     
     sys.exit()
 
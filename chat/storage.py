@@ -0,0 +1,241 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from wire.wire_protocol import HEADER_FORMAT, HEADER_SIZE, pack_packet
+
+# Log record format:
+# - each record is a wire protocol packet
+# - the operation code is the kind of record
+# - the data is the record's fields joined by "|", usernames cannot contain
+#   "|" so only the last field (the message) may contain one
+
+CREATE_ACCOUNT = 1
+DELETE_ACCOUNT = 2
+QUEUE_MESSAGE = 3
+# Only written by older versions, which cleared a queue once delivered
+CLEAR_QUEUE = 4
+ACK_MESSAGES = 5
+
+RECORD_FIELDS = {CREATE_ACCOUNT: 1, DELETE_ACCOUNT: 1,
+                 QUEUE_MESSAGE: 3, CLEAR_QUEUE: 1, ACK_MESSAGES: 2}
+
+
+class Storage:
+    """
+    A class used to persist chat state, this base class keeps nothing so all
+    state only lives in memory
+    ...
+
+    Methods
+    -------
+    create_account(username)
+        Records that an account was created
+
+    delete_account(username)
+        Records that an account was deleted
+
+    queue_message(recip_username, username, message)
+        Records that a message was queued for an offline user
+
+    ack_messages(username, count)
+        Records that a user acknowledged their oldest queued messages
+
+    replay()
+        Yields every stored record as (operation, fields)
+
+    close()
+        Releases the storage
+    """
+
+    def create_account(self, username: str):
+        pass
+
+    def delete_account(self, username: str):
+        pass
+
+    def queue_message(self, recip_username: str, username: str, message: str):
+        pass
+
+    def ack_messages(self, username: str, count: int):
+        pass
+
+    def replay(self):
+        return iter(())
+
+    def close(self):
+        pass
+
+
+class LogStorage(Storage):
+    """
+    A class used to persist chat state in an append-only log file
+    ...
+
+    Records are packed with the wire protocol framing and handed to a
+    committer thread, which writes everything appended since its last pass
+    and fsyncs it once (group commit). If a write or fsync fails, such as
+    on a full disk, the storage is marked failed: every waiting and later
+    append raises OSError instead of blocking on a committer that is gone.
+
+    Attributes
+    ----------
+    path : str
+        path of the log file
+
+    commit_interval : float
+        seconds the committer waits to gather records before each fsync
+
+    durable : bool
+        whether appending blocks until the record has been fsynced
+
+    failed : OSError
+        error that stopped the committer, or None
+
+    condition: Condition()
+        Condition variable guarding the pending records and commit progress
+    """
+
+    def __init__(self, path: str, commit_interval: float = 0.005, durable: bool = False):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.durable = durable
+
+        self.condition = threading.Condition()
+        self.pending = []
+        self.appended = 0
+        self.committed = 0
+        self.closed = False
+        self.failed = None
+
+        self.truncate_partial_record()
+        self.file = open(path, 'ab')
+        self.committer = threading.Thread(target=self.commit_loop, daemon=True)
+        self.committer.start()
+
+    def create_account(self, username: str):
+        self.append(CREATE_ACCOUNT, username)
+
+    def delete_account(self, username: str):
+        self.append(DELETE_ACCOUNT, username)
+
+    def queue_message(self, recip_username: str, username: str, message: str):
+        self.append(QUEUE_MESSAGE, recip_username, username, message)
+
+    def ack_messages(self, username: str, count: int):
+        self.append(ACK_MESSAGES, username, str(count))
+
+    def append(self, operation: int, *fields: str):
+        record = pack_packet(operation, "|".join(fields))
+
+        with self.condition:
+            self.check_failed()
+            self.pending.append(record)
+            self.appended += 1
+            sequence = self.appended
+            self.condition.notify_all()
+
+            if self.durable:
+                self.wait_committed(sequence)
+
+    def flush(self):
+        """
+        Blocks until every record appended so far has been fsynced
+        """
+        with self.condition:
+            self.wait_committed(self.appended)
+
+    def wait_committed(self, sequence: int):
+        # The caller holds the condition
+        while self.committed < sequence and not self.closed and self.failed is None:
+            self.condition.wait()
+        if self.committed < sequence:
+            self.check_failed()
+
+    def check_failed(self):
+        if self.failed is not None:
+            raise OSError(f'Log {self.path} can no longer be written.') from self.failed
+
+    def commit_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending and self.closed:
+                    return
+
+            # Let more records arrive so that they share a single fsync
+            if self.commit_interval:
+                time.sleep(self.commit_interval)
+
+            with self.condition:
+                records, self.pending = self.pending, []
+                sequence = self.appended
+
+            try:
+                self.file.write(b"".join(records))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            except OSError as e:
+                logging.exception(f'Could not write log {self.path}')
+                # Wake every waiting append so that it fails
+                with self.condition:
+                    self.failed = e
+                    self.condition.notify_all()
+                return
+
+            with self.condition:
+                self.committed = sequence
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.committer.join()
+        try:
+            self.file.close()
+        except OSError:
+            # The unwritten records already failed
+            pass
+
+    def truncate_partial_record(self):
+        """
+        Cuts off a record left incomplete by a crash in the middle of a write
+        """
+        if not os.path.exists(self.path):
+            return
+
+        end = 0
+        for end, _ in self.scan():
+            pass
+        if end != os.path.getsize(self.path):
+            os.truncate(self.path, end)
+
+    def scan(self):
+        """
+        Yields the end offset and the record of every complete record,
+        reading the file through mmap
+        """
+        if os.path.getsize(self.path) == 0:
+            return
+
+        with open(self.path, 'rb') as log_file, \
+                mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log:
+            offset = 0
+            size = len(log)
+            while offset + HEADER_SIZE <= size:
+                data_len, operation = struct.unpack_from(HEADER_FORMAT, log, offset)
+                end = offset + HEADER_SIZE + data_len
+                if end > size:
+                    return
+                yield end, (operation, log[offset + HEADER_SIZE:end])
+                offset = end
+
+    def replay(self):
+        for _, (operation, data) in self.scan():
+            fields = data.decode('utf-8').split("|", RECORD_FIELDS[operation] - 1)
+            yield operation, fields
@@ -4,7 +4,7 @@
 print("****************************************")
 print("***** Testing the wire protocol... *****")
 print("****************************************")
-from wire.wire_protocol import pack_packet, unpack_packet
+from wire.wire_protocol import FIELDS, HELLO, PARTIAL, PUSH, REQUEST, RESPONSE, STATUS_OK, PacketDecoder, pack_fields, pack_fields_request, pack_frame, pack_packet, pack_request, parse_send, send_packets, unpack_fields, unpack_packet
 import time
 
 operation = 1
@@ -15,6 +15,78 @@ unpacked_operation, unpacked_data = unpack_packet(packet)
 assert operation == unpacked_operation
 assert data == unpacked_data
 
+# Test decoding packets coalesced into a single read
+decoder = PacketDecoder()
+stream = pack_packet(1, "first") + pack_packet(5, "user2|second") + pack_packet(3, "")
+assert decoder.feed(stream) == [(1, "first"), (5, "user2|second"), (3, "")]
+assert decoder.buffer == bytearray()
+
+# Test decoding a packet split across several reads
+packet = pack_packet(5, "user2|Hello, World!")
+assert decoder.feed(packet[:3]) == []
+assert decoder.feed(packet[3:10]) == []
+assert decoder.feed(packet[10:] + packet[:7]) == [(5, "user2|Hello, World!")]
+assert decoder.feed(packet[7:]) == [(5, "user2|Hello, World!")]
+
+# Test decoding multi-byte characters split mid-character
+packet = pack_packet(1, "héllo wörld")
+assert decoder.feed(packet[:7]) == []
+assert decoder.feed(packet[7:]) == [(1, "héllo wörld")]
+
+# Test switching to version 2 frames right after a HELLO packet
+decoder = PacketDecoder()
+stream = pack_packet(1, "greeting") + pack_packet(HELLO, "2") + pack_request(5, "user2|hi", 7)
+assert decoder.feed(stream[:-3]) == [(1, "greeting"), (HELLO, "2")]
+assert decoder.version == 2
+assert decoder.feed(stream[-3:]) == [(5, "user2|hi", REQUEST, 7, STATUS_OK)]
+
+# Test packing reply fields compactly and decoding them from frames
+fields = ("héllo", -1, None, ["user1", ["user2", 0]], [])
+assert unpack_fields(pack_fields(fields)) == fields
+assert len(pack_fields(("user2",))) == 10
+assert decoder.feed(pack_frame(5, pack_fields(fields), PUSH, 8, 10)) == [(5, fields, PUSH, 8, 10)]
+try:
+    unpack_fields(pack_fields(fields)[:-1])
+    assert False
+except ValueError:
+    pass
+
+# Test that a send's recipient and message can be packed as fields
+assert decoder.feed(pack_fields_request(5, ["user2", "a|b"], 9)) == [(5, ("user2", "a|b"), FIELDS, 9, STATUS_OK)]
+
+# Test splitting the legacy send text at the first pipe in linear time
+assert parse_send("user2|Hello, World!") == ("user2", "Hello, World!")
+assert parse_send("user2|a|b") == ("user2", "a|b")
+assert parse_send("user2|") is None and parse_send("|hi") is None
+assert parse_send("user 2|hi") is None and parse_send("user2") is None
+start = time.time()
+assert parse_send("user2|" + "a " * 100000 + "\t") == ("user2", "a " * 100000 + "\t")
+assert parse_send("user2" * 100000) is None
+assert time.time() - start < 1
+
+# Test that asking for an unknown version falls back to what is supported
+decoder = PacketDecoder()
+decoder.feed(pack_packet(HELLO, "9"))
+assert decoder.version == 2
+decoder = PacketDecoder()
+decoder.feed(pack_packet(HELLO, "v2"))
+assert decoder.version == 1
+decoder = PacketDecoder()
+decoder.feed(pack_packet(HELLO, "²"))
+assert decoder.version == 1
+
+# Test writing many packets with one scatter-gather write
+import socket
+sender, receiver = socket.socketpair()
+packets = [pack_packet(5, f"user2|message {i}") for i in range(2000)]
+send_packets(sender, packets)
+sender.close()
+received = b""
+while len(received) < sum(map(len, packets)):
+    received += receiver.recv(65536)
+assert received == b"".join(packets)
+receiver.close()
+
 print("*****************************************")
 print("***** Done testing wire protocol... *****")
 print("*****************************************")
@@ -27,6 +99,17 @@ print("*************************************************")
 print("***** Testing the wire protocol chat app... *****")
 print("*************************************************")
 from wire.chat_service import Chat, User
+from wire.replies import *
+
+
+def text(responses):
+    return [(conn, render(reply)) for conn, reply in responses]
+
+
+def queued(chat_app):
+    return {username: [tuple(message) for message in account.queue]
+            for username, account in chat_app.core.accounts.items()}
+
 
 chat_app = Chat()
 
@@ -39,81 +122,1127 @@ user1.set_name("user1")
 assert user1.get_name() == "user1"
 
 # Listing the accounts in the chat app
-assert chat_app.list_accounts(user1) == [(None, '<server> List of accounts: []')]
-assert chat_app.online_users == {}
-assert chat_app.accounts == {}
+assert text(chat_app.list_accounts(user1)) == [(None, '<server> List of accounts: []')]
+assert chat_app.core.online_users == {}
+assert queued(chat_app) == {}
 
 # Adding an account to the chat app
-assert chat_app.create_account(user1, "user1") == [(None, '<server> Account created with username "user1".')]
-assert chat_app.online_users == {"user1": None}
-assert chat_app.accounts == {"user1": []}
+assert text(chat_app.create_account(user1, "user1")) == [(None, '<server> Account created with username "user1".')]
+assert chat_app.core.online_users == {"user1": None}
+assert queued(chat_app) == {"user1": []}
 
 user2 = User(None)
-assert chat_app.create_account(user2, "user2") == [(None, '<server> Account created with username "user2".')]
-assert chat_app.online_users == {"user1": None, "user2": None}
-assert chat_app.accounts == {"user1": [], "user2": []}
+assert text(chat_app.create_account(user2, "user2")) == [(None, '<server> Account created with username "user2".')]
+assert chat_app.core.online_users == {"user1": None, "user2": None}
+assert queued(chat_app) == {"user1": [], "user2": []}
 
 # Listing the accounts in the chat app
-assert chat_app.list_accounts(user1) == [(None, '<server> List of accounts: [\'user1\', \'user2\']')]
+assert text(chat_app.list_accounts(user1)) == [(None, '<server> List of accounts: [\'user1\', \'user2\']')]
 
 # Adding an invalid account name to the chat app
-assert chat_app.create_account(user1, "y|eet") == [(None, "<server> Failed to create account. Username cannot have \" \" or \"|\".")]
-assert chat_app.create_account(user1, "y eet") == [(None, "<server> Failed to create account. Username cannot have \" \" or \"|\".")]
-assert chat_app.create_account(user1, "") == [(None, "<server> Failed to create account. Username cannot be empty.")]
-assert chat_app.online_users == {"user1": None, "user2": None}
-assert chat_app.accounts == {"user1": [], "user2": []}
+assert text(chat_app.create_account(user1, "y|eet")) == [(None, "<server> Failed to create account. Username cannot have \" \" or \"|\".")]
+assert text(chat_app.create_account(user1, "y eet")) == [(None, "<server> Failed to create account. Username cannot have \" \" or \"|\".")]
+assert text(chat_app.create_account(user1, "")) == [(None, "<server> Failed to create account. Username cannot be empty.")]
+assert chat_app.core.online_users == {"user1": None, "user2": None}
+assert queued(chat_app) == {"user1": [], "user2": []}
 
 # Logging in to an invalid account in the chat app
-assert chat_app.login_account(user1, "notanaccount") == [(None, '<server> Failed to login. Account "notanaccount" not found.')]
-assert chat_app.online_users == {"user1": None, "user2": None}
+assert text(chat_app.login_account(user1, "notanaccount")) == [(None, '<server> Failed to login. Account "notanaccount" not found.')]
+assert chat_app.core.online_users == {"user1": None, "user2": None}
 
 # Logging in to an already online account in the chat app
-assert chat_app.login_account(user1, "user1") == [(None, '<server> Failed to login. Account "user1" is already logged in. You cannot log in to the same account from multiple clients.')]
-assert chat_app.online_users == {"user1": None, "user2": None}
+assert text(chat_app.login_account(user1, "user1")) == [(None, '<server> Failed to login. Account "user1" is already logged in. You cannot log in to the same account from multiple clients.')]
+assert chat_app.core.online_users == {"user1": None, "user2": None}
 
 # Logging out of an account in the chat app
-assert chat_app.logout_account(user1) == [(None, '<server> Account "user1" logged out.')]
-assert chat_app.online_users == {"user2": None}
-assert chat_app.accounts == {"user1": [], "user2": []}
+assert text(chat_app.logout_account(user1)) == [(None, '<server> Account "user1" logged out.')]
+assert chat_app.core.online_users == {"user2": None}
+assert queued(chat_app) == {"user1": [], "user2": []}
 
 # Logging in to an account in the chat app
-assert chat_app.login_account(user1, "user1") == [(None, '<server> Account "user1" logged in.')]
-assert chat_app.online_users == {"user1": None, "user2": None}
+assert text(chat_app.login_account(user1, "user1")) == [(None, '<server> Account "user1" logged in.')]
+assert chat_app.core.online_users == {"user1": None, "user2": None}
 
 # Sending a message in the chat app
-assert chat_app.send_message(user1, "user2", "Hello, user2!") == [(None, '<user1> Hello, user2!'), (None, '<server> Message sent to "user2".')]
+assert text(chat_app.send_message(user1, "user2", "Hello, user2!")) == [(None, '<user1> Hello, user2!'), (None, '<server> Message sent to "user2".')]
 
 # Sending a message to an invalid account in the chat app
-assert chat_app.send_message(user1, "user3", "Hello, user3!") == [(None, '<server> Failed to send. Account "user3" does not exist.')]
+assert text(chat_app.send_message(user1, "user3", "Hello, user3!")) == [(None, '<server> Failed to send. Account "user3" does not exist.')]
 
 # Sending a message to an offline account in the chat app
 user3 = User(None)
-assert chat_app.create_account(user3, "user3") == [(None, '<server> Account created with username "user3".')]
-assert chat_app.logout_account(user3) == [(None, '<server> Account "user3" logged out.')]
-assert chat_app.send_message(user1, "user3", "Hello, user3!") == [(None, '<server> Account "user3" not online. Message queued to send')]
-assert chat_app.accounts == {"user1": [], "user2": [], "user3": ['<user1> Hello, user3!']}
+assert text(chat_app.create_account(user3, "user3")) == [(None, '<server> Account created with username "user3".')]
+assert text(chat_app.logout_account(user3)) == [(None, '<server> Account "user3" logged out.')]
+assert text(chat_app.send_message(user1, "user3", "Hello, user3!")) == [(None, '<server> Account "user3" not online. Message queued to send')]
+assert queued(chat_app) == {"user1": [], "user2": [], "user3": [("user1", "Hello, user3!")]}
+
+# Sending a message given as fields instead of text
+assert text(chat_app.handler(user1, 5, ("user2", "Hi|there"))) == [(None, '<user1> Hi|there'), (None, '<server> Message sent to "user2".')]
+assert text(chat_app.handler(user1, 5, ["user2", "Hi"]))[1] == (None, '<server> Message sent to "user2".')
+assert chat_app.handler(user1, 5, ("user2", "")) == [(None, (INVALID_INPUT, "['user2', '']"))]
+assert chat_app.handler(user1, 5, ("user2",)) == [(None, (INVALID_INPUT, "['user2']"))]
+assert chat_app.handler(user1, 1, ("user4",)) == [(None, (INVALID_INPUT, "['user4']"))]
+assert chat_app.handler(user1, 5, "user2 |Hi") == [(None, (INVALID_INPUT, "user2 |Hi"))]
+
+# Test that replies are a reply code and its fields
+assert chat_app.send_message(user1, "user2", "Hi") == [(None, (MESSAGE, "user1", "Hi")), (None, (MESSAGE_SENT, "user2"))]
+assert chat_app.send_message(user1, "user9", "Hi") == [(None, (RECIPIENT_NOT_FOUND, "user9"))]
+assert is_error((RECIPIENT_NOT_FOUND, "user9")) and not is_error((MESSAGE_SENT, "user2"))
+
+# Sending a message to several accounts in the chat app
+assert text(chat_app.send_message_batch(user1, ["user2", "user3", "user4", "user2"], "Hello, all!")) == [
+    (None, '<user1> Hello, all!'),
+    (None, '<server> Message sent to 3 accounts. "user2": sent, "user3": queued, "user4": does not exist.')]
+assert text(chat_app.handler(user1, 7, "user3|")) == [(None, '<server> Invalid input: user3|')]
+assert queued(chat_app) == {"user1": [], "user2": [], "user3": [("user1", "Hello, user3!"), ("user1", "Hello, all!")]}
 
 # Getting all queued messages in the chat app
-assert chat_app.login_account(user3, "user3") == [(None, '<server> Account "user3" logged in.')]
-assert chat_app.online_users == {"user1": None, "user2": None, "user3": None}
-assert chat_app.accounts == {"user1": [], "user2": [], "user3": ['<user1> Hello, user3!']}
-assert chat_app.deliver_undelivered(user3) == [(None, '<user1> Hello, user3!')]
+assert text(chat_app.login_account(user3, "user3")) == [(None, '<server> Account "user3" logged in.')]
+assert chat_app.core.online_users == {"user1": None, "user2": None, "user3": None}
+assert queued(chat_app) == {"user1": [], "user2": [], "user3": [("user1", "Hello, user3!"), ("user1", "Hello, all!")]}
+assert text(chat_app.deliver_undelivered(user3)) == [
+    (None, '<user1> Hello, user3!'), (None, '<user1> Hello, all!'), (None, '<server> Delivered 2 messages, next offset 2.')]
 
-# Getting all queued messages in the chat app, except no messages queued
-assert chat_app.deliver_undelivered(user3) == [(None, '<server> No messages queued')]
-assert chat_app.accounts == {"user1": [], "user2": [], "user3": []}
+# Getting all queued messages in the chat app, except no messages queued,
+# which acknowledges the messages already delivered
+assert text(chat_app.deliver_undelivered(user3)) == [(None, '<server> No messages queued')]
+assert queued(chat_app) == {"user1": [], "user2": [], "user3": []}
 
 # Deleting an account in the chat app
-assert chat_app.online_users == {"user1": None, "user2": None, "user3": None}
-assert chat_app.accounts == {"user1": [], "user2": [], "user3": []}
-assert chat_app.delete_account(user1) == [(None, '<server> Account "user1" deleted.')]
-assert chat_app.online_users == {"user2": None, "user3": None}
-assert chat_app.accounts == {"user2": [], "user3": []}
+assert chat_app.core.online_users == {"user1": None, "user2": None, "user3": None}
+assert queued(chat_app) == {"user1": [], "user2": [], "user3": []}
+assert text(chat_app.delete_account(user1)) == [(None, '<server> Account "user1" deleted.')]
+assert chat_app.core.online_users == {"user2": None, "user3": None}
+assert queued(chat_app) == {"user2": [], "user3": []}
+
+# Failing to delete releases the lock, so the username can still be used
+user4 = User(None)
+user4.set_name("user4")
+assert text(chat_app.delete_account(user4)) == [(None, '<server> Failed to delete. You are not logged in, or account "user4" does not exist.')]
+assert text(chat_app.create_account(user4, "user4")) == [(None, '<server> Account created with username "user4".')]
 
 print("******************************************************")
 print("***** Done testing the wire protocol chat app... *****")
 print("******************************************************")
 
+########################################
+# Testing the chat core
+########################################
+
+print("************************************")
+print("***** Testing the chat core... *****")
+print("************************************")
+import threading
+from core import ChatCore
+from records import Message
+
+# Test that the core returns replies and the sessions it hands out
+core = ChatCore()
+assert core.create_account("alice", "alice session") == (ACCOUNT_CREATED, "alice")
+assert core.create_account("bob", "bob session") == (ACCOUNT_CREATED, "bob")
+assert core.create_account("alice", None) == (USERNAME_IN_USE, "alice")
+assert core.route_message("bob", "alice", "hi") == (SENT, "alice session")
+assert core.logout("alice") == ((LOGGED_OUT, "alice"), "alice session")
+assert core.logout("alice") == ((LOGOUT_FAILED, "alice"), None)
+assert core.route_message("bob", "alice", "hi") == (QUEUED, None)
+assert core.route_message("bob", "carol", "hi") == (NOT_FOUND, None)
+
+# Test that logging in to another account logs out of the previous one
+assert core.login("alice", "new session", previous="bob") == (LOGGED_IN, "alice")
+assert core.online_users == {"alice": "new session"}
+messages, next_offset, remaining = core.deliver("alice")
+assert messages == [Message("bob", "hi")] and (next_offset, remaining) == (1, 0)
+assert core.delete_account("alice") == ((ACCOUNT_DELETED, "alice"), "new session")
+assert list(core.accounts) == ["bob"]
+
+# Test that a grpc login uses a new mailbox as its session
+from grpc_proto.server import ChatServer, Mailbox
+import grpc_proto.chat_pb2 as chat_pb2
+service = ChatServer()
+service.CreateAccount(chat_pb2.User(username="alice"), None)
+first = service.core.online_users["alice"]
+service.Logout(chat_pb2.User(username="alice"), None)
+service.Login(chat_pb2.User(username="alice"), None)
+assert isinstance(service.core.online_users["alice"], Mailbox) and service.core.online_users["alice"] is not first
+
+# Test that the wire handler and grpc methods count requests, errors and latency
+from metrics import Histogram, serve_metrics
+from wire.chat_service import Chat, User
+chat_app = Chat()
+user = User("conn")
+chat_app.handler(user, 1, "metrics")
+chat_app.handler(user, 2, "nobody")
+chat_app.handler(user, 3, "")
+count, errors, latency = chat_app.core.metrics.requests[2]
+assert (count, errors, latency.count) == (1, 1, 1) and chat_app.core.metrics.requests[1][:2] == [1, 0]
+assert service.core.metrics.requests["Login"][:2] == [1, 0]
+assert service.core.metrics.requests["CreateAccount"][:2] == [1, 0]
+recipient = User("recipient conn")
+chat_app.handler(recipient, 1, "queue")
+chat_app.handler(recipient, 3, "")
+chat_app.handler(user, 2, "metrics")
+chat_app.handler(user, 5, "queue|one")
+chat_app.handler(user, 5, "queue|two")
+assert chat_app.core.metrics.mailbox_depth.count == 2 and chat_app.core.metrics.mailbox_depth.sum == 3
+
+# Test that each thread records into its own table and reads merge them
+import threading
+from metrics import Metrics
+metrics = Metrics()
+threads = [threading.Thread(target=lambda: [metrics.observe(5, 0.001) for _ in range(100)]) for _ in range(4)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+metrics.observe(5, 0.002, failed=True)
+assert len(metrics.tables) >= 2
+count, errors, latency = metrics.requests[5]
+assert (count, errors, latency.count) == (401, 1, 401) and 'chat_requests_total{op="5"} 401' in metrics.render()
+
+# Test that histograms are rendered with cumulative buckets
+histogram = Histogram((1, 10))
+for value in (0.5, 2, 20):
+    histogram.observe(value)
+assert histogram.lines("depth") == ['depth_bucket{le="1"} 1', 'depth_bucket{le="10"} 2', 'depth_bucket{le="+Inf"} 3',
+                                    'depth_sum 22.5', 'depth_count 3']
+
+# Test that profiled locks record where they waited and how long they were held
+from contention import LockProfiler, ProfiledLock, report_on_signal
+profiler = LockProfiler()
+profiled_lock = ProfiledLock("test", profiler, chat_app.core.metrics)
+with profiled_lock:
+    pass
+assert chat_app.core.metrics.lock_wait.count == 0
+
+
+def wait_for_lock():
+    with profiled_lock:
+        time.sleep(0.01)
+
+
+assert profiled_lock.acquire()
+waiter = threading.Thread(target=wait_for_lock)
+waiter.start()
+time.sleep(0.05)
+profiled_lock.release()
+waiter.join()
+assert not profiled_lock.locked()
+assert chat_app.core.metrics.lock_wait.count == 1 and chat_app.core.metrics.lock_wait.sum >= 0.04
+stats = {(code.co_name, line): values for (name, code, line), values in profiler.snapshot().items()}
+assert [values[:2] for (function, _), values in sorted(stats.items())] == [[1, 0], [1, 0], [1, 1]]
+waited = next(values for (function, _), values in stats.items() if function == "wait_for_lock")
+assert waited[2] >= 0.04 and waited[4] >= 0.01
+report = profiler.report().splitlines()
+assert len(report) == 5 and report[2].startswith("test") and report[2].endswith("(wait_for_lock)")
+
+# Test that the core's locks are profiled by default, and the report is logged on a signal
+import logging
+import os
+import signal
+from contention import PROFILER
+assert any(name == "stripe" for name, *_ in PROFILER.snapshot())
+if report_on_signal(profiler):
+    logged = []
+    handler = logging.Handler()
+    handler.emit = lambda record: logged.append(record.getMessage())
+    logging.root.addHandler(handler)
+    logging.root.setLevel(logging.INFO)
+    os.kill(os.getpid(), signal.SIGUSR1)
+    time.sleep(0.01)
+    logging.root.removeHandler(handler)
+    logging.root.setLevel(logging.WARNING)
+    signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+    assert logged == ["\n" + profiler.report()]
+profiler.reset()
+assert profiler.snapshot() == {}
+
+# Test that the metrics are served in the Prometheus text format
+import urllib.request
+metrics_server = serve_metrics(chat_app.core.metrics, "127.0.0.1", 0)
+body = urllib.request.urlopen("http://127.0.0.1:%d/metrics" % metrics_server.server_address[1]).read().decode()
+assert 'chat_requests_total{op="2"} 2' in body and 'chat_request_errors_total{op="2"} 1' in body
+assert 'chat_request_seconds_count{op="5"} 2' in body and 'chat_lock_wait_seconds_count 1' in body
+metrics_server.shutdown()
+
+print("*****************************************")
+print("***** Done testing the chat core... *****")
+print("*****************************************")
+
+########################################
+# Testing the username index
+########################################
+
+print("******************************************")
+print("***** Testing the username index... *****")
+print("******************************************")
+import re
+from index import UsernameIndex, literal_prefix
+
+# Test finding the literal prefix every match must start with
+assert literal_prefix("user") == "user"
+assert literal_prefix("user1.*") == "user1"
+assert literal_prefix("users*") == "user"
+assert literal_prefix("users+") == "users"
+assert literal_prefix("user[0-9]") == "user"
+assert literal_prefix("a|b") == ""
+assert literal_prefix("(?i)user") == ""
+assert literal_prefix("") == ""
+
+index = UsernameIndex()
+for username in ["bob", "alice", "user10", "user2", "user1", "carol", "user3"]:
+    index.add(username)
+index.remove("carol")
+index.remove("notauser")
+assert index.usernames == ["alice", "bob", "user1", "user10", "user2", "user3"]
+
+# Test matching only within the prefix range
+assert index.search(re.compile("user")) == (["user1", "user10", "user2", "user3"], None)
+assert index.search(re.compile("user1")) == (["user1", "user10"], None)
+assert index.search(re.compile("user[23]$")) == (["user2", "user3"], None)
+assert index.search(re.compile(".*o")) == (["bob"], None)
+
+# Test paging through results with a limit and cursor
+assert index.search(re.compile("user"), limit=3) == (["user1", "user10", "user2"], "user2")
+assert index.search(re.compile("user"), limit=3, cursor="user2") == (["user3"], None)
+assert index.search(re.compile(""), limit=2, cursor="b") == (["bob", "user1"], "user1")
+
+# Test paging through the chat app's accounts
+chat_app = Chat()
+for username in ["user1", "user2", "user3"]:
+    chat_app.create_account(User(None), username)
+assert chat_app.list_accounts(user1, "user", limit=2) == [(None, (ACCOUNTS, ["user1", "user2"], "user2"))]
+assert chat_app.list_accounts(user1, "user", limit=2, cursor="user2") == [(None, (ACCOUNTS, ["user3"], None))]
+assert text(chat_app.list_accounts(user1, "user", limit=2)) == [(None, '<server> List of accounts: [\'user1\', \'user2\'] More accounts after "user2".')]
+
+# Test listing all accounts in chunks of one page per response
+assert list(chat_app.list_accounts_pages(user1, "user", page_size=2)) == [
+    (None, (ACCOUNTS, ["user1", "user2"], None)),
+    (None, (ACCOUNTS, ["user3"], None))]
+assert list(chat_app.list_accounts_pages(user1, "user", page_size=3)) == [
+    (None, (ACCOUNTS, ["user1", "user2", "user3"], None))]
+assert list(chat_app.list_accounts_pages(user1, "nobody")) == [(None, (ACCOUNTS, [], None))]
+assert list(chat_app.list_accounts_pages(user1, "(")) == [(None, (INVALID_REGEX, "("))]
+
+# Test requesting a page with a page size and continuation token
+assert chat_app.handler(user1, 8, "2||user") == [(None, (ACCOUNTS, ["user1", "user2"], "user2"))]
+assert chat_app.handler(user1, 8, "2|user2|user") == [(None, (ACCOUNTS, ["user3"], None))]
+assert chat_app.handler(user1, 8, "0||user") == [(None, (INVALID_INPUT, "0||user"))]
+assert chat_app.handler(user1, 8, "²||user") == [(None, (INVALID_INPUT, "²||user"))]
+
+print("***********************************************")
+print("***** Done testing the username index... *****")
+print("***********************************************")
+
+########################################
+# Testing the offline mailboxes
+########################################
+
+print("*******************************************")
+print("***** Testing the offline mailboxes... *****")
+print("*******************************************")
+from offline import DROP_OLDEST, REJECT, SPILL, OfflineQueue
+from records import Account, Message, decode_message, encode_message
+
+# Test that message records are compact, share sender names and round trip
+# through a spill file
+first, second = Message("".join(["send", "er"]), "hi"), Message("".join(["send", "er"]), "hi | there")
+assert first.sender is second.sender
+assert not hasattr(first, "__dict__") and not hasattr(Account("user", None), "__dict__")
+assert tuple(second) == ("sender", "hi | there") and decode_message(encode_message(second)) == second
+queue = OfflineQueue(1, SPILL, encode=encode_message, decode=decode_message)
+queue.append(first)
+queue.append(second)
+assert list(queue) == [first, second] and list(queue)[1] is not second
+
+# Test each policy for a message sent to a full mailbox
+queue = OfflineQueue(2, DROP_OLDEST)
+assert all(queue.append(message) for message in ["a", "b", "c"])
+assert list(queue) == ["b", "c"]
+
+queue = OfflineQueue(2, REJECT)
+assert [queue.append(message) for message in ["a", "b", "c"]] == [True, True, False]
+assert list(queue) == ["a", "b"]
+
+queue = OfflineQueue(2, SPILL, encode="|".join, decode=lambda data: tuple(data.split("|", 1)))
+for i in range(5):
+    assert queue.append(("user1", f"message | {i}"))
+assert len(queue.messages) == 2 and queue.spilled == 3 and len(queue) == 5
+assert queue.take() == [("user1", f"message | {i}") for i in range(5)]
+assert len(queue) == 0 and queue.spill_file is None
+assert queue.append(("user1", "again")) and list(queue) == [("user1", "again")]
+
+# Test that senders are told when a recipient's mailbox is full
+chat_app = Chat(max_messages=1)
+sender, recipient = User(None), User(None)
+chat_app.create_account(sender, "sender")
+chat_app.create_account(recipient, "recipient")
+chat_app.logout_account(recipient)
+assert chat_app.send_message(sender, "recipient", "first") == [(None, (MESSAGE_QUEUED, "recipient"))]
+assert chat_app.send_message(sender, "recipient", "second") == [(None, (MESSAGE_REJECTED, "recipient"))]
+assert text(chat_app.send_message_batch(sender, ["recipient"], "third")) == [
+    (None, '<server> Message sent to 1 accounts. "recipient": mailbox full.')]
+assert queued(chat_app) == {"sender": [], "recipient": [("sender", "first")]}
+
+# Test that the grpc server reports a full mailbox in its message status
+from grpc_proto.server import ChatServer
+import grpc_proto.chat_pb2 as chat_pb2
+service = ChatServer(max_messages=1)
+service.CreateAccount(chat_pb2.User(username="recipient"), None)
+service.Logout(chat_pb2.User(username="recipient"), None)
+message = chat_pb2.ChatMessage(username="sender", recip_username="recipient", message="hi")
+assert service.SendMessage(message, None).status == 0
+assert service.SendMessage(message, None).status == -2
+assert list(service.SendMessageBatch(chat_pb2.ChatMessageBatch(
+    username="sender", recip_usernames=["recipient"], message="hi"), None).statuses) == [-2]
+
+
+# Test delivering in batches that are acknowledged by offset
+queue = OfflineQueue()
+for i in range(5):
+    queue.append(i)
+assert queue.peek(0, 2) == [0, 1] and queue.peek(3, 10) == [3, 4]
+assert queue.ack(2) == 2 and list(queue) == [2, 3, 4] and queue.first_offset == 2
+assert queue.ack(1) == 0 and queue.peek(0, 1) == [2]
+assert queue.ack(99) == 3 and len(queue) == 0 and queue.end_offset == 5
+
+# Test that acknowledging spilled messages brings the rest back into memory
+queue = OfflineQueue(2, SPILL, decode=int)
+for i in range(7):
+    queue.append(i)
+assert queue.ack(3) == 3
+assert list(queue.messages) == [3, 4] and queue.spilled == 2 and list(queue) == [3, 4, 5, 6]
+assert queue.ack(5) == 2 and list(queue.messages) == [5, 6] and queue.spill_file is None
+
+# Test that offsets keep counting when the oldest messages are dropped
+queue = OfflineQueue(2, DROP_OLDEST)
+for i in range(5):
+    queue.append(i)
+assert queue.first_offset == 3 and queue.peek(0, 5) == [3, 4]
+
+# Test that a delivery cut off by a disconnect is resumed without losing or
+# repeating messages
+chat_app = Chat()
+sender, recipient = User(None), User(None)
+chat_app.create_account(sender, "sender")
+chat_app.create_account(recipient, "recipient")
+chat_app.logout_account(recipient)
+for i in range(5):
+    chat_app.send_message(sender, "recipient", f"message {i}")
+chat_app.login_account(recipient, "recipient")
+assert chat_app.deliver_undelivered(recipient, batch_size=2) == [
+    (None, (MESSAGE, "sender", "message 0")), (None, (MESSAGE, "sender", "message 1")), (None, (DELIVERED, 2, 2, 3))]
+assert text(chat_app.deliver_undelivered(recipient, batch_size=2))[-1] == (
+    None, '<server> Delivered 2 messages, next offset 4. 1 more queued, send "6|" to get them.')
+assert len(chat_app.core.accounts["recipient"].queue) == 3
+
+# The connection is lost before message 3 arrives, so the client resumes
+# from the offset after the last message it received
+chat_app.logout_account(recipient, acknowledge=False)
+chat_app.login_account(recipient, "recipient")
+assert chat_app.handler(recipient, 6, "3") == [
+    (None, (MESSAGE, "sender", "message 3")), (None, (MESSAGE, "sender", "message 4")), (None, (DELIVERED, 2, 5, 0))]
+assert chat_app.handler(recipient, 6, "x") == [(None, (INVALID_INPUT, "x"))]
+assert chat_app.handler(recipient, 6, "²") == [(None, (INVALID_INPUT, "²"))]
+# Offsets past the end of the queue are clamped to it
+assert chat_app.handler(recipient, 6, "9" * 23) == [(None, (NO_MESSAGES,))]
+assert chat_app.core.deliver("recipient", 10 ** 6) == ([], 5, 0)
+assert chat_app.core.accounts["recipient"].queue.peek(10 ** 30, 2) == []
+assert chat_app.handler(recipient, 6) == [(None, (NO_MESSAGES,))]
+assert len(chat_app.core.accounts["recipient"].queue) == 0
+
+# Test that the grpc server delivers queued messages in acknowledged batches
+service = ChatServer()
+service.CreateAccount(chat_pb2.User(username="recipient"), None)
+service.Logout(chat_pb2.User(username="recipient"), None)
+for i in range(150):
+    service.SendMessage(chat_pb2.ChatMessage(username="sender", recip_username="recipient", message=str(i)), None)
+service.Login(chat_pb2.User(username="recipient"), None)
+batch = service.DeliverMessages(chat_pb2.Delivery(username="recipient"), None)
+assert [m.message for m in batch.messages] == [str(i) for i in range(100)]
+assert (batch.next_offset, batch.remaining) == (100, 50)
+batch = service.DeliverMessages(chat_pb2.Delivery(username="recipient", offset=90), None)
+assert batch.messages[0].message == "90" and (batch.next_offset, batch.remaining) == (150, 0)
+assert len(service.core.accounts["recipient"].queue) == 60
+service.Logout(chat_pb2.User(username="recipient"), None)
+assert len(service.core.accounts["recipient"].queue) == 0
+
+# Test that a mailbox size below 1 is rejected in the config
+from utils import get_mailbox_config_from_yaml
+assert get_mailbox_config_from_yaml({"mailbox": {"max_messages": 1, "overflow": "spill"}})[:2] == (1, "spill")
+for max_messages in (0, -1, "10"):
+    try:
+        get_mailbox_config_from_yaml({"mailbox": {"max_messages": max_messages, "overflow": "spill"}})
+        assert False
+    except ValueError:
+        pass
+
+print("************************************************")
+print("***** Done testing the offline mailboxes... *****")
+print("************************************************")
+
+########################################
+# Testing the message log storage
+########################################
+
+print("*********************************************")
+print("***** Testing the message log storage... *****")
+print("*********************************************")
+import os
+import tempfile
+from storage import LogStorage
+
+log_path = os.path.join(tempfile.mkdtemp(), "chat.log")
+
+# Test that accounts and queued messages survive a restart
+chat_app = Chat(storage=LogStorage(log_path))
+user1, user2 = User(None), User(None)
+chat_app.create_account(user1, "user1")
+chat_app.create_account(user2, "user2")
+chat_app.logout_account(user2)
+chat_app.send_message(user1, "user2", "Hello | user2!")
+chat_app.send_message(user1, "user2", "Still there?")
+chat_app.core.storage.close()
+
+chat_app = Chat(storage=LogStorage(log_path))
+assert queued(chat_app) == {"user1": [], "user2": [("user1", "Hello | user2!"), ("user1", "Still there?")]}
+assert chat_app.core.online_users == {}
+
+# Test that acknowledged messages and deleted accounts stay gone
+chat_app.login_account(user2, "user2")
+chat_app.deliver_undelivered(user2)
+chat_app.logout_account(user2)
+chat_app.login_account(user1, "user1")
+chat_app.delete_account(user1)
+chat_app.core.storage.close()
+
+# Test that a record cut off by a crash is dropped
+with open(log_path, "ab") as log_file:
+    log_file.write(pack_packet(1, "user3")[:-2])
+chat_app = Chat(storage=LogStorage(log_path))
+assert queued(chat_app) == {"user2": []}
+chat_app.core.storage.close()
+
+# Test that partly acknowledged deliveries are replayed
+chat_app = Chat(storage=LogStorage(log_path))
+chat_app.login_account(user1, "user2")
+chat_app.logout_account(user1)
+for i in range(3):
+    chat_app.send_message(User(None, "sender"), "user2", f"message {i}")
+chat_app.login_account(user1, "user2")
+chat_app.deliver_undelivered(user1, batch_size=2)
+chat_app.deliver_undelivered(user1, batch_size=2)
+chat_app.logout_account(user1, acknowledge=False)
+chat_app.core.storage.close()
+chat_app = Chat(storage=LogStorage(log_path))
+assert queued(chat_app) == {"user2": [("sender", "message 2")]}
+chat_app.core.storage.close()
+
+# Test that cleared queues in logs written by older versions are replayed
+from storage import CLEAR_QUEUE
+chat_app = Chat(storage=LogStorage(log_path))
+chat_app.core.storage.append(CLEAR_QUEUE, "user2")
+chat_app.core.storage.close()
+chat_app = Chat(storage=LogStorage(log_path))
+assert queued(chat_app) == {"user2": []}
+chat_app.core.storage.close()
+
+# Test that a send racing with deleting its recipient is not queued or
+# logged, and that records of unknown accounts are skipped on replay
+chat_app = Chat(storage=LogStorage(log_path))
+chat_app.create_account(User(None), "user4")
+account = chat_app.core.accounts["user4"]
+chat_app.core.delete_account("user4")
+# The sender looked the account up just before it was deleted
+chat_app.core.accounts["user4"] = account
+assert chat_app.core.route_message("user2", "user4", "Too late") == (NOT_FOUND, None)
+del chat_app.core.accounts["user4"]
+chat_app.core.storage.queue_message("user5", "user2", "Orphan")
+chat_app.core.storage.ack_messages("user5", 1)
+chat_app.core.storage.close()
+chat_app = Chat(storage=LogStorage(log_path))
+assert queued(chat_app) == {"user2": []}
+chat_app.core.storage.close()
+
+# Test that a failed write fails durable appends instead of blocking them
+import errno
+
+
+class FullDisk:
+    def write(self, data):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def close(self):
+        pass
+
+
+storage = LogStorage(os.path.join(os.path.dirname(log_path), "full.log"), durable=True)
+storage.file.close()
+storage.file = FullDisk()
+errors = []
+for _ in range(2):
+    try:
+        storage.create_account("user6")
+    except OSError as e:
+        errors.append(e)
+assert len(errors) == 2 and storage.failed.errno == errno.ENOSPC
+storage.close()
+
+# Test that the grpc server replays the same log
+from grpc_proto.server import ChatServer
+service = ChatServer(storage=LogStorage(log_path))
+assert list(service.core.accounts) == ["user2"]
+service.core.storage.close()
+
+print("**************************************************")
+print("***** Done testing the message log storage... *****")
+print("**************************************************")
+
+########################################
+# Testing the threaded wire server
+########################################
+
+print("***********************************************")
+print("***** Testing the threaded wire server... *****")
+print("***********************************************")
+import socket
+import threading
+from wire.server import client_thread
+
+chat_app = Chat()
+
+
+def connect_thread_client():
+    client_sock, server_sock = socket.socketpair()
+    threading.Thread(target=client_thread, args=(
+        chat_app, server_sock, ("127.0.0.1", 0)), daemon=True).start()
+    return client_sock, PacketDecoder(), []
+
+
+def receive_thread_client(client, count=1):
+    sock, decoder, pending = client
+    while len(pending) < count:
+        pending.extend(decoder.feed(sock.recv(4096)))
+    received = [data for _, data in pending[:count]]
+    del pending[:count]
+    return received
+
+
+client1, client2 = connect_thread_client(), connect_thread_client()
+assert receive_thread_client(client1) == ['<server> Connected to server']
+assert receive_thread_client(client2) == ['<server> Connected to server']
+client1[0].sendall(pack_packet(1, "user1"))
+assert receive_thread_client(client1) == ['<server> Account created with username "user1".']
+client2[0].sendall(pack_packet(1, "user2"))
+assert receive_thread_client(client2) == ['<server> Account created with username "user2".']
+
+# Test that pipelined messages are all delivered in order without waiting
+start = time.time()
+client1[0].sendall(b"".join(pack_packet(5, f"user2|message {i}") for i in range(100)))
+assert receive_thread_client(client2, 100) == [f"<user1> message {i}" for i in range(100)]
+assert receive_thread_client(client1, 100) == ['<server> Message sent to "user2".'] * 100
+assert time.time() - start < 5
+
+# Test negotiating version 2 and pipelining requests matched by request id
+from wire.client import negotiate
+client3 = connect_thread_client()
+assert [data for _, data in negotiate(client3[0], client3[1])] == ['<server> Connected to server']
+assert client3[1].version == 2
+client3[0].sendall(pack_request(1, "user3", 1) +
+                   pack_fields_request(5, ["user1", "Hello from v2"], 2) +
+                   pack_request(0, "user[12]", 3))
+assert receive_thread_client(client1) == ['<user3> Hello from v2']
+received = []
+while len(received) < 3:
+    received.extend(client3[1].feed(client3[0].recv(4096)))
+assert received == [(1, ("user3",), RESPONSE, 1, ACCOUNT_CREATED),
+                    (5, ("user1",), RESPONSE, 2, MESSAGE_SENT),
+                    (0, (["user1", "user2"], None), RESPONSE, 3, ACCOUNTS)]
+
+# Test that a version 1 client gets pushes from a version 2 client as
+# version 1 packets, and the other way around
+client1[0].sendall(pack_packet(5, "user3|Hello from v1"))
+received = []
+while len(received) < 1:
+    received.extend(client3[1].feed(client3[0].recv(4096)))
+assert received == [(5, ("user1", "Hello from v1"), PUSH, 0, MESSAGE)]
+assert receive_thread_client(client1) == ['<server> Message sent to "user3".']
+
+# Test that the replies to a request are partial frames before the response
+client3[0].sendall(pack_request(3, "", 4))
+chat_app.core.accounts["user3"].queue.append(Message("user1", "first"))
+chat_app.core.accounts["user3"].queue.append(Message("user1", "second"))
+client3[0].sendall(pack_request(2, "user3", 5) + pack_request(6, "", 6))
+received = []
+while len(received) < 5:
+    received.extend(client3[1].feed(client3[0].recv(4096)))
+assert [packet[2:4] for packet in received] == [(RESPONSE, 4), (RESPONSE, 5), (PARTIAL, 6), (PARTIAL, 6), (RESPONSE, 6)]
+assert received[-1][1] == (2, 2, 0)
+client3[0].close()
+
+# Test that a handler pass's packets are grouped by recipient, in order
+from wire.server import COALESCE_PACKETS, Connection, coalesce
+assert list(coalesce([("a", b"1"), ("b", b"2"), ("a", b"3")])) == [("a", [b"1", b"3"]), ("b", [b"2"])]
+groups = list(coalesce((("a", bytes([i])) for i in range(COALESCE_PACKETS + 1))))
+assert [len(packets) for _, packets in groups] == [COALESCE_PACKETS, 1]
+
+# Test that packets queued within the write window go out in one write
+class RecordingSocket:
+    def __init__(self):
+        self.options = {}
+        self.writes = []
+
+    def setsockopt(self, level, option, value):
+        self.options[level, option] = value
+
+    def sendmsg(self, buffers):
+        self.writes.append(b"".join(buffers))
+        return len(self.writes[-1])
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+recorder = RecordingSocket()
+connection = Connection(recorder, write_window=0.2)
+assert recorder.options[socket.IPPROTO_TCP, socket.TCP_NODELAY] == 1
+connection.send(b"first")
+time.sleep(0.05)
+connection.send_many([b"second", b"third"])
+connection.close()
+connection.writer.join(5)
+assert recorder.writes == [b"firstsecondthird"]
+
+# Test that accepted TCP connections have Nagle's algorithm turned off
+tcp_listener = socket.create_server(("127.0.0.1", 0))
+tcp_client = socket.create_connection(tcp_listener.getsockname())
+tcp_server, _ = tcp_listener.accept()
+connection = Connection(tcp_server)
+assert tcp_server.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+connection.close()
+tcp_client.close()
+tcp_listener.close()
+
+# Test that silent clients that negotiated version 2 are pinged, and
+# disconnected and logged out unless they answer, while version 1 clients
+# are never pinged
+from wire.server import get_reaper, keep_alive, set_tcp_keepalive
+from wire.wire_protocol import PING
+
+
+def receive_frame(client):
+    sock, decoder, pending = client
+    while not pending:
+        pending.extend(decoder.feed(sock.recv(4096)))
+    return pending.pop(0)
+
+
+keep_alive(0.2, 0.6)
+client4, client5, client6 = connect_thread_client(), connect_thread_client(), connect_thread_client()
+for client, username in ((client4, "user4"), (client5, "user5")):
+    negotiate(client[0], client[1])
+    client[0].sendall(pack_request(1, username, 1))
+    assert receive_frame(client)[3] == 1
+receive_thread_client(client6)
+client6[0].sendall(pack_packet(1, "user6"))
+receive_thread_client(client6)
+for client in (client4, client5):
+    assert receive_frame(client) == (PING, (), PUSH, 0, STATUS_OK)
+# Only client5 answers, a PING request gets no reply
+client5[0].sendall(pack_request(PING, "", 0))
+received = []
+while data := client4[0].recv(4096):
+    received += client4[1].feed(data)
+assert set(received) <= {(PING, (), PUSH, 0, STATUS_OK)}
+assert "user4" not in chat_app.core.online_users
+assert "user5" in chat_app.core.online_users and "user6" in chat_app.core.online_users
+assert get_reaper().reaped == 1
+client6[0].setblocking(False)
+try:
+    client6[0].recv(4096)
+    assert False
+except BlockingIOError:
+    pass
+keep_alive(None, None)
+assert get_reaper() is None
+client4[0].close()
+client5[0].close()
+client6[0].close()
+
+# Test that TCP keepalive is turned on for clients that cannot answer pings
+keepalive_sock = socket.socket()
+set_tcp_keepalive(keepalive_sock, 30, 90)
+assert keepalive_sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+if hasattr(socket, 'TCP_KEEPIDLE'):
+    assert keepalive_sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE) == 30
+    assert keepalive_sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL) == 20
+keepalive_sock.close()
+
+# Test that a client that stops reading is dropped and logged out once its
+# outbound queue is full
+client7_sock, server_sock = socket.socketpair()
+threading.Thread(target=client_thread, args=(chat_app, server_sock, ("127.0.0.1", 0), 4), daemon=True).start()
+client7 = client7_sock, PacketDecoder(), []
+receive_thread_client(client7)
+client7[0].sendall(pack_packet(1, "user7"))
+receive_thread_client(client7)
+filler = "x" * 1000
+for _ in range(1000):
+    if "user7" not in chat_app.core.online_users:
+        break
+    client1[0].sendall(pack_packet(5, f"user7|{filler}"))
+    receive_thread_client(client1)
+deadline = time.time() + 5
+while "user7" in chat_app.core.online_users and time.time() < deadline:
+    time.sleep(0.01)
+assert "user7" not in chat_app.core.online_users
+client7[0].close()
+
+# Test that disconnecting logs the user out
+client2[0].close()
+while "user2" in chat_app.core.online_users:
+    time.sleep(0.01)
+client1[0].close()
+
+print("****************************************************")
+print("***** Done testing the threaded wire server... *****")
+print("****************************************************")
+
+########################################
+# Testing the multi-process wire server
+########################################
+
+print("*****************************************************")
+print("***** Testing the multi-process wire server... *****")
+print("*****************************************************")
+from wire.cluster import ClusterChat
+from wire.workers import listen_peers, listen_port, run_worker, worker_name
+
+# Each worker runs in a thread with its own port, standing in for worker
+# processes that share one port, so clients are known to be on different
+# workers
+peer_listeners, addresses = listen_peers(2)
+assert list(addresses) == ["worker0", "worker1"]
+worker_chats = [ClusterChat(worker_name(i)) for i in range(2)]
+worker_listeners = [listen_port("127.0.0.1", 0) for _ in range(2)]
+for chat, listener, peer_listener in zip(worker_chats, worker_listeners, peer_listeners):
+    threading.Thread(target=run_worker, args=(chat, listener, peer_listener, addresses), daemon=True).start()
+
+
+def connect_worker_client(listener):
+    sock = socket.create_connection(listener.getsockname())
+    client = (sock, PacketDecoder(), [])
+    assert receive_thread_client(client) == ['<server> Connected to server']
+    return client
+
+
+def owner_shard(username):
+    return worker_chats[int(worker_chats[0].ring.owner(username)[-1])].shard
+
+
+client1, client2 = (connect_worker_client(listener) for listener in worker_listeners)
+client1[0].sendall(pack_packet(1, "user1"))
+client2[0].sendall(pack_packet(1, "user2"))
+assert receive_thread_client(client1) == ['<server> Account created with username "user1".']
+assert receive_thread_client(client2) == ['<server> Account created with username "user2".']
+
+# Test that each worker's shard only holds the accounts it owns
+for username in ("user1", "user2"):
+    assert [username in chat.shard.accounts for chat in worker_chats].count(True) == 1
+    assert username in owner_shard(username).accounts
+
+# Test that a message crosses from one worker to the other
+client1[0].sendall(pack_packet(5, "user2|Hello from worker 1"))
+assert receive_thread_client(client2) == ['<user1> Hello from worker 1']
+assert receive_thread_client(client1) == ['<server> Message sent to "user2".']
+
+# Test that a version 2 client gets frames with its request ids and pushes
+client3 = connect_worker_client(worker_listeners[1])
+client3[0].sendall(pack_packet(HELLO, "2") + pack_request(1, "user3", 7))
+while len(client3[2]) < 2:
+    client3[2].extend(client3[1].feed(client3[0].recv(4096)))
+assert client3[2] == [(HELLO, "2"), (1, ("user3",), RESPONSE, 7, ACCOUNT_CREATED)]
+client1[0].sendall(pack_packet(5, "user3|Hello v2"))
+assert receive_thread_client(client1) == ['<server> Message sent to "user3".']
+received = []
+while not received:
+    received.extend(client3[1].feed(client3[0].recv(4096)))
+assert received == [(5, ("user1", "Hello v2"), PUSH, 0, MESSAGE)]
+
+# Test that disconnecting from a worker logs the user out on its owner
+client2[0].close()
+while "user2" in owner_shard("user2").online_users:
+    time.sleep(0.01)
+client1[0].sendall(pack_packet(5, "user2|Are you there?"))
+assert receive_thread_client(client1) == ['<server> Account "user2" not online. Message queued to send']
+client1[0].close()
+client3[0].close()
+for listener in worker_listeners:
+    listener.close()
+
+print("*********************************************************")
+print("***** Done testing the multi-process wire server... *****")
+print("*********************************************************")
+
+########################################
+# Testing the sharded wire cluster
+########################################
+
+print("***********************************************")
+print("***** Testing the sharded wire cluster... *****")
+print("***********************************************")
+from ring import HashRing
+from wire.cluster import ClusterChat
+
+# Test that keys are placed the same way by every ring and that a new node
+# only takes keys over from the others
+ring = HashRing(["a", "b"])
+keys = [f"user{i}" for i in range(1000)]
+placement = {key: ring.owner(key) for key in keys}
+assert placement == {key: HashRing(["b", "a"]).owner(key) for key in keys}
+assert 300 < sum(owner == "a" for owner in placement.values()) < 700
+ring.add("c")
+moved = [key for key in keys if ring.owner(key) != placement[key]]
+assert moved and all(ring.owner(key) == "c" for key in moved)
+assert ring.nodes == ["a", "b", "c"]
+
+
+def start_node(seed=None):
+    listener, peer_listener = listen_port("127.0.0.1", 0), listen_port("127.0.0.1", 0)
+    node = ClusterChat("127.0.0.1:%d" % peer_listener.getsockname()[1])
+    node.start(peer_listener, seed)
+    threading.Thread(target=node.serve_forever, args=(listener,), daemon=True).start()
+    return node, listener
+
+
+node1, listener1 = start_node()
+node2, listener2 = start_node(node1.name)
+assert node1.ring.nodes == node2.ring.nodes == sorted([node1.name, node2.name])
+
+# Pick users owned by each node, and connect to the node that does not own them
+user1 = next(key for key in keys if node1.ring.owner(key) == node1.name)
+user2 = next(key for key in keys if node1.ring.owner(key) == node2.name)
+client1, client2 = connect_worker_client(listener2), connect_worker_client(listener1)
+client1[0].sendall(pack_packet(1, user1))
+client2[0].sendall(pack_packet(1, user2))
+assert receive_thread_client(client1) == [f'<server> Account created with username "{user1}".']
+assert receive_thread_client(client2) == [f'<server> Account created with username "{user2}".']
+assert user1 in node1.shard.accounts and user2 in node2.shard.accounts
+assert user1 not in node2.shard.accounts
+
+# Test that a message reaches a recipient connected to another node
+client1[0].sendall(pack_packet(5, f"{user2}|Hello across nodes"))
+assert receive_thread_client(client2) == [f'<{user1}> Hello across nodes']
+assert receive_thread_client(client1) == [f'<server> Message sent to "{user2}".']
+
+# Test that listing accounts merges every node's accounts in order
+first, second = sorted([user1, user2])
+client1[0].sendall(pack_packet(8, "1||user"))
+assert receive_thread_client(client1) == [f'<server> List of accounts: [\'{first}\'] More accounts after "{first}".']
+client1[0].sendall(pack_packet(8, f"1|{first}|user"))
+assert receive_thread_client(client1) == [f'<server> List of accounts: [\'{second}\'] More accounts after "{second}".']
+client1[0].sendall(pack_packet(0, "user"))
+assert receive_thread_client(client1) == [f'<server> List of accounts: {[first, second]}']
+
+# Queue a message for an offline user, and add offline accounts for the
+# joining node to take over
+client2[0].sendall(pack_packet(3, ""))
+assert receive_thread_client(client2) == [f'<server> Account "{user2}" logged out.']
+client1[0].sendall(pack_packet(5, f"{user2}|Queued before the join"))
+assert receive_thread_client(client1) == [f'<server> Account "{user2}" not online. Message queued to send']
+others = [key for key in keys[:100] if key not in (user1, user2)]
+for username in others:
+    owner = node1 if node1.ring.owner(username) == node1.name else node2
+    owner.shard.import_account(username, [["someone", f"Hello {username}"]])
+
+# Test that a joining node takes over its accounts with their queued messages
+node3, listener3 = start_node(node2.name)
+nodes = (node1, node2, node3)
+assert node1.ring.nodes == node2.ring.nodes == node3.ring.nodes
+for node in nodes:
+    assert all(node.ring.owner(username) == node.name for username in node.shard.accounts)
+assert sorted(username for node in nodes for username in node.shard.accounts) == sorted(others + [user1, user2])
+assert node3.shard.accounts
+
+user3 = next(username for username in others if username in node3.shard.accounts)
+client3 = connect_worker_client(listener1)
+client3[0].sendall(pack_packet(2, user3))
+assert receive_thread_client(client3) == [f'<server> Account "{user3}" logged in.']
+client3[0].sendall(pack_packet(6, ""))
+assert receive_thread_client(client3, 2) == [f'<someone> Hello {user3}', '<server> Delivered 1 messages, next offset 1.']
+owner2 = next(node for node in nodes if user2 in node.shard.accounts)
+client2[0].sendall(pack_packet(2, user2))
+assert receive_thread_client(client2) == [f'<server> Account "{user2}" logged in.']
+client2[0].sendall(pack_packet(6, ""))
+assert receive_thread_client(client2, 2) == [f'<{user1}> Queued before the join', '<server> Delivered 1 messages, next offset 1.']
+
+# Test that an online user moved by the join can still be reached
+client3[0].sendall(pack_packet(5, f"{user1}|Hello after the join"))
+assert receive_thread_client(client1) == [f'<{user3}> Hello after the join']
+assert receive_thread_client(client3) == [f'<server> Message sent to "{user1}".']
+
+# Test that each recipient's replies to a request are sent as one write
+owner3 = next(node for node in nodes if user3 in node.shard.accounts)
+session3 = node1.sessions[max(node1.sessions)]
+writes = []
+send_many = session3.connection.send_many
+session3.connection.send_many = lambda packets: writes.append(len(packets)) or send_many(packets)
+owner3.shard.import_account(user3, [["someone", "first"], ["someone", "second"]])
+client3[0].sendall(pack_packet(6, ""))
+assert receive_thread_client(client3, 3)[:2] == ['<someone> first', '<someone> second']
+assert writes == [3]
+session3.connection.send_many = send_many
+
+# Test that an operation on an account whose node is unavailable, or that
+# is still moving, gets an error reply instead of dropping the client
+account3 = owner3.shard.accounts.pop(user3)
+client3[0].sendall(pack_packet(6, ""))
+assert receive_thread_client(client3) == ['<server> Operation failed. The server holding the account is unavailable, try again.']
+owner3.shard.accounts[user3] = account3
+unreachable = listen_port("127.0.0.1", 0)
+lost, lost_owner = "lost", "127.0.0.1:%d" % unreachable.getsockname()[1]
+unreachable.close()
+owner = node1.ring.owner
+node1.ring.owner = lambda key: lost_owner if key == lost else owner(key)
+client3[0].sendall(pack_packet(5, f"{lost}|Hello?") + pack_packet(7, f"{lost} {user1}|Hello all"))
+assert receive_thread_client(client3, 2)[0] == '<server> Operation failed. The server holding the account is unavailable, try again.'
+assert receive_thread_client(client1) == [f'<{user3}> Hello all']
+del node1.ring.owner
+client3[0].sendall(pack_packet(6, ""))
+assert receive_thread_client(client3) == ['<server> No messages queued']
+
+# Test that a disconnected client is logged out on the node owning its account
+client1[0].close()
+owner1 = next(node for node in nodes if user1 in node.shard.accounts)
+while user1 in owner1.shard.online_users:
+    time.sleep(0.01)
+for client in (client2, client3):
+    client[0].close()
+for listener in (listener1, listener2, listener3):
+    listener.close()
+
+print("****************************************************")
+print("***** Done testing the sharded wire cluster... *****")
+print("****************************************************")
+
+########################################
+# Testing the asyncio wire server
+########################################
+
+print("**********************************************")
+print("***** Testing the asyncio wire server... *****")
+print("**********************************************")
+import asyncio
+from wire.async_server import handle_client
+
+
+async def test_async_server():
+    chat_app = Chat()
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_client(chat_app, reader, writer), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+
+    async def connect():
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        return reader, writer, PacketDecoder(), []
+
+    async def receive(client):
+        reader, _, decoder, pending = client
+        while not pending:
+            pending.extend(decoder.feed(await reader.read(1024)))
+        return pending.pop(0)[1]
+
+    client1, client2 = await connect(), await connect()
+    assert await receive(client1) == '<server> Connected to server'
+    assert await receive(client2) == '<server> Connected to server'
+
+    client1[1].write(pack_packet(1, "user1"))
+    assert await receive(client1) == '<server> Account created with username "user1".'
+    client2[1].write(pack_packet(1, "user2"))
+    assert await receive(client2) == '<server> Account created with username "user2".'
+
+    # Test pushing a message to another connection on the same event loop
+    client1[1].write(pack_packet(5, "user2|Hello, user2!"))
+    assert await receive(client2) == '<user1> Hello, user2!'
+    assert await receive(client1) == '<server> Message sent to "user2".'
+
+    # Test that a version 2 client gets its responses as frames
+    client3 = await connect()
+    assert await receive(client3) == '<server> Connected to server'
+    client3[1].write(pack_packet(HELLO, "2"))
+    assert await receive(client3) == "2"
+    client3[1].write(pack_request(1, "user3", 9) + pack_request(5, "user2|Hi", 10))
+    assert await receive(client2) == '<user3> Hi'
+    assert await receive(client3) == ("user3",)
+    while not client3[3]:
+        client3[3].extend(client3[2].feed(await client3[0].read(1024)))
+    assert client3[3] == [(5, ("user2",), RESPONSE, 10, MESSAGE_SENT)]
+    client3[1].close()
+
+    # Test that a silent version 2 client is pinged, and disconnected unless
+    # it answers, while a version 1 client is left alone
+    keep_alive(0.1, 0.3)
+    client4, client5 = await connect(), await connect()
+    assert await receive(client4) == '<server> Connected to server'
+    assert await receive(client5) == '<server> Connected to server'
+    client4[1].write(pack_packet(HELLO, "2"))
+    assert await receive(client4) == "2"
+    client4[1].write(pack_request(1, "user4", 1))
+    client5[1].write(pack_packet(1, "user5"))
+    assert await receive(client4) == ("user4",)
+    await receive(client5)
+    received = []
+    while data := await client4[0].read(1024):
+        received += client4[2].feed(data)
+    assert received and set(received) == {(PING, (), PUSH, 0, STATUS_OK)}
+    assert "user4" not in chat_app.core.online_users and "user5" in chat_app.core.online_users
+    assert client5[3] == [] and not client5[0].at_eof()
+    keep_alive(None, None)
+    client5[1].close()
+
+    # Test that a client that stops reading is dropped and logged out once
+    # too much is buffered for it
+    small_server = await asyncio.start_server(
+        lambda reader, writer: handle_client(chat_app, reader, writer, 1 << 16), '127.0.0.1', 0)
+    reader, writer = await asyncio.open_connection('127.0.0.1', small_server.sockets[0].getsockname()[1])
+    client6 = reader, writer, PacketDecoder(), []
+    assert await receive(client6) == '<server> Connected to server'
+    writer.write(pack_packet(1, "user6"))
+    await receive(client6)
+    # Stop reading so the server's buffer for the client fills up
+    writer.transport.pause_reading()
+    filler = "x" * 10000
+    for _ in range(2000):
+        if "user6" not in chat_app.core.online_users:
+            break
+        client1[1].write(pack_packet(5, f"user6|{filler}"))
+        await receive(client1)
+    for _ in range(100):
+        if "user6" not in chat_app.core.online_users:
+            break
+        await asyncio.sleep(0.01)
+    assert "user6" not in chat_app.core.online_users
+    writer.close()
+    small_server.close()
+    await small_server.wait_closed()
+
+    # Test that disconnecting logs the user out
+    client2[1].close()
+    while "user2" in chat_app.core.online_users:
+        await asyncio.sleep(0.01)
+
+    client1[1].close()
+    server.close()
+    await server.wait_closed()
+
+asyncio.run(test_async_server())
+
+print("***************************************************")
+print("***** Done testing the asyncio wire server... *****")
+print("***************************************************")
+
 ########################################
 # Testing the GRPC chat app
 ########################################
@@ -124,6 +1253,7 @@ print("****************************************")
 
 from grpc_proto.client import ChatClient
 import grpc
+import grpc_proto.chat_pb2 as chat_pb2
 import grpc_proto.chat_pb2_grpc as chat_pb2_grpc
 from grpc_proto.server import ChatServer
 from concurrent import futures
@@ -183,6 +1313,10 @@ except:
 # Test sending a message to themselves
 assert client.send_message("user2", "Hello, msyelf!") == "Message sent."
 
+# Test sending a message to several users
+assert client.send_message_batch(["user1", "user2", "user3"], "Hello, all!") == \
+    '<server> Message sent to 3 accounts. "user1": queued, "user2": sent, "user3": does not exist.'
+
 # Test logging in to a user
 assert client.logout_account() == "<server> Account \"user2\" logged out."
 assert client.login_account("user1") == "<server> Account \"user1\" logged in."
@@ -209,6 +1343,24 @@ except:
 # Test listing all accounts
 assert client.list_accounts("") == "<server> All Accounts: [\'user1\', \'user2\']"
 
+# Test listing a page of accounts
+stub = chat_pb2_grpc.ChatServerStub(grpc.insecure_channel('127.0.0.1:6666'))
+page = stub.ListAccounts(chat_pb2.Wildcard(wildcard="user", limit=1))
+assert (list(page.usernames), page.next_cursor) == (["user1"], "user1")
+page = stub.ListAccounts(chat_pb2.Wildcard(wildcard="user", limit=1, cursor=page.next_cursor))
+assert (list(page.usernames), page.next_cursor) == (["user2"], "user2")
+
+assert client.list_accounts_page("user", 1) == "<server> All Accounts: [\'user1\'] More accounts after \"user1\"."
+
+# Test streaming every page of accounts
+pages = stub.ListAccountsStream(chat_pb2.Wildcard(wildcard="", page_size=1))
+assert [(list(page.usernames), page.next_cursor) for page in pages] == [(["user1"], "user1"), (["user2"], "user2")]
+
+# Test that idle chat streams sleep instead of busy-waiting
+start = time.process_time()
+time.sleep(0.5)
+assert time.process_time() - start < 0.25
+
 # Disconnect the server
 service.is_connected = False
 
@@ -216,5 +1368,47 @@ time.sleep(0.1)
 print("*********************************************")
 print("***** Done testing the GRPC chat app... *****")
 print("*********************************************")
+
+########################################
+# Testing the grpc.aio chat server
+########################################
+
+print("***********************************************")
+print("***** Testing the grpc.aio chat server... *****")
+print("***********************************************")
+from grpc_proto.aio_server import AsyncChatServer, serve
+
+aio_service = AsyncChatServer()
+aio_loop = asyncio.new_event_loop()
+aio_task = aio_loop.create_task(serve(aio_service, '127.0.0.1:6667'))
+threading.Thread(target=aio_loop.run_forever, daemon=True).start()
+aio_channel = grpc.insecure_channel('127.0.0.1:6667')
+grpc.channel_ready_future(aio_channel).result(timeout=5)
+
+# Test that more streams than the threaded server has workers stay responsive
+aio_clients = [ChatClient("127.0.0.1", 6667) for _ in range(20)]
+for i, aio_client in enumerate(aio_clients):
+    assert aio_client.create_account(f"user{i}") == f"<server> Account created with username \"user{i}\"."
+assert aio_clients[0].list_accounts("user1$") == "<server> All Accounts: ['user1']"
+
+# Test that a message is pushed on a waiting stream
+stub = chat_pb2_grpc.ChatServerStub(aio_channel)
+stream = stub.ChatStream(chat_pb2.User(username="user0"))
+time.sleep(0.1)
+assert aio_clients[19].send_message("user0", "Hello, user0!") == "Message sent."
+chat_message = next(stream)
+assert (chat_message.username, chat_message.message) == ("user19", "Hello, user0!")
+
+# Test that logging out ends the stream
+assert aio_clients[0].logout_account() == "<server> Account \"user0\" logged out."
+assert next(stream, None) is None
+
+# Stop the server
+aio_loop.call_soon_threadsafe(aio_task.cancel)
+
+time.sleep(0.1)
+print("****************************************************")
+print("***** Done testing the grpc.aio chat server... *****")
+print("****************************************************")
 print("\nAll tests passed!")
 
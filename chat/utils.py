@@ -54,3 +54,169 @@ def get_server_config_from_file(relative_path):
     absolute_path = os.path.join(ROOT_DIR, relative_path)
     yaml_config = read_yaml_config(absolute_path)
     return get_server_config_from_yaml(yaml_config)
+
+
+def get_grpc_config_from_yaml(yaml_data):
+    """
+    Get the grpc server limits from yaml data
+    Args:
+        yaml_data: Data from a previously loaded yaml file
+    Returns:
+        A tuple where the first item is the number of worker threads
+        and the second item is the maximum number of concurrent RPCs,
+        which is None when there is no limit
+    Raises:
+        ValueError: If the yaml data is not in a dictionary format
+    """
+    if (yaml_data is None) or (not isinstance(yaml_data, dict)):
+        raise ValueError('Yaml data needs to be a dict type!')
+
+    grpc_config = yaml_data.get('grpc') or {}
+    return grpc_config.get('max_workers', 10), grpc_config.get('max_concurrent_rpcs')
+
+
+def get_grpc_config_from_file(relative_path):
+    absolute_path = os.path.join(ROOT_DIR, relative_path)
+    yaml_config = read_yaml_config(absolute_path)
+    return get_grpc_config_from_yaml(yaml_config)
+
+
+def get_storage_config_from_yaml(yaml_data):
+    """
+    Get the storage configuration from yaml data
+    Args:
+        yaml_data: Data from a previously loaded yaml file
+    Returns:
+        A tuple where the first item is the absolute path of the log file,
+        which is None when state is only kept in memory, the second item
+        is the group commit interval in seconds, and the third is whether
+        each change waits for its fsync before it is acknowledged
+    Raises:
+        ValueError: If the yaml data is not in a dictionary format
+    """
+    if (yaml_data is None) or (not isinstance(yaml_data, dict)):
+        raise ValueError('Yaml data needs to be a dict type!')
+
+    storage_config = yaml_data.get('storage') or {}
+    path = storage_config.get('path')
+    if path is not None:
+        path = os.path.join(ROOT_DIR, path)
+    return path, storage_config.get('commit_interval', 0.005), bool(storage_config.get('durable', False))
+
+
+def get_storage_config_from_file(relative_path):
+    absolute_path = os.path.join(ROOT_DIR, relative_path)
+    yaml_config = read_yaml_config(absolute_path)
+    return get_storage_config_from_yaml(yaml_config)
+
+
+def get_mailbox_config_from_yaml(yaml_data):
+    """
+    Get the offline mailbox limits from yaml data
+    Args:
+        yaml_data: Data from a previously loaded yaml file
+    Returns:
+        A tuple of the messages kept for each offline user, which is None
+        when there is no limit, the overflow policy and the absolute path
+        of the spill folder, which is None for the temporary folder
+    Raises:
+        ValueError: If the yaml data is not in a dictionary format, the
+                    overflow policy is unknown or the limit is below 1
+    """
+    if (yaml_data is None) or (not isinstance(yaml_data, dict)):
+        raise ValueError('Yaml data needs to be a dict type!')
+
+    mailbox_config = yaml_data.get('mailbox') or {}
+    overflow = mailbox_config.get('overflow', 'reject')
+    if overflow not in ('drop-oldest', 'reject', 'spill'):
+        raise ValueError(f'{overflow} is not a mailbox overflow policy!')
+
+    # A mailbox that holds nothing would spill every message and never
+    # deliver it
+    max_messages = mailbox_config.get('max_messages')
+    if max_messages is not None and (not isinstance(max_messages, int) or max_messages < 1):
+        raise ValueError(f'{max_messages} is not a valid mailbox size, it must be at least 1!')
+
+    spill_path = mailbox_config.get('spill_path')
+    if spill_path is not None:
+        spill_path = os.path.join(ROOT_DIR, spill_path)
+    return max_messages, overflow, spill_path
+
+
+def get_mailbox_config_from_file(relative_path):
+    absolute_path = os.path.join(ROOT_DIR, relative_path)
+    yaml_config = read_yaml_config(absolute_path)
+    return get_mailbox_config_from_yaml(yaml_config)
+
+
+def get_metrics_config_from_yaml(yaml_data):
+    """
+    Get the metrics configuration from yaml data
+    Args:
+        yaml_data: Data from a previously loaded yaml file
+    Returns:
+        A tuple of the host and port of the metrics endpoint, the port
+        being None when metrics are not served, and how many requests
+        are received for each one logged, 0 for none
+    Raises:
+        ValueError: If the yaml data is not in a dictionary format
+    """
+    if (yaml_data is None) or (not isinstance(yaml_data, dict)):
+        raise ValueError('Yaml data needs to be a dict type!')
+
+    metrics_config = yaml_data.get('metrics') or {}
+    return metrics_config.get('host', 'localhost'), metrics_config.get('port'), metrics_config.get('log_every', 0)
+
+
+def get_metrics_config_from_file(relative_path):
+    absolute_path = os.path.join(ROOT_DIR, relative_path)
+    yaml_config = read_yaml_config(absolute_path)
+    return get_metrics_config_from_yaml(yaml_config)
+
+
+def get_write_window_from_yaml(yaml_data):
+    """
+    Get the write window of the wire servers from yaml data
+    Args:
+        yaml_data: Data from a previously loaded yaml file
+    Returns:
+        The seconds a connection's writer waits after its first packet to
+        gather more into the same write, 0 when it does not wait
+    Raises:
+        ValueError: If the yaml data is not in a dictionary format
+    """
+    if (yaml_data is None) or (not isinstance(yaml_data, dict)):
+        raise ValueError('Yaml data needs to be a dict type!')
+
+    server_config = yaml_data.get('server') or {}
+    return server_config.get('write_window') or 0.0
+
+
+def get_write_window_from_file(relative_path):
+    absolute_path = os.path.join(ROOT_DIR, relative_path)
+    yaml_config = read_yaml_config(absolute_path)
+    return get_write_window_from_yaml(yaml_config)
+
+
+def get_keepalive_config_from_yaml(yaml_data):
+    """
+    Get the keepalive configuration of the wire servers from yaml data
+    Args:
+        yaml_data: Data from a previously loaded yaml file
+    Returns:
+        A tuple of the seconds a client can be silent before it is pinged,
+        and before it is disconnected, either being None when turned off
+    Raises:
+        ValueError: If the yaml data is not in a dictionary format
+    """
+    if (yaml_data is None) or (not isinstance(yaml_data, dict)):
+        raise ValueError('Yaml data needs to be a dict type!')
+
+    server_config = yaml_data.get('server') or {}
+    return server_config.get('ping_interval'), server_config.get('idle_timeout')
+
+
+def get_keepalive_config_from_file(relative_path):
+    absolute_path = os.path.join(ROOT_DIR, relative_path)
+    yaml_config = read_yaml_config(absolute_path)
+    return get_keepalive_config_from_yaml(yaml_config)
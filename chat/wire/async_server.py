@@ -0,0 +1,216 @@
+# asyncio implementation of the server side of the chat room.
+import asyncio
+import logging
+import time
+
+from wire.chat_service import User
+import wire.server
+from wire.server import coalesce, frame_responses, handle_control, set_tcp_keepalive
+from wire.wire_protocol import PING, PUSH, PacketDecoder, pack_frame, pack_packet
+
+RECV_SIZE = 4096
+BACKLOG = 1024
+# Bytes buffered for a client that is not reading before it is dropped
+MAX_WRITE_BUFFER = 1 << 24
+
+
+class StreamConnection:
+    """
+    A class used to write to a client's stream on the event loop
+    ...
+
+    Stands in for the socket as the user's connection, so Chat.handler can
+    route responses to any client without knowing which server engine is
+    running.
+
+    A client with more than max_buffer bytes waiting in its transport's
+    write buffer is dropped, a max_buffer of 0 buffers without limit.
+
+    Attributes
+    ----------
+    writer : StreamWriter
+        stream to write packets to the client
+
+    max_buffer : int
+        bytes the transport may buffer before the client is dropped
+
+    version : int
+        protocol version negotiated with the client
+
+    answers_pings : bool
+        whether the client negotiated version 2 or sent a PING
+
+    Methods
+    -------
+    send(packet)
+        Buffers a packet to be written to the client
+
+    send_many(packets)
+        Buffers packets to be written to the client in one write
+
+    ping()
+        Buffers a PING packet in the client's protocol version
+
+    is_closing()
+        Gets whether the stream is closed or closing
+
+    abort()
+        Closes the stream without writing buffered packets
+    """
+
+    def __init__(self, writer, max_buffer: int = MAX_WRITE_BUFFER):
+        self.writer = writer
+        self.max_buffer = max_buffer
+        self.version = 1
+        self.answers_pings = False
+
+    def send(self, packet: bytes):
+        self.send_many([packet])
+
+    def send_many(self, packets: list):
+        if self.is_closing():
+            return
+
+        # Joined into a single write, asyncio already sets TCP_NODELAY
+        self.writer.writelines(packets)
+        # The client is not reading, drop it rather than buffer forever
+        if self.max_buffer and self.writer.transport.get_write_buffer_size() > self.max_buffer:
+            self.abort()
+
+    def ping(self):
+        self.send(pack_packet(PING, "") if self.version == 1 else pack_frame(PING, b"", PUSH))
+
+    def is_closing(self) -> bool:
+        return self.writer.is_closing()
+
+    def abort(self):
+        # Wakes the client's reader with a lost connection, which logs it out
+        self.writer.transport.abort()
+
+
+async def handle_client(chat_app, reader, writer, max_buffer: int = MAX_WRITE_BUFFER):
+    """
+    Serves a single client connection on the event loop
+
+    Parameters
+    ----------
+    chat_app: Chat
+        Chat object shared by every connection
+
+    reader: StreamReader
+        Stream to read packets from the client
+
+    writer: StreamWriter
+        Stream to write packets to the client
+
+    max_buffer: int
+        Bytes buffered for the client before it is dropped
+    """
+    addr = writer.get_extra_info('peername')
+
+    # Define a user object to keep track of the user and state for the connection
+    connection = StreamConnection(writer, max_buffer)
+
+    # sends a message to the client whose user object is writer
+    connection.send(pack_packet(1, '<server> Connected to server'))
+
+    curr_user = User(connection)
+    decoder = PacketDecoder()
+
+    # Reads time out to ping a silent client that answers pings, and to
+    # disconnect it once it has been silent for the idle timeout. Version 1
+    # clients cannot answer, so they are left to TCP keepalive.
+    ping_interval, idle_timeout = wire.server.PING_INTERVAL, wire.server.IDLE_TIMEOUT
+    last_read = last_ping = time.monotonic()
+    if ping_interval or idle_timeout:
+        set_tcp_keepalive(writer.get_extra_info('socket'), ping_interval or idle_timeout, idle_timeout)
+
+    try:
+        while True:
+            deadlines = []
+            if ping_interval and connection.answers_pings:
+                deadlines.append(max(last_read, last_ping) + ping_interval)
+            if idle_timeout and connection.answers_pings:
+                deadlines.append(last_read + idle_timeout)
+            timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
+
+            try:
+                data = await asyncio.wait_for(reader.read(RECV_SIZE), timeout)
+            except asyncio.TimeoutError:
+                if idle_timeout and time.monotonic() - last_read >= idle_timeout:
+                    break
+                connection.ping()
+                last_ping = time.monotonic()
+                continue
+
+            # If data has no content, the client has disconnected
+            if not data:
+                break
+            last_read = time.monotonic()
+
+            for op_code, contents, *header in decoder.feed(data):
+                if handle_control(connection, decoder, addr, op_code, contents):
+                    continue
+
+                # Version 1 packets have no request id
+                request_id = header[1] if header else 0
+                responses = chat_app.handler(
+                    curr_user, int(op_code), contents)
+
+                # Writes are buffered by each transport, so a slow recipient
+                # never blocks the sender or the event loop
+                for recip_conn, packets in coalesce(frame_responses(
+                        responses, connection, op_code, request_id)):
+                    recip_conn.send_many(packets)
+
+            # Only wait on the sender's own buffer to apply backpressure, a
+            # client answering pings that stops reading for the idle timeout
+            # is disconnected
+            await asyncio.wait_for(writer.drain(), idle_timeout if connection.answers_pings else None)
+    except (ConnectionError, ValueError, asyncio.TimeoutError):
+        pass
+    finally:
+        chat_app.logout_account(curr_user, acknowledge=False)
+        writer.close()
+
+
+def raise_open_file_limit():
+    """
+    Raises the soft limit on open files to the hard limit so the server can
+    hold as many sockets as the system allows
+    """
+    try:
+        import resource
+    except ImportError:
+        # resource is not available on Windows
+        return
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            logging.info(f'Could not raise open file limit above {soft}')
+
+
+async def serve(chat_app, host: str, port: int):
+    """
+    Accepts clients and serves them all from a single event loop
+
+    Parameters
+    ----------
+    chat_app: Chat
+        Chat object to handle all the chat logic
+
+    host: str
+        Address to bind the server to
+
+    port: int
+        Port to bind the server to
+    """
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_client(chat_app, reader, writer),
+        host, port, backlog=BACKLOG)
+
+    async with server:
+        await server.serve_forever()
@@ -1,9 +1,17 @@
 import re
-import threading
+import time
 from _thread import *
 from typing import NewType
 
-Response = NewType('response', tuple[int, str])
+from core import DELIVER_BATCH, STRIPES, ChatCore
+from offline import REJECT
+from storage import Storage
+from wire.replies import *
+from wire.wire_protocol import parse_send
+
+Response = NewType('response', tuple)
+
+PAGE_SIZE = 100
 
 
 class User:
@@ -45,38 +53,66 @@ class User:
         self.username = username
 
 
+def send_fields(content):
+    """
+    Gets the recipient and message of a send, given as the fields of a
+    version 2 FIELDS request or as "recipient|message" text
+
+    Returns
+    -------
+    A tuple of the recipient and message, or None if the send is invalid
+    """
+    if isinstance(content, str):
+        return parse_send(content)
+    if len(content) == 2 and all(isinstance(field, str) and field for field in content):
+        return tuple(content)
+    return None
+
+
 class Chat:
     """
     A class used to handle chat functions
     ...
 
+    Adapts wire protocol requests to the ChatCore holding all chat state,
+    using each user's socket as their session.
+
     Attributes
     ----------
-    accounts : dict
-        dictionary of all accounts
-
-    online_users : dict
-        dictionary of online users
-
-    lock: Lock()
-        Primative lock for multithread synchronization
+    core : ChatCore
+        chat state shared with the connections of every user
 
     Methods
     -------
-    says(sound=None)
-        Prints the animals name and what sound it makes
+    handler(user, op_code, content)
+        Handles one request, returning the replies to send
     """
 
-    def __init__(self):
+    def __init__(self, stripes: int = STRIPES, storage: Storage = None,
+                 max_messages: int = None, overflow: str = REJECT, spill_dir: str = None):
         """
         Constructs all the necessary attributes for the person object.
         """
 
-        self.accounts = {}
-        self.online_users = {}
-        self.lock = threading.Lock()
+        self.core = ChatCore(stripes, storage, max_messages, overflow, spill_dir)
 
     def handler(self, user: User, op_code: int, content: str = "") -> list[Response]:
+        """
+        Handles one request, counting it in the core's metrics along with
+        its latency and whether its last reply was an error. The pages
+        listed by op code 0 are found after it returns, so they are not
+        included in its latency.
+        """
+        start = time.perf_counter()
+        failed = True
+        try:
+            responses = self.dispatch(user, op_code, content)
+            failed = isinstance(responses, list) and bool(responses) and is_error(responses[-1][1])
+            return responses
+        finally:
+            self.core.metrics.observe(op_code, time.perf_counter() - start, failed)
+
+    def dispatch(self, user: User, op_code: int, content: str = "") -> list[Response]:
         """
         Handler function
 
@@ -90,34 +126,60 @@ class Chat:
 
         content: str, optional
             Contents of the request
+
+        Returns
+        -------
+        The (recipient connection, reply) pairs to send, every reply being a
+        reply code followed by its fields
         """
 
+        # Only sends take packed fields, every other request is text
+        if not isinstance(content, str) and op_code != 5:
+            return [(user.get_conn(), (INVALID_INPUT, str(list(content))))]
+
         if op_code == 0:
-            return self.list_accounts(user, content)
+            return self.list_accounts_pages(user, content)
         elif op_code == 1:
             return self.create_account(user, content)
         elif op_code == 2:
             return self.login_account(user, content)
-        elif user.username in self.online_users:
+        elif op_code == 8:
+            page_size, cursor, exp = (content.split("|", 2) + ["", ""])[:3]
+            if page_size.isdecimal() and int(page_size) > 0:
+                return self.list_accounts(user, exp, int(page_size), cursor or None)
+            else:
+                return [(user.get_conn(), (INVALID_INPUT, content))]
+        elif self.is_logged_in(user):
             if op_code == 3:
                 return self.logout_account(user)
             elif op_code == 4:
                 return self.delete_account(user)
             elif op_code == 5:
-                match = re.match(r"(\S+)\|((\S| )+)", content)
-                if match:
-                    send_user, message = match.group(1), match.group(2)
-                    return self.send_message(user, send_user, message)
+                send = send_fields(content)
+                if send:
+                    return self.send_message(user, *send)
                 else:
-                    return [(user.get_conn(), f"<server> Invalid input: {content}")]
+                    return [(user.get_conn(), (INVALID_INPUT, content if isinstance(content, str) else str(list(content))))]
             elif op_code == 6:
-                return self.deliver_undelivered(user)
+                if content.isdecimal() or content == "":
+                    return self.deliver_undelivered(user, int(content) if content else None)
+                else:
+                    return [(user.get_conn(), (INVALID_INPUT, content))]
+            elif op_code == 7:
+                send_users, _, message = content.partition("|")
+                if send_users.strip() and message:
+                    return self.send_message_batch(user, send_users.split(), message)
+                else:
+                    return [(user.get_conn(), (INVALID_INPUT, content))]
             else:
-                return [(user.get_conn(), f'<server> {op_code} is not a valid operation code.')]
+                return [(user.get_conn(), (INVALID_OPERATION, op_code))]
         else:
-            return [(user.get_conn(), "<server> Operation not permitted. You are not logged in.")]
+            return [(user.get_conn(), (NOT_LOGGED_IN,))]
 
-    def list_accounts(self, user: User, exp: str = "\S*") -> list[Response]:
+    def is_logged_in(self, user: User) -> bool:
+        return user.username in self.core.online_users
+
+    def list_accounts(self, user: User, exp: str = "\S*", limit: int = None, cursor: str = None) -> list[Response]:
         """
         List all accounts on the chat server
 
@@ -128,6 +190,12 @@ class Chat:
 
         exp: str
             Regex expression to filter accounts
+
+        limit: int, optional
+            Maximum number of accounts to list, None for no limit
+
+        cursor: str, optional
+            Only list accounts after this username
         """
 
         conn = user.get_conn()
@@ -136,14 +204,44 @@ class Chat:
         try:
             pattern = re.compile(exp)
         except:
-            return [(conn, f"<server> {exp} is not a valid regex pattern.")]
+            return [(conn, (INVALID_REGEX, exp))]
 
-        # Filters all usernames based on the passed in regex pattern
-        self.lock.acquire()
-        list_of_usernames = list(filter(pattern.match, self.accounts))
-        self.lock.release()
+        # Filters usernames based on the passed in regex pattern, only
+        # scanning usernames that start with the pattern's literal prefix
+        list_of_usernames, next_cursor = self.core.index.search(pattern, limit, cursor)
+
+        return [(conn, (ACCOUNTS, list_of_usernames, next_cursor))]
+
+    def list_accounts_pages(self, user: User, exp: str = "\S*", page_size: int = PAGE_SIZE):
+        """
+        List all accounts on the chat server, generating one response per
+        page so that no single packet holds every username
+
+        Parameters
+        ----------
+        user: User
+            User information
+
+        exp: str
+            Regex expression to filter accounts
+
+        page_size: int
+            Maximum number of accounts in each response
+        """
+
+        conn = user.get_conn()
+
+        # Checks if the passed-in expression is a valid regex pattern
+        try:
+            pattern = re.compile(exp)
+        except:
+            yield (conn, (INVALID_REGEX, exp))
+            return
+
+        # Each page is only found once the previous one has been sent
+        for list_of_usernames, _ in self.core.index.pages(pattern, page_size):
+            yield (conn, (ACCOUNTS, list_of_usernames, None))
 
-        return [(conn, f"<server> List of accounts: {str(list_of_usernames)}")]
 
     def create_account(self, user: User, username: str) -> list[Response]:
         """
@@ -158,31 +256,11 @@ class Chat:
             Username for the new account
         """
         conn = user.get_conn()
+        reply = self.core.create_account(username, conn)
 
-        # Checks if the passed-in username is valid
-        if " " in username or "|" in username:
-            return [(conn, '<server> Failed to create account. Username cannot have " " or "|".')]
-
-        # Checks if the username is empty
-        if "" == username:
-            return [(conn, '<server> Failed to create account. Username cannot be empty.')]
-
-        # Checks if the username is already in use
-        if username in self.accounts:
-            response = (
-                conn, f'<server> Failed to create account. Username "{username}" is already in use.')
-        else:
-            # Updates chat app state for the new account
-            self.lock.acquire()
-            self.accounts[username] = []
-            self.online_users[username] = conn
+        if reply[0] == ACCOUNT_CREATED:
             user.set_name(username)
-            self.lock.release()
-
-            response = (
-                conn, f'<server> Account created with username "{username}".')
-
-        return [response]
+        return [(conn, reply)]
 
     def login_account(self, user: User, username: str) -> list[Response]:
         """
@@ -197,32 +275,13 @@ class Chat:
             Account username
         """
         conn = user.get_conn()
+        reply = self.core.login(username, conn, user.get_name())
 
-        # Check if the username is not in accounts
-        if username not in self.accounts:
-            response = (
-                conn, f'<server> Failed to login. Account "{username}" not found.')
-        # Check if another user is already logged in
-        elif username in self.online_users:
-            response = (
-                conn, f'<server> Failed to login. Account "{username}" is already logged in. You cannot log in to the same account from multiple clients.')
-        # otherwise, we will try to log in
-        else:
-            self.lock.acquire()
-            # if the user is logged-in to a different account, we need to log them out
-            if user.get_name() in self.online_users:
-                del self.online_users[user.get_name()]
-
-            # Updates chat app state with new account connection
-            self.online_users[username] = conn
+        if reply[0] == LOGGED_IN:
             user.set_name(username)
-            self.lock.release()
-
-            response = (conn, f'<server> Account "{username}" logged in.')
+        return [(conn, reply)]
 
-        return [response]
-
-    def logout_account(self, user: User) -> list[Response]:
+    def logout_account(self, user: User, acknowledge: bool = True) -> list[Response]:
         """
         Logs a user out of the server
 
@@ -231,23 +290,16 @@ class Chat:
         user: User
             User information
 
-        username: str
-            Account username
+        acknowledge: bool
+            Whether messages already delivered to the user are acknowledged,
+            False when the connection was lost and they may not have arrived
         """
         conn = user.get_conn()
-        to_logout = user.get_name()
-
-        # Checks if the user is logged in or exists
-        if to_logout not in self.accounts or to_logout not in self.online_users:
-            return [(conn, f"<server> Failed to logout. You are not logged in, or account \"{to_logout}\" does not exist.")]
-
-        # Deletes the user from the online users
-        self.lock.acquire()
-        del self.online_users[user.get_name()]
-        self.lock.release()
+        reply, _ = self.core.logout(user.get_name(), acknowledge)
 
-        user.set_name()
-        return [(conn, f"<server> Account \"{to_logout}\" logged out.")]
+        if reply[0] == LOGGED_OUT:
+            user.set_name()
+        return [(conn, reply)]
 
     def delete_account(self, user: User) -> list[Response]:
         """
@@ -259,18 +311,11 @@ class Chat:
             User information
         """
         conn = user.get_conn()
-        to_delete = user.get_name()
+        reply, _ = self.core.delete_account(user.get_name())
 
-        self.lock.acquire()
-        if to_delete not in self.accounts or to_delete not in self.online_users:
-            return [(conn, f"<server> Failed to delete. You are not logged in, or account \"{to_delete}\" does not exist.")]
-        else:
-            del self.accounts[to_delete]
-            del self.online_users[to_delete]
-        self.lock.release()
-
-        user.set_name()
-        return [(conn, f"<server> Account \"{to_delete}\" deleted.")]
+        if reply[0] == ACCOUNT_DELETED:
+            user.set_name()
+        return [(conn, reply)]
 
     def send_message(self, user: User, send_user: str, message: str) -> list[Response]:
         """
@@ -288,50 +333,83 @@ class Chat:
             Chat message
         """
         conn = user.get_conn()
+        status, send_conn = self.core.route_message(user.get_name(), send_user, message)
 
-        self.lock.acquire()
         # Check if the username does not exist
-        if send_user not in self.accounts:
-            response = [(
-                conn, f"<server> Failed to send. Account \"{send_user}\" does not exist.")]
-        else:
-            # send the message directly if the user is online
-            response_message = f"<{user.get_name()}> {message}"
-            if send_user in self.online_users:
-                send_conn = self.online_users[send_user]
-                response = [(send_conn, response_message),
-                            (conn, f"<server> Message sent to \"{send_user}\".")]
-            # queue the message if the user is not online
-            else:
-                self.accounts[send_user].append(response_message)
-                # let the current user know that the message is queued to send
-                response = [(
-                    conn, f"<server> Account \"{send_user}\" not online. Message queued to send")]
-        self.lock.release()
+        if status == NOT_FOUND:
+            return [(conn, (RECIPIENT_NOT_FOUND, send_user))]
+
+        # send the message directly if the user is online
+        if status == SENT:
+            return [(send_conn, (MESSAGE, user.get_name(), message)),
+                    (conn, (MESSAGE_SENT, send_user))]
 
-        return response
+        # the recipient's mailbox is full and the message was rejected
+        if status == MAILBOX_FULL:
+            return [(conn, (MESSAGE_REJECTED, send_user))]
 
-    def deliver_undelivered(self, user: User) -> list[Response]:
+        # the recipient's account could not be reached
+        if status == UNAVAILABLE:
+            return [(conn, (NODE_UNAVAILABLE,))]
+
+        # let the current user know that the message is queued to send
+        return [(conn, (MESSAGE_QUEUED, send_user))]
+
+    def send_message_batch(self, user: User, send_users: list[str], message: str) -> list[Response]:
         """
-        Delivers all queued messages to a user upon request
+        Sends one message to several users, replying with the delivery
+        status of every recipient in a single response
 
         Parameters
         ----------
         user: User
-            User information 
+            User information of sender
+
+        send_users: list[str]
+            Usernames of the intended recipients
+
+        message: str
+            Chat message
         """
         conn = user.get_conn()
+        response_message = (MESSAGE, user.get_name(), message)
+
+        responses = []
+        statuses = []
+        # Each recipient is only looked up and locked once, even if repeated
+        for send_user in dict.fromkeys(send_users):
+            status, send_conn = self.core.route_message(user.get_name(), send_user, message)
+            if status == SENT:
+                responses.append((send_conn, response_message))
+            statuses.append([send_user, status])
+
+        responses.append((conn, (BATCH_SENT, statuses)))
+        return responses
+
+    def deliver_undelivered(self, user: User, offset: int = None,
+                            batch_size: int = DELIVER_BATCH) -> list[Response]:
+        """
+        Delivers the next batch of queued messages to a user upon request
+
+        Parameters
+        ----------
+        user: User
+            User information 
+
+        offset: int, optional
+            Acknowledge every message before this offset and deliver from
+            it, instead of from after the last batch sent
 
-        self.lock.acquire()
-        # get all queued messages for the user formatted correctly
-        responses = [(conn, message)
-                     for message in self.accounts[user.get_name()]]
-        # clear the queue
-        self.accounts[user.get_name()] = []
-        self.lock.release()
+        batch_size: int
+            Maximum number of messages to deliver
+        """
+        conn = user.get_conn()
+        messages, next_offset, remaining = self.core.deliver(user.get_name(), offset, batch_size)
 
         # notify user if there were no queued messages
-        if len(responses) == 0:
-            return [(conn, "<server> No messages queued")]
-        else:
-            return responses
+        if not messages:
+            return [(conn, (NO_MESSAGES,))]
+
+        responses = [(conn, (MESSAGE, sender, message)) for sender, message in messages]
+        responses.append((conn, (DELIVERED, len(messages), next_offset, remaining)))
+        return responses
@@ -1,19 +1,62 @@
-
 from threading import *
 
-from wire.wire_protocol import unpack_packet
+from wire.replies import render
+from wire.wire_protocol import HELLO, PING, VERSION, PacketDecoder, pack_packet, pack_request
+
+
+def negotiate(server, decoder: PacketDecoder) -> list[tuple]:
+    """
+    Asks the server for the newest protocol version with a HELLO packet
+
+    Parameters
+    ----------
+    server: socket
+        Socket connected to the server
+
+    decoder: PacketDecoder
+        Decoder for the server's packets, left on the negotiated version
+
+    Returns
+    -------
+    Every other packet received while waiting for the server's answer
+    """
+    server.sendall(pack_packet(HELLO, str(VERSION)))
+
+    received = []
+    while True:
+        message = server.recv(4096)
+        if not message:
+            return received
+        for packet in decoder.feed(message):
+            # Servers that do not know HELLO answer it like any bad request,
+            # the first reply is always the connection greeting
+            if packet[0] == HELLO or received:
+                return received
+            received.append(packet)
 
 
 class ReceiveMessages(Thread):
-    def __init__(self, server):
+    def __init__(self, server, decoder: PacketDecoder = None):
         super().__init__()
         self.__server = server
+        self.__decoder = decoder or PacketDecoder()
 
     def run(self):
         while True:
             try:
-                message = self.__server.recv(1024)
-                _, data = unpack_packet(message)
-                print(data)
+                message = self.__server.recv(4096)
+                # The server closed the connection
+                if not message:
+                    break
+                for op_code, data, *header in self.__decoder.feed(message):
+                    # Answer the server's pings so it knows the client is alive
+                    if op_code == PING:
+                        self.__server.sendall(pack_request(PING, "", 0) if header else pack_packet(PING, ""))
+                        continue
+
+                    # Version 2 replies are rendered from their status and fields
+                    if header:
+                        data = render((header[2], *data))
+                    print(data)
             except:
                 break
@@ -0,0 +1,679 @@
+import heapq
+import itertools
+import logging
+import re
+import socket
+import threading
+from _thread import *
+
+from core import DELIVER_BATCH, STRIPES, ChatCore
+from metrics import Metrics
+from offline import REJECT
+from ring import HashRing
+from storage import Storage
+from wire.chat_service import Chat, User
+from wire.replies import *
+from wire.server import Connection, coalesce, order_responses, pack_reply, read_requests
+from wire.wire_protocol import PUSH, RESPONSE, STATUS_OK, PacketDecoder, pack_fields, pack_frame, pack_packet
+
+# Sharded wire server:
+# - every node is a wire server owning the accounts whose usernames hash to
+#   it on a consistent hash ring of every node's name, by default its peer address
+# - a client may connect to any node, which runs each operation on an
+#   account on the node that owns it, over a peer link to that node
+# - a user's session is the (node, connection id) pair of the connection
+#   they logged in from, so a message is pushed straight to that node
+# - a joining node asks a seed node for the members and announces itself to
+#   each of them, and every member hands over the accounts that now hash to
+#   the new node along with their queued messages
+#
+# Peer link format:
+# - every peer message is a version 2 frame holding packed fields
+# - the node that opened a link sends requests over it, and the other node
+#   answers each one with a frame holding the same request id and a nonzero
+#   status if the operation failed, requests with id 0 are not answered
+
+PEER_MEMBERS = 1    # -> member names
+PEER_JOIN = 2       # node -> nothing
+PEER_MIGRATE = 3    # username, session, messages -> nothing
+PEER_CREATE = 4     # username, node, connection id -> reply
+PEER_LOGIN = 5      # username, node, connection id -> reply
+PEER_LOGOUT = 6     # username, acknowledge -> reply
+PEER_DELETE = 7     # username -> reply
+PEER_ROUTE = 8      # sender, recipient, message -> status, session
+PEER_DELIVER = 9    # username, offset, batch size -> messages, offset, remaining
+PEER_LIST = 10      # regex, limit, cursor -> usernames, cursor
+PEER_PUSH = 11      # connection id, op code, list of [message type, request id, reply]
+
+PEER_FAILED = 1
+PEER_TIMEOUT = 10
+PEER_RECV_SIZE = 65536
+# Bytes of queued messages moved per frame, well under MAX_DATA_LEN
+MIGRATE_BYTES = 1 << 18
+
+
+def peer_decoder() -> PacketDecoder:
+    # Peer links never negotiate, every frame on them is version 2
+    decoder = PacketDecoder()
+    decoder.version = 2
+    return decoder
+
+
+class NodeUnavailable(Exception):
+    """
+    Raised when an operation could not be run on the node that owns an
+    account, because the node did not answer or the operation failed there
+    """
+
+    def __init__(self, node: str):
+        super().__init__(f'Node {node} is unavailable.')
+        self.node = node
+
+
+def migrate_batches(messages: list):
+    """
+    Splits the messages of a moving account into the batches sent in each
+    frame, yielding one empty batch if there are none
+    """
+    batch, size = [], 0
+    for sender, text in messages:
+        if batch and size + len(text) > MIGRATE_BYTES:
+            yield batch
+            batch, size = [], 0
+        batch.append([sender, text])
+        size += len(sender) + len(text)
+    yield batch
+
+
+class PeerLink:
+    """
+    A class used to send requests to another node of the cluster
+    ...
+
+    Requests from any number of threads share the link, each waiting for
+    the answer with its own request id.
+
+    Attributes
+    ----------
+    address : str
+        peer address of the other node
+
+    connection : Connection
+        connection to the other node's peer listener
+
+    pending : dict
+        [event, answer] of each request waiting for an answer by request id
+
+    closed : bool
+        whether the other node closed the link
+
+    Methods
+    -------
+    call(operation, fields, timeout=PEER_TIMEOUT)
+        Sends a request and waits for its answer
+
+    send(operation, fields)
+        Sends a request without waiting for an answer
+    """
+
+    def __init__(self, address: str):
+        host, port = address.rsplit(':', 1)
+        self.address = address
+        self.connection = Connection(socket.create_connection((host, int(port))), 0)
+        self.pending = {}
+        self.request_ids = itertools.count(1)
+        self.closed = False
+        threading.Thread(target=self.read_loop, daemon=True).start()
+
+    def call(self, operation: int, fields: list, timeout: float = PEER_TIMEOUT) -> tuple:
+        """
+        Sends a request to the other node and waits for its answer
+
+        Raises
+        ------
+        ConnectionError
+            If the link closed or the other node did not answer in time
+
+        RuntimeError
+            If the operation failed on the other node
+        """
+        # Request ids are 4 bytes and 0 is never answered
+        request_id = next(self.request_ids) % 0xFFFFFFFF + 1
+        waiter = [threading.Event(), None]
+        self.pending[request_id] = waiter
+        self.connection.send(pack_frame(operation, pack_fields(fields), RESPONSE, request_id))
+
+        answered = not self.closed and waiter[0].wait(timeout)
+        self.pending.pop(request_id, None)
+        if not answered or waiter[1] is None:
+            raise ConnectionError(f'Node {self.address} did not answer.')
+
+        status, answer = waiter[1]
+        if status != STATUS_OK:
+            raise RuntimeError(f'Operation {operation} failed on node {self.address}.')
+        return answer
+
+    def send(self, operation: int, fields: list):
+        self.connection.send(pack_frame(operation, pack_fields(fields)))
+
+    def read_loop(self):
+        decoder = peer_decoder()
+        sock = self.connection.sock
+        try:
+            while True:
+                data = sock.recv(PEER_RECV_SIZE)
+                if not data:
+                    break
+
+                for _, fields, _, request_id, status in decoder.feed(data):
+                    waiter = self.pending.get(request_id)
+                    if waiter is not None:
+                        waiter[1] = (status, fields)
+                        waiter[0].set()
+        except (OSError, ValueError):
+            pass
+
+        # Wake every request still waiting, they are never answered
+        self.closed = True
+        for waiter in list(self.pending.values()):
+            waiter[0].set()
+        self.connection.close()
+
+
+class ClientSession:
+    """
+    A class used to hold a client connected to this node
+    ...
+
+    Attributes
+    ----------
+    connection : Connection
+        connection of the client
+
+    ref : tuple
+        (node, connection id) pair identifying the client in the cluster
+
+    Methods
+    -------
+    send_replies(op_code, replies)
+        Sends replies packed in the client's protocol version as one write
+    """
+
+    __slots__ = ('connection', 'ref')
+
+    def __init__(self, connection: Connection, node: str, conn_id: int):
+        self.connection = connection
+        self.ref = (node, conn_id)
+
+    def send_replies(self, op_code: int, replies: list):
+        """
+        Sends replies to the client together
+
+        Parameters
+        ----------
+        op_code: int
+            Operation code of the request the replies answer
+
+        replies: list
+            (reply, message type, request id) of each reply in order
+        """
+        version = self.connection.version
+        self.connection.send_many([pack_reply(version, op_code, reply, msg_type, request_id)
+                                   for reply, msg_type, request_id in replies])
+
+
+class PeerSession:
+    """
+    A class used to stand in for a client connected to another node
+    ...
+
+    Attributes
+    ----------
+    cluster : ClusterChat
+        node sending the replies
+
+    ref : tuple
+        (node, connection id) pair identifying the client in the cluster
+
+    Methods
+    -------
+    send_replies(op_code, replies)
+        Pushes replies to the client through its node in one frame
+    """
+
+    __slots__ = ('cluster', 'ref')
+
+    def __init__(self, cluster, node: str, conn_id: int):
+        self.cluster = cluster
+        self.ref = (node, conn_id)
+
+    def send_replies(self, op_code: int, replies: list):
+        self.cluster.push(*self.ref, op_code, replies)
+
+
+class ClusterCore:
+    """
+    A class used by a node's Chat in place of a ChatCore, running each
+    operation on the node that owns the account
+    ...
+
+    Its methods take and return the same values as a ChatCore's, so the
+    Chat turns requests into calls and replies into packets unchanged. It
+    also stands in for the core's UsernameIndex, listing the accounts of
+    every node in sorted order.
+
+    An operation whose node is unavailable gets a NODE_UNAVAILABLE reply,
+    or the UNAVAILABLE status for a message, rather than disconnecting the
+    client. Deliveries and listings have no reply to return, so they raise
+    NodeUnavailable, which the ClusterChat turns into that reply.
+
+    Attributes
+    ----------
+    cluster : ClusterChat
+        node the requests arrive at
+
+    Methods
+    -------
+    search(pattern, limit=None, cursor=None)
+        Finds a page of usernames on every node matching a compiled regex
+
+    pages(pattern, page_size, cursor=None)
+        Yields every page of usernames matching a compiled regex
+    """
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    @property
+    def index(self):
+        return self
+
+    @property
+    def storage(self) -> Storage:
+        return self.cluster.shard.storage
+
+    @property
+    def metrics(self) -> Metrics:
+        return self.cluster.shard.metrics
+
+    def call_owner(self, username: str, operation: int, fields: list) -> Reply:
+        # Runs an operation that answers with a reply
+        try:
+            return tuple(self.cluster.call_owner(username, operation, fields))
+        except NodeUnavailable:
+            return (NODE_UNAVAILABLE,)
+
+    def create_account(self, username: str, session: ClientSession) -> Reply:
+        return self.call_owner(username, PEER_CREATE, [username, *session.ref])
+
+    def login(self, username: str, session: ClientSession, previous: str = None) -> Reply:
+        reply = self.call_owner(username, PEER_LOGIN, [username, *session.ref])
+
+        # The previous account may be owned by another node, where it stays
+        # logged in if that node is unavailable
+        if reply[0] == LOGGED_IN and previous is not None and previous != username:
+            self.call_owner(previous, PEER_LOGOUT, [previous, False])
+        return reply
+
+    def logout(self, username: str, acknowledge: bool = True) -> tuple:
+        if username is None:
+            return (LOGOUT_FAILED, username), None
+        return self.call_owner(username, PEER_LOGOUT, [username, acknowledge]), None
+
+    def delete_account(self, username: str) -> tuple:
+        if username is None:
+            return (DELETE_FAILED, username), None
+        return self.call_owner(username, PEER_DELETE, [username]), None
+
+    def route_message(self, username: str, send_user: str, message: str) -> tuple:
+        try:
+            status, session = self.cluster.call_owner(send_user, PEER_ROUTE, [username, send_user, message])
+        except NodeUnavailable:
+            return UNAVAILABLE, None
+        return status, self.cluster.resolve(session)
+
+    def deliver(self, username: str, offset: int = None, batch_size: int = DELIVER_BATCH) -> tuple:
+        return tuple(self.cluster.call_owner(username, PEER_DELIVER, [username, offset, batch_size]))
+
+    def search(self, pattern, limit: int = None, cursor: str = None) -> tuple:
+        """
+        Finds usernames matching a compiled regex on every node, merging
+        each node's sorted page into the first limit usernames overall
+        """
+        found = [self.cluster.call(node, PEER_LIST, [pattern.pattern, limit, cursor])
+                 for node in self.cluster.ring.nodes]
+        usernames = list(heapq.merge(*(page for page, _ in found)))
+        if limit is None:
+            return usernames, None
+
+        # A node that filled its page may have more usernames after it
+        more = len(usernames) > limit or any(next_cursor is not None for _, next_cursor in found)
+        usernames = usernames[:limit]
+        return usernames, usernames[-1] if more and usernames else None
+
+    def pages(self, pattern, page_size: int, cursor: str = None):
+        first = True
+        while True:
+            usernames, cursor = self.search(pattern, page_size, cursor)
+            # The previous page ended exactly on the last match
+            if not usernames and not first:
+                return
+
+            yield usernames, cursor
+            if cursor is None:
+                return
+            first = False
+
+
+class ClusterChat(Chat):
+    """
+    A class used to run one node of a sharded chat cluster
+    ...
+
+    The node's shard holds the accounts it owns, while its Chat handles
+    every request through a ClusterCore that sends each operation to the
+    owner of the account. Operations from other nodes are run on the shard
+    in the order each peer link sends them.
+
+    Attributes
+    ----------
+    name : str
+        name of the node, its peer address "host:port" unless it is given
+        in addresses
+
+    addresses : dict
+        peer address of each node that is not named by its address
+
+    shard : ChatCore
+        accounts owned by this node
+
+    ring : HashRing
+        consistent hash ring of every node in the cluster
+
+    links : dict
+        PeerLink to each other node by name
+
+    sessions : dict
+        ClientSession of each client connected to this node by connection id
+
+    Methods
+    -------
+    start(peer_listener, seed=None)
+        Serves other nodes and joins the cluster of a seed node
+
+    serve_forever(listener)
+        Accepts clients until the listener is closed
+
+    call(node, operation, fields)
+        Runs an operation on a node and gets its answer
+
+    execute(operation, fields)
+        Runs an operation on this node's shard
+    """
+
+    def __init__(self, name: str, stripes: int = STRIPES, storage: Storage = None,
+                 max_messages: int = None, overflow: str = REJECT, spill_dir: str = None):
+        self.name = name
+        self.shard = ChatCore(stripes, storage, max_messages, overflow, spill_dir)
+        self.core = ClusterCore(self)
+        self.ring = HashRing([name])
+        self.addresses = {}
+        self.links = {}
+        self.links_lock = threading.Lock()
+        self.sessions = {}
+        self.conn_ids = itertools.count(1)
+
+    def is_logged_in(self, user: User) -> bool:
+        # The owner of the account may be another node, but a user is only
+        # named once the owner has logged them in
+        return user.get_name() is not None
+
+    def dispatch(self, user: User, op_code: int, content: str = "") -> list:
+        """
+        Handles a request as a Chat does, replying NODE_UNAVAILABLE if the
+        delivery or listing it runs cannot reach a node
+        """
+        conn = user.get_conn()
+        try:
+            responses = super().dispatch(user, op_code, content)
+        except NodeUnavailable:
+            return [(conn, (NODE_UNAVAILABLE,))]
+        if isinstance(responses, list):
+            return responses
+        return self.unavailable_pages(conn, responses)
+
+    def unavailable_pages(self, conn, responses):
+        # Pages of a listing are found as they are sent, so a node can fail
+        # after the first pages went out
+        try:
+            yield from responses
+        except NodeUnavailable:
+            yield (conn, (NODE_UNAVAILABLE,))
+
+    def link(self, node: str) -> PeerLink:
+        with self.links_lock:
+            link = self.links.get(node)
+            if link is None or link.closed:
+                link = self.links[node] = PeerLink(self.addresses.get(node, node))
+            return link
+
+    def call(self, node: str, operation: int, fields: list, timeout: float = PEER_TIMEOUT) -> tuple:
+        """
+        Runs an operation on a node, skipping the peer link if it is this one
+
+        Returns
+        -------
+        The fields of the operation's answer
+
+        Raises
+        ------
+        NodeUnavailable
+            If the node could not be reached or the operation failed on it,
+            such as an account that is still moving to the node
+        """
+        try:
+            if node == self.name:
+                return tuple(self.execute(operation, fields))
+            return self.link(node).call(operation, fields, timeout)
+        except (OSError, RuntimeError, KeyError) as e:
+            logging.warning(f'Peer operation {operation} on node {node} failed: {e!r}')
+            raise NodeUnavailable(node) from e
+
+    def call_owner(self, username: str, operation: int, fields: list) -> tuple:
+        return self.call(self.ring.owner(username), operation, fields)
+
+    def resolve(self, session):
+        """
+        Gets the session to send replies to from a (node, connection id)
+        pair, or None if there is no session
+        """
+        if session is None:
+            return None
+        node, conn_id = session
+        if node == self.name and conn_id in self.sessions:
+            return self.sessions[conn_id]
+        return PeerSession(self, node, conn_id)
+
+    def push(self, node: str, conn_id: int, op_code: int, replies: list):
+        if node == self.name:
+            # The client may have disconnected since it was looked up
+            session = self.sessions.get(conn_id)
+            if session is not None:
+                session.send_replies(op_code, replies)
+            return
+
+        try:
+            self.link(node).send(PEER_PUSH, [conn_id, op_code, [[msg_type, request_id, list(reply)]
+                                                                for reply, msg_type, request_id in replies]])
+        except OSError:
+            logging.warning(f'Could not push a reply to node {node}')
+
+    def execute(self, operation: int, fields) -> list:
+        """
+        Runs an operation sent by a node on this node's shard
+
+        Parameters
+        ----------
+        operation: int
+            Peer operation code
+
+        fields: list
+            Fields of the operation
+
+        Returns
+        -------
+        The fields of the answer
+        """
+        shard = self.shard
+        if operation == PEER_MEMBERS:
+            return [self.ring.nodes]
+        elif operation == PEER_JOIN:
+            self.add_member(fields[0])
+            return []
+        elif operation == PEER_MIGRATE:
+            username, session, messages = fields
+            shard.import_account(username, messages, tuple(session) if session else None)
+            return []
+        elif operation == PEER_CREATE:
+            username, node, conn_id = fields
+            return shard.create_account(username, (node, conn_id))
+        elif operation == PEER_LOGIN:
+            username, node, conn_id = fields
+            return shard.login(username, (node, conn_id))
+        elif operation == PEER_LOGOUT:
+            username, acknowledge = fields
+            return shard.logout(username, bool(acknowledge))[0]
+        elif operation == PEER_DELETE:
+            return shard.delete_account(fields[0])[0]
+        elif operation == PEER_ROUTE:
+            status, session = shard.route_message(*fields)
+            return [status, list(session) if session else None]
+        elif operation == PEER_DELIVER:
+            messages, next_offset, remaining = shard.deliver(*fields)
+            return [[list(message) for message in messages], next_offset, remaining]
+        elif operation == PEER_LIST:
+            exp, limit, cursor = fields
+            return list(shard.index.search(re.compile(exp), limit, cursor))
+        elif operation == PEER_PUSH:
+            conn_id, op_code, replies = fields
+            self.push(self.name, conn_id, op_code, [(tuple(reply), msg_type, request_id)
+                                                    for msg_type, request_id, reply in replies])
+            return []
+        raise ValueError(f'Unknown peer operation {operation}.')
+
+    def add_member(self, node: str):
+        """
+        Adds a joining node to the ring and moves it the accounts it now owns
+
+        Requests arriving for a moving account between the ring changing and
+        the account reaching the new node find no account there.
+        """
+        self.ring.add(node)
+        moving = [username for username in list(self.shard.accounts) if self.ring.owner(username) == node]
+
+        link = self.link(node)
+        for username in moving:
+            messages, session = self.shard.export_account(username)
+            for batch in migrate_batches(messages):
+                link.call(PEER_MIGRATE, [username, list(session) if session else None, batch])
+        logging.info(f'Moved {len(moving)} accounts to {node}')
+
+    def join(self, seed: str):
+        """
+        Joins the cluster of a seed node, returning once every member has
+        handed over the accounts this node now owns
+        """
+        members = self.link(seed).call(PEER_MEMBERS, [])[0]
+        for member in members:
+            self.ring.add(member)
+
+        for member in members:
+            self.link(member).call(PEER_JOIN, [self.name], timeout=None)
+        logging.info(f'Joined a cluster of {len(members)} nodes')
+
+    def start(self, peer_listener, seed: str = None):
+        """
+        Serves other nodes in the background and joins the cluster of the
+        seed node, if any, which requires already serving them
+
+        Parameters
+        ----------
+        peer_listener: socket
+            Listening socket bound to this node's peer address
+
+        seed: str, optional
+            Peer address of any node of the cluster to join
+        """
+        threading.Thread(target=self.serve_peers, args=(peer_listener,), daemon=True).start()
+        if seed is not None:
+            self.join(seed)
+
+    def serve_peers(self, listener):
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError:
+                break
+            start_new_thread(self.serve_peer, (sock,))
+
+    def serve_peer(self, sock):
+        connection = Connection(sock, 0)
+        decoder = peer_decoder()
+        try:
+            while True:
+                data = sock.recv(PEER_RECV_SIZE)
+                if not data:
+                    break
+
+                for operation, fields, _, request_id, _ in decoder.feed(data):
+                    status = STATUS_OK
+                    # A failed operation must not stop the link's others
+                    try:
+                        answer = self.execute(operation, fields)
+                    except Exception:
+                        logging.exception(f'Peer operation {operation} failed')
+                        status, answer = PEER_FAILED, []
+
+                    if request_id:
+                        connection.send(pack_frame(operation, pack_fields(answer), RESPONSE, request_id, status))
+        except (OSError, ValueError):
+            pass
+        connection.close()
+
+    def serve_forever(self, listener):
+        while True:
+            try:
+                conn, addr = listener.accept()
+            except OSError:
+                break
+            logging.info(addr[0] + " connected.")
+            start_new_thread(self.client_thread, (conn, addr))
+
+    def client_thread(self, conn, addr):
+        connection = Connection(conn)
+        conn_id = next(self.conn_ids)
+        session = self.sessions[conn_id] = ClientSession(connection, self.name, conn_id)
+        connection.send(pack_packet(1, '<server> Connected to server'))
+
+        user = User(session)
+        try:
+            for op_code, contents, request_id in read_requests(connection, addr):
+                responses = self.handler(user, int(op_code), contents)
+
+                # Each recipient's replies are sent as one write, or one push
+                # to the node it is connected to
+                replies = ((recip, (reply, msg_type, 0 if msg_type == PUSH else request_id))
+                           for recip, reply, msg_type in order_responses(responses, session))
+                for recip, grouped in coalesce(replies):
+                    recip.send_replies(op_code, grouped)
+        except Exception:
+            logging.exception(f'Connection {conn_id} failed')
+
+        # Messages delivered right before a lost connection may not have arrived
+        try:
+            self.logout_account(user, acknowledge=False)
+        except Exception:
+            logging.exception(f'Could not log out connection {conn_id}')
+
+        del self.sessions[conn_id]
+        connection.close()
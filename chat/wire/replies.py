@@ -0,0 +1,105 @@
+from typing import NewType
+
+# Reply format:
+# - every reply is a tuple of a reply code followed by its fields
+# - a reply's fields are strings, integers, None or lists of these
+# - version 2 frames carry the code as the status and the packed fields as
+#   the data, version 1 packets carry the reply rendered as text
+
+Reply = NewType('reply', tuple)
+
+# Successful replies
+ACCOUNTS = 1            # usernames, cursor of the next page or None
+ACCOUNT_CREATED = 2     # username
+LOGGED_IN = 3           # username
+LOGGED_OUT = 4          # username
+ACCOUNT_DELETED = 5     # username
+MESSAGE_SENT = 6        # recipient username
+MESSAGE_QUEUED = 7      # recipient username
+BATCH_SENT = 8          # list of [recipient username, delivery status]
+NO_MESSAGES = 9
+MESSAGE = 10            # sender username, message
+DELIVERED = 11          # messages delivered, offset to resume from, messages still queued
+
+# Failed replies, every error code is at least FIRST_ERROR
+FIRST_ERROR = 64
+INVALID_INPUT = 64      # request contents
+INVALID_REGEX = 65      # regex
+INVALID_USERNAME = 66
+EMPTY_USERNAME = 67
+USERNAME_IN_USE = 68    # username
+ACCOUNT_NOT_FOUND = 69  # username
+ALREADY_LOGGED_IN = 70  # username
+LOGOUT_FAILED = 71      # username
+DELETE_FAILED = 72      # username
+RECIPIENT_NOT_FOUND = 73  # recipient username
+INVALID_OPERATION = 74  # operation code
+NOT_LOGGED_IN = 75
+MESSAGE_REJECTED = 76   # recipient username, whose mailbox is full
+NODE_UNAVAILABLE = 77
+
+# Delivery status of a message for each recipient
+NOT_FOUND = -1
+QUEUED = 0
+SENT = 1
+MAILBOX_FULL = -2
+UNAVAILABLE = -3
+BATCH_STATUS = {NOT_FOUND: "does not exist", QUEUED: "queued", SENT: "sent",
+                MAILBOX_FULL: "mailbox full", UNAVAILABLE: "node unavailable"}
+
+TEMPLATES = {
+    ACCOUNT_CREATED: '<server> Account created with username "{}".',
+    LOGGED_IN: '<server> Account "{}" logged in.',
+    LOGGED_OUT: '<server> Account "{}" logged out.',
+    ACCOUNT_DELETED: '<server> Account "{}" deleted.',
+    MESSAGE_SENT: '<server> Message sent to "{}".',
+    MESSAGE_QUEUED: '<server> Account "{}" not online. Message queued to send',
+    NO_MESSAGES: '<server> No messages queued',
+    MESSAGE: '<{}> {}',
+    INVALID_INPUT: '<server> Invalid input: {}',
+    INVALID_REGEX: '<server> {} is not a valid regex pattern.',
+    INVALID_USERNAME: '<server> Failed to create account. Username cannot have " " or "|".',
+    EMPTY_USERNAME: '<server> Failed to create account. Username cannot be empty.',
+    USERNAME_IN_USE: '<server> Failed to create account. Username "{}" is already in use.',
+    ACCOUNT_NOT_FOUND: '<server> Failed to login. Account "{}" not found.',
+    ALREADY_LOGGED_IN: '<server> Failed to login. Account "{}" is already logged in. You cannot log in to the same account from multiple clients.',
+    LOGOUT_FAILED: '<server> Failed to logout. You are not logged in, or account "{}" does not exist.',
+    DELETE_FAILED: '<server> Failed to delete. You are not logged in, or account "{}" does not exist.',
+    RECIPIENT_NOT_FOUND: '<server> Failed to send. Account "{}" does not exist.',
+    INVALID_OPERATION: '<server> {} is not a valid operation code.',
+    NOT_LOGGED_IN: '<server> Operation not permitted. You are not logged in.',
+    MESSAGE_REJECTED: '<server> Failed to send. The mailbox of account "{}" is full.',
+    NODE_UNAVAILABLE: '<server> Operation failed. The server holding the account is unavailable, try again.',
+}
+
+
+def is_error(reply: Reply) -> bool:
+    return reply[0] >= FIRST_ERROR
+
+
+def render(reply: Reply) -> str:
+    """
+    Renders a reply as the text shown to the user
+    Args:
+        reply: Tuple of a reply code and its fields
+    Returns:
+        The reply as human-readable text
+    """
+    code, *fields = reply
+
+    if code == ACCOUNTS:
+        usernames, cursor = fields
+        if cursor is not None:
+            return f'<server> List of accounts: {str(usernames)} More accounts after "{cursor}".'
+        return f'<server> List of accounts: {str(usernames)}'
+    elif code == DELIVERED:
+        # The offset lets a client that lost the batch resume with "6|<offset>"
+        count, next_offset, remaining = fields
+        if remaining:
+            return f'<server> Delivered {count} messages, next offset {next_offset}. {remaining} more queued, send "6|" to get them.'
+        return f'<server> Delivered {count} messages, next offset {next_offset}.'
+    elif code == BATCH_SENT:
+        statuses = [f'"{username}": {BATCH_STATUS[status]}' for username, status in fields[0]]
+        return f"<server> Message sent to {len(statuses)} accounts. {', '.join(statuses)}."
+
+    return TEMPLATES[code].format(*fields)
@@ -1,45 +1,559 @@
 # Python program to implement server side of chat room.
+import logging
+import os
+import queue
+import socket
+import threading
 import time
 
 from _thread import *
 
+from metrics import log_request
 from wire.chat_service import User
-from wire.wire_protocol import pack_packet, unpack_packet
+from wire.replies import Reply, render
+from wire.wire_protocol import HELLO, PARTIAL, PING, PUSH, RESPONSE, PacketDecoder, pack_fields, pack_frame, pack_packet, send_packets
 
+RECV_SIZE = 4096
+MAX_OUTBOUND = 10000
+# Seconds a writer waits after its first packet to gather more into the same
+# write, 0 only gathers the packets that are already queued
+WRITE_WINDOW = 0.0
+# A writer stops waiting once it has gathered this many bytes
+WRITE_BATCH_BYTES = 65536
+# Packets of one handler pass held back for a recipient before queueing them
+COALESCE_PACKETS = 64
 
-def client_thread(chat_app, conn, addr):
-    # sends a message to the client whose user object is conn
-    message = '<server> Connected to server'
-    output = pack_packet(1, message)
-    conn.send(output)
 
-    # Define a user object to keep track of the user and state for the thread
-    curr_user = User(conn)
+def coalesce_writes(window: float):
+    """
+    Sets the write window of every connection created from now on
+    """
+    global WRITE_WINDOW
+    WRITE_WINDOW = window
+
+
+# Seconds a client can be silent before it is pinged, and before it is
+# disconnected, None turns either off. Only clients known to answer pings
+# are pinged and disconnected, every other client relies on TCP keepalive.
+PING_INTERVAL = None
+IDLE_TIMEOUT = None
+# Unanswered TCP keepalive probes before the OS drops a connection
+KEEPALIVE_PROBES = 3
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+def keep_alive(ping_interval: float = None, idle_timeout: float = None):
+    """
+    Sets how long a client of the wire servers can be silent before it is
+    pinged, and before it is disconnected
+    """
+    global PING_INTERVAL, IDLE_TIMEOUT
+    PING_INTERVAL, IDLE_TIMEOUT = ping_interval, idle_timeout
+
+
+def set_tcp_keepalive(sock, idle: float, timeout: float = None):
+    """
+    Turns on TCP keepalive so the OS drops a dead peer that cannot answer
+    pings, probing after idle seconds of silence and giving up about
+    timeout seconds after the last data where the OS supports tuning it
+    """
+    interval = idle
+    if timeout and timeout > idle:
+        interval = (timeout - idle) / KEEPALIVE_PROBES
+
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval),
+                              ('TCP_KEEPCNT', KEEPALIVE_PROBES)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), max(1, int(value)))
+    except OSError:
+        # Unix domain sockets have no keepalive to tune
+        pass
+
+
+class Connection:
+    """
+    A class used to write to a client socket from a dedicated thread
+    ...
+
+    Packets are queued by whichever thread produced them and written by the
+    connection's own writer thread, so a slow recipient never blocks the
+    sender's thread. A client with max_outbound writes queued is dropped,
+    a max_outbound of 0 queues without limit.
+
+    The writer gathers every queued packet, and those queued within
+    write_window seconds of the first, into one scatter-gather write.
+    TCP_NODELAY is set so that a write is never held back by Nagle's
+    algorithm, since the writer already does the batching.
+
+    Attributes
+    ----------
+    sock : socket
+        socket for the client
+
+    outbound : Queue
+        packets waiting to be written to the socket
+
+    closed : bool
+        whether the connection has stopped accepting packets
+
+    version : int
+        protocol version negotiated with the client
+
+    write_window : float
+        seconds the writer waits for more packets after the first one
+
+    last_read : float
+        monotonic time data was last received from the client
+
+    last_ping : float
+        monotonic time the client was last pinged, or 0
+
+    answers_pings : bool
+        whether the client negotiated version 2 or sent a PING, so it can
+        be pinged and disconnected when it stops answering
+
+    Methods
+    -------
+    send(packet)
+        Queues a packet to be written to the client
+
+    send_many(packets)
+        Queues packets to be written to the client together
+
+    ping()
+        Queues a PING packet in the client's protocol version
+
+    shutdown()
+        Shuts the socket down, waking the thread reading from it
+
+    close()
+        Writes any queued packets and then closes the socket
 
-    while True:
+    abort()
+        Shuts the socket down and closes it without writing queued packets
+    """
+
+    def __init__(self, sock, max_outbound: int = MAX_OUTBOUND, write_window: float = None):
+        self.sock = sock
+        self.outbound = queue.Queue(max_outbound)
+        self.closed = False
+        self.version = 1
+        self.write_window = WRITE_WINDOW if write_window is None else write_window
+        self.last_read = time.monotonic()
+        self.last_ping = 0.0
+        self.answers_pings = False
+
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            # Unix domain sockets have no Nagle algorithm to turn off
+            pass
+
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def send(self, packet: bytes):
+        if self.closed:
+            return
+
+        try:
+            self.outbound.put_nowait(packet)
+        except queue.Full:
+            # The client is not reading, drop it rather than buffer forever
+            self.abort()
+
+    def send_many(self, packets: list):
+        # One queue entry, so the writer never sends part of them on its own
+        self.send(packets)
+
+    def ping(self):
+        self.last_ping = time.monotonic()
+        self.send(pack_packet(PING, "") if self.version == 1 else pack_frame(PING, b"", PUSH))
+
+    def shutdown(self):
         try:
-            data = conn.recv(1024)
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
-            if data:
-                op_code, contents = unpack_packet(data)
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.outbound.put(None)
 
-                """prints the message and address of the
-                user who just sent the message on the server
-                terminal"""
-                print(f"<{addr[0]}> {op_code}|{contents}")
+    def abort(self):
+        # Shut down first so the thread reading from the socket wakes up and
+        # logs the user out, closing alone leaves it blocked
+        self.closed = True
+        self.shutdown()
+        try:
+            self.sock.close()
+        except OSError:
+            pass
 
-                responses = chat_app.handler(
-                    curr_user, int(op_code), contents)
+    def write_loop(self):
+        """
+        Writes queued packets, batching everything that is already queued,
+        or is queued within the write window, into a single scatter-gather
+        write
+        """
+        running = True
+        while running:
+            batch = []
+            size = 0
+            entry = self.outbound.get()
+            deadline = time.monotonic() + self.write_window
 
-                # Iterate and send out each new response generated by the server
-                for recip_conn, response in responses:
-                    output = pack_packet(1, response)
-                    recip_conn.send(output)
-                    time.sleep(0.1)
+            # None marks that the connection was closed
+            while entry is not None:
+                if isinstance(entry, list):
+                    batch += entry
+                    size += sum(map(len, entry))
+                else:
+                    batch.append(entry)
+                    size += len(entry)
 
-            # If data has no content, we remove the connection
+                try:
+                    entry = self.outbound.get_nowait()
+                except queue.Empty:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0 or size >= WRITE_BATCH_BYTES:
+                        break
+                    try:
+                        entry = self.outbound.get(timeout=timeout)
+                    except queue.Empty:
+                        break
             else:
-                chat_app.handler(curr_user, 3)
+                running = False
+
+            try:
+                if batch:
+                    send_packets(self.sock, batch)
+            except OSError:
+                break
+
+        self.abort()
+
+
+class Reaper:
+    """
+    A class used to ping silent clients and disconnect those that stay
+    silent, so that dead peers do not hold sockets, threads and logins
+    ...
+
+    A client that vanished without closing its socket leaves its thread
+    blocked reading forever. The reaper's thread checks every connection
+    that answers pings periodically and shuts down the socket of one silent
+    for idle_timeout seconds, which wakes the reading thread to log the user
+    out and close the connection as if the client had disconnected. Version
+    1 clients cannot answer pings, so they are left to TCP keepalive.
+
+    Attributes
+    ----------
+    ping_interval : float
+        seconds of silence before a client is pinged, or None
+
+    idle_timeout : float
+        seconds of silence before a client is disconnected, or None
+
+    connections : dict
+        every connection being watched, as keys
+
+    reaped : int
+        number of connections disconnected for being silent
+
+    pid : int
+        process the reaper's thread runs in
+
+    Methods
+    -------
+    add(connection)
+        Starts watching a connection
+
+    discard(connection)
+        Stops watching a connection
+
+    scan(now)
+        Pings or disconnects every silent connection
+    """
+
+    def __init__(self, ping_interval: float = None, idle_timeout: float = None):
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.connections = {}
+        self.reaped = 0
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+        # Checked twice per period so a client is pinged or reaped at most
+        # half a period late
+        self.period = min(t for t in (ping_interval, idle_timeout) if t) / 2
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def add(self, connection: Connection):
+        with self.lock:
+            self.connections[connection] = None
+
+    def discard(self, connection: Connection):
+        with self.lock:
+            self.connections.pop(connection, None)
+
+    def scan(self, now: float):
+        with self.lock:
+            connections = list(self.connections)
+
+        for connection in connections:
+            if not connection.answers_pings:
+                continue
+
+            silent = now - connection.last_read
+            if self.idle_timeout and silent >= self.idle_timeout:
+                self.discard(connection)
+                self.reaped += 1
+                logging.debug(f'Disconnecting a client silent for {silent:.0f} seconds')
+                connection.shutdown()
+            elif (self.ping_interval and silent >= self.ping_interval
+                    and now - connection.last_ping >= self.ping_interval):
+                connection.ping()
+
+    def run(self):
+        while True:
+            time.sleep(self.period)
+            self.scan(time.monotonic())
+
+
+def get_reaper():
+    """
+    Gets the reaper of this process, starting it the first time, or None if
+    clients are neither pinged nor disconnected. Worker processes forked
+    after the reaper started get their own, since threads do not survive
+    a fork.
+    """
+    global _reaper
+    if not (PING_INTERVAL or IDLE_TIMEOUT):
+        return None
+
+    with _reaper_lock:
+        if _reaper is None or _reaper.pid != os.getpid():
+            _reaper = Reaper(PING_INTERVAL, IDLE_TIMEOUT)
+        return _reaper
+
+
+def pack_reply(version: int, op_code: int, reply: Reply, msg_type: int = RESPONSE,
+               request_id: int = 0) -> bytes:
+    """
+    Packs a reply in the recipient's protocol version, version 1 clients get
+    the reply rendered as text while version 2 clients get the reply code as
+    the status and its packed fields
+    """
+    if version == 1:
+        return pack_packet(1, render(reply))
+    return pack_frame(op_code, pack_fields(reply[1:]), msg_type, request_id, reply[0])
+
+
+def order_responses(responses, conn):
+    """
+    Gets the message type of each response to a request
+
+    The sender's last response is the RESPONSE to the request and any before
+    it are PARTIAL, so one response is held back until the next one shows
+    whether it was the last. Every other recipient gets a PUSH.
+
+    Parameters
+    ----------
+    responses: iterable
+        (recipient connection, reply) pairs returned by Chat.handler
+
+    conn:
+        Connection of the client that sent the request
+
+    Yields
+    ------
+    The recipient connection, the reply and its message type
+    """
+    held = None
+    for recip_conn, response in responses:
+        if recip_conn is not conn:
+            yield recip_conn, response, PUSH
+            continue
+
+        if held is not None:
+            yield conn, held, PARTIAL
+        held = response
+
+    if held is not None:
+        yield conn, held, RESPONSE
+
+
+def frame_responses(responses, conn, op_code: int, request_id: int):
+    """
+    Packs the responses to a request in each recipient's protocol version
+
+    Parameters
+    ----------
+    responses: iterable
+        (recipient connection, reply) pairs returned by Chat.handler
+
+    conn:
+        Connection of the client that sent the request
+
+    op_code: int
+        Operation code of the request
+
+    request_id: int
+        Id of the request, 0 for version 1 clients
+
+    Yields
+    ------
+    The recipient connection and the packet to send to it
+    """
+    for recip_conn, response, msg_type in order_responses(responses, conn):
+        if msg_type == PUSH:
+            yield recip_conn, pack_reply(recip_conn.version, op_code, response, PUSH)
+        else:
+            yield recip_conn, pack_reply(recip_conn.version, op_code, response, msg_type, request_id)
+
+
+def coalesce(framed, limit: int = COALESCE_PACKETS):
+    """
+    Groups the packets of one handler pass by recipient, so that each
+    recipient's packets are queued as a single write
+
+    Parameters
+    ----------
+    framed: iterable
+        (recipient connection, packet) pairs from frame_responses
+
+    limit: int
+        Packets held back for one recipient, a recipient reaching it gets
+        them before the pass ends so a long listing is not all held at once
+
+    Yields
+    ------
+    The recipient connection and its packets in order
+    """
+    groups = {}
+    for recip_conn, packet in framed:
+        group = groups.setdefault(recip_conn, [])
+        group.append(packet)
+        if len(group) >= limit:
+            yield recip_conn, groups.pop(recip_conn)
+    yield from groups.items()
+
+
+def handle_control(connection, decoder: PacketDecoder, addr, op_code: int, contents) -> bool:
+    """
+    Logs a packet read from a client and answers it if it is a PING or the
+    version handshake, which never reach the chat
+
+    Parameters
+    ----------
+    connection:
+        Connection of the client, whose version is switched by a HELLO
+
+    decoder: PacketDecoder
+        Decoder of the client's packets, holding the negotiated version
+
+    Returns
+    -------
+    Whether the packet was answered here
+    """
+    # Answers to pings only show that the client is alive
+    if op_code == PING:
+        connection.answers_pings = True
+        return True
+
+    # Only sampled requests are logged, printing each one would put
+    # terminal I/O on every request
+    log_request(addr, op_code, contents)
+
+    # Answer the handshake in version 1 before switching over
+    if op_code == HELLO and connection.version == 1:
+        connection.send(pack_packet(HELLO, str(decoder.version)))
+        connection.version = decoder.version
+        connection.answers_pings = connection.version >= 2
+        return True
+    return False
+
+
+def read_requests(connection: Connection, addr):
+    """
+    Reads requests from a client until it disconnects, answering the
+    version handshake itself
+
+    Parameters
+    ----------
+    connection: Connection
+        Connection of the client, whose version is switched by a HELLO
+
+    addr:
+        Address of the client
+
+    Yields
+    ------
+    The operation code, contents and request id of each request, the id
+    being 0 for version 1 clients, until the client disconnects or is
+    disconnected for being silent
+    """
+    # Reassembles packets that are split across or coalesced within reads
+    decoder = PacketDecoder()
+
+    # Silent clients are pinged and then disconnected if that is configured
+    reaper = get_reaper()
+    if reaper is not None:
+        reaper.add(connection)
+        set_tcp_keepalive(connection.sock, reaper.ping_interval or reaper.idle_timeout, reaper.idle_timeout)
+
+    try:
+        while True:
+            try:
+                data = connection.sock.recv(RECV_SIZE)
+                # If data has no content, we remove the connection
+                if not data:
+                    return
+                connection.last_read = time.monotonic()
+                packets = decoder.feed(data)
+            except (OSError, ValueError):
+                return
+
+            for op_code, contents, *header in packets:
+                if handle_control(connection, decoder, addr, op_code, contents):
+                    continue
+
+                # Version 1 packets have no request id
+                yield op_code, contents, header[1] if header else 0
+    finally:
+        if reaper is not None:
+            reaper.discard(connection)
+
+
+def client_thread(chat_app, conn, addr, max_outbound: int = MAX_OUTBOUND):
+    connection = Connection(conn, max_outbound)
+
+    # sends a message to the client whose user object is conn
+    message = '<server> Connected to server'
+    output = pack_packet(1, message)
+    connection.send(output)
+
+    # Define a user object to keep track of the user and state for the thread
+    curr_user = User(connection)
+
+    try:
+        for op_code, contents, request_id in read_requests(connection, addr):
+            responses = chat_app.handler(
+                curr_user, int(op_code), contents)
+
+            # Queue the responses generated by the server, each recipient's
+            # packets as one write
+            for recip_conn, packets in coalesce(frame_responses(
+                    responses, connection, op_code, request_id)):
+                recip_conn.send_many(packets)
+    except:
+        pass
 
-        except:
-            break
+    # Messages delivered right before a lost connection may not have arrived
+    chat_app.logout_account(curr_user, acknowledge=False)
+    connection.close()
@@ -1,3 +1,4 @@
+import os
 import struct
 
 # Packet format:
@@ -5,14 +6,291 @@ import struct
 # - 1 byte unsigned integer for operation code
 # - N bytes for packet data
 
+HEADER_FORMAT = "!IB"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+MAX_DATA_LEN = 1 << 20
+
+# Version 2 frame format:
+# - 4 byte unsigned integer for data length (N)
+# - 1 byte unsigned integer for operation code
+# - 1 byte unsigned integer for message type
+# - 4 byte unsigned integer for request id
+# - 1 byte unsigned integer for status code
+# - N bytes for frame data
+#
+# Every connection starts on version 1. A client asks for version 2 by sending
+# a version 1 HELLO packet holding the version it wants, and the server answers
+# with a version 1 HELLO packet holding the version both sides use from then on.
+# A server that does not know HELLO answers with an ordinary reply instead, so
+# the client stays on version 1.
+
+V2_HEADER_FORMAT = "!IBBIB"
+V2_HEADER_SIZE = struct.calcsize(V2_HEADER_FORMAT)
+HEADERS = {1: (HEADER_FORMAT, HEADER_SIZE), 2: (V2_HEADER_FORMAT, V2_HEADER_SIZE)}
+
+HELLO = 255
+VERSION = 2
+
+# The server sends an empty PING packet to a client that has been silent for a
+# while, and the client answers with an empty PING packet of its own. A PING
+# is never answered with a reply, and a client silent for too long is closed.
+PING = 254
+
+# Message types, a request's replies are zero or more PARTIAL frames followed
+# by one RESPONSE frame with the same request id. REQUEST frames hold text
+# like version 1 packets, every other frame holds packed fields. FIELDS frames
+# are requests whose contents are packed fields instead of text, such as a
+# send (op code 5) holding the recipient and the message.
+RESPONSE = 0
+PUSH = 1
+PARTIAL = 2
+REQUEST = 3
+FIELDS = 4
+
+STATUS_OK = 0
+
+# Packed fields format, each field is a 1 byte tag followed by its value:
+# - "s": 4 byte unsigned integer for length (N) and N bytes of utf-8 text
+# - "i": 8 byte signed integer
+# - "n": None, with no value
+# - "l": 4 byte unsigned integer for count (N) and N more fields
+
+LENGTH = struct.Struct("!I")
+INTEGER = struct.Struct("!q")
+
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
 
 def pack_packet(operation: int, input: str) -> bytes:
     data = input.encode('utf-8')
-    return struct.pack("!IB", len(data), operation) + data
+    return struct.pack(HEADER_FORMAT, len(data), operation) + data
 
 
 def unpack_packet(packet: bytes) -> tuple:
-    data_len, operation = struct.unpack("!IB", packet[:5])
-    data = packet[5:5 + data_len]
+    data_len, operation = struct.unpack(HEADER_FORMAT, packet[:HEADER_SIZE])
+    data = packet[HEADER_SIZE:HEADER_SIZE + data_len]
     output = data.decode('utf-8')
-    return operation, output
\ No newline at end of file
+    return operation, output
+
+
+def pack_frame(operation: int, data: bytes, msg_type: int = RESPONSE,
+               request_id: int = 0, status: int = STATUS_OK) -> bytes:
+    return struct.pack(V2_HEADER_FORMAT, len(data), operation, msg_type, request_id, status) + data
+
+
+def pack_request(operation: int, input: str, request_id: int) -> bytes:
+    return pack_frame(operation, input.encode('utf-8'), REQUEST, request_id)
+
+
+def pack_fields_request(operation: int, fields, request_id: int) -> bytes:
+    return pack_frame(operation, pack_fields(fields), FIELDS, request_id)
+
+
+def pack_value(value, parts: list):
+    if isinstance(value, str):
+        data = value.encode('utf-8')
+        parts += (b"s", LENGTH.pack(len(data)), data)
+    elif isinstance(value, int):
+        parts += (b"i", INTEGER.pack(value))
+    elif value is None:
+        parts.append(b"n")
+    else:
+        parts += (b"l", LENGTH.pack(len(value)))
+        for item in value:
+            pack_value(item, parts)
+
+
+def pack_fields(fields) -> bytes:
+    """
+    Packs a sequence of fields into the data of a version 2 frame
+    Args:
+        fields: Strings, integers, None or lists of these
+    Returns:
+        The packed fields
+    """
+    parts = []
+    for field in fields:
+        pack_value(field, parts)
+    return b"".join(parts)
+
+
+def unpack_value(buffer, offset: int) -> tuple:
+    tag = buffer[offset]
+    offset += 1
+    if tag == ord("s"):
+        (length,) = LENGTH.unpack_from(buffer, offset)
+        offset += LENGTH.size
+        return str(buffer[offset:offset + length], 'utf-8'), offset + length
+    elif tag == ord("i"):
+        return INTEGER.unpack_from(buffer, offset)[0], offset + INTEGER.size
+    elif tag == ord("n"):
+        return None, offset
+    elif tag == ord("l"):
+        (count,) = LENGTH.unpack_from(buffer, offset)
+        offset += LENGTH.size
+        values = []
+        for _ in range(count):
+            value, offset = unpack_value(buffer, offset)
+            values.append(value)
+        return values, offset
+    raise ValueError(f'Unknown field tag {tag}.')
+
+
+def unpack_fields(buffer) -> tuple:
+    """
+    Unpacks every field from the data of a version 2 frame
+    Args:
+        buffer: Bytes-like object holding only the packed fields
+    Returns:
+        A tuple of the fields
+    Raises:
+        ValueError: If the data is not a valid sequence of fields
+    """
+    fields = []
+    offset = 0
+    try:
+        while offset < len(buffer):
+            value, offset = unpack_value(buffer, offset)
+            fields.append(value)
+    except (struct.error, IndexError) as e:
+        raise ValueError('Truncated fields.') from e
+    return tuple(fields)
+
+
+def negotiate_version(requested: str) -> int:
+    """
+    Gets the protocol version to use given the version asked for in a HELLO
+    """
+    if not requested.isdecimal():
+        return 1
+    return max(1, min(int(requested), VERSION))
+
+
+def parse_send(content: str):
+    """
+    Splits the text of a version 1 send into its recipient and message in
+    one pass, the recipient ending at the first "|"
+    Args:
+        content: Text of the form "recipient|message"
+    Returns:
+        A tuple of the recipient and message, or None if the recipient is
+        empty or has whitespace or the message is empty
+    """
+    recipient, separator, message = content.partition("|")
+    if not separator or not message or recipient.split() != [recipient]:
+        return None
+    return recipient, message
+
+
+def send_packets(sock, packets: list):
+    """
+    Writes packets to a socket with scatter-gather sendmsg, so that they are
+    never joined into one bytes object. Falls back to sendall where sendmsg
+    is not available.
+    Args:
+        sock: Socket to write to
+        packets: Bytes-like objects to write in order
+    """
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b"".join(packets))
+        return
+
+    buffers = [memoryview(packet) for packet in packets]
+    first = 0
+    while first < len(buffers):
+        sent = sock.sendmsg(buffers[first:first + IOV_MAX])
+
+        # Skip past fully written buffers and trim a partially written one
+        while sent and sent >= len(buffers[first]):
+            sent -= len(buffers[first])
+            first += 1
+        if sent:
+            buffers[first] = buffers[first][sent:]
+
+
+class PacketDecoder:
+    """
+    Incremental decoder that reassembles packets from a stream of bytes
+    ...
+
+    A single recv() can return several coalesced packets or only part of
+    one, so bytes are buffered per connection until the length header says
+    a packet is complete.
+
+    Decoding starts on version 1 and switches to the negotiated version right
+    after a HELLO packet, since every byte after it uses the new framing.
+    Version 1 packets are decoded as (operation, data) and version 2 frames as
+    (operation, data, msg_type, request_id, status), where data is the text of
+    a REQUEST frame and the tuple of unpacked fields of any other frame,
+    FIELDS requests included.
+
+    Attributes
+    ----------
+    buffer : bytearray
+        bytes received but not yet decoded into a full packet
+
+    version : int
+        protocol version of the packets being decoded
+
+    Methods
+    -------
+    feed(data)
+        Buffers data and returns every packet completed by it
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.version = 1
+
+    def feed(self, data: bytes) -> list[tuple]:
+        """
+        Adds received bytes to the buffer and decodes all complete packets
+
+        Parameters
+        ----------
+        data: bytes
+            Bytes read from the socket
+
+        Raises
+        ------
+        ValueError
+            If a packet header announces more than MAX_DATA_LEN bytes
+        """
+        self.buffer += data
+
+        packets = []
+        offset = 0
+        # Decode straight from the buffer instead of from copied slices
+        with memoryview(self.buffer) as view:
+            while True:
+                header_format, header_size = HEADERS[self.version]
+                if len(view) - offset < header_size:
+                    break
+
+                data_len, operation, *header = struct.unpack_from(
+                    header_format, view, offset)
+                if data_len > MAX_DATA_LEN:
+                    raise ValueError(f'Packet of {data_len} bytes is too large.')
+
+                # Wait for more data if the packet is not complete yet
+                end = offset + header_size + data_len
+                if len(view) < end:
+                    break
+
+                data = view[offset + header_size:end]
+                if self.version == 1 or header[0] == REQUEST:
+                    data = str(data, 'utf-8')
+                else:
+                    data = unpack_fields(data)
+                packets.append((operation, data, *header))
+                offset = end
+
+                if operation == HELLO and self.version == 1:
+                    self.version = negotiate_version(data)
+
+        # Drop the decoded packets, keeping any partial packet for later
+        del self.buffer[:offset]
+        return packets
@@ -0,0 +1,144 @@
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from wire.cluster import ClusterChat
+
+# Multi-process wire server:
+# - N worker processes accept clients on the same port with SO_REUSEPORT
+# - every worker is a node of a sharded cluster on the loopback interface,
+#   named "worker<i>", owning the accounts whose usernames hash to it and
+#   running their operations on its own core, so no process handles every
+#   request and the chat logic runs on N cores
+# - only an operation on an account owned by another worker, or a reply
+#   pushed to a client of another worker, goes over a peer link to it
+# - the workers start together with empty shards, so each one is given
+#   every worker's peer address up front and no accounts move
+# - a worker stops once the process that started it is gone
+
+PEER_HOST = '127.0.0.1'
+LISTEN_BACKLOG = 1024
+# Seconds between checks that a worker's parent process is still running
+PARENT_POLL = 1.0
+
+
+def worker_name(index: int) -> str:
+    return f'worker{index}'
+
+
+def listen_port(host: str, port: int, reuse_port: bool = False):
+    """
+    Creates a listening socket, which several processes can bind to the same
+    port with reuse_port so that the kernel spreads clients over them
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((host, port))
+    listener.listen(LISTEN_BACKLOG)
+    return listener
+
+
+def listen_peers(workers: int) -> tuple:
+    """
+    Creates the loopback listening socket of each worker's peer links
+
+    Returns
+    -------
+    The listening sockets, and the peer address of each worker by name
+    """
+    listeners = [listen_port(PEER_HOST, 0) for _ in range(workers)]
+    addresses = {worker_name(i): f'{PEER_HOST}:{listener.getsockname()[1]}'
+                 for i, listener in enumerate(listeners)}
+    return listeners, addresses
+
+
+def run_worker(chat_app: ClusterChat, listener, peer_listener, addresses: dict):
+    """
+    Serves a worker's shard to the other workers and accepts clients until
+    the listener is closed
+
+    Parameters
+    ----------
+    chat_app: ClusterChat
+        Node of the worker, named after it
+
+    listener: socket
+        Listening socket clients connect to
+
+    peer_listener: socket
+        Listening socket the other workers connect to
+
+    addresses: dict
+        Peer address of every worker by name
+    """
+    chat_app.addresses.update(addresses)
+    for node in addresses:
+        chat_app.ring.add(node)
+    chat_app.start(peer_listener)
+
+    try:
+        chat_app.serve_forever(listener)
+    except KeyboardInterrupt:
+        pass
+
+    listener.close()
+    peer_listener.close()
+    chat_app.shard.storage.close()
+
+
+def watch_parent(parent: int, listener):
+    """
+    Shuts the listener down once the parent process is gone, which wakes the
+    worker's blocked accept so it stops
+    """
+    while os.getppid() == parent:
+        time.sleep(PARENT_POLL)
+    try:
+        listener.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def worker_process(make_chat, index: int, host: str, port: int, peer_listener, addresses: dict,
+                   parent: int):
+    logging.info(f'Starting worker {index}')
+    listener = listen_port(host, port, reuse_port=True)
+    threading.Thread(target=watch_parent, args=(parent, listener), daemon=True).start()
+    run_worker(make_chat(worker_name(index)), listener, peer_listener, addresses)
+
+
+def start_workers(host: str, port: int, workers: int, make_chat=ClusterChat) -> list:
+    """
+    Starts worker processes that all accept clients on the same port, each
+    owning a shard of the accounts
+
+    Parameters
+    ----------
+    make_chat: callable
+        Creates the ClusterChat of a worker given its name
+
+    Raises
+    ------
+    OSError
+        If the platform does not support SO_REUSEPORT
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise OSError('SO_REUSEPORT is not supported on this platform.')
+
+    # Peer listeners are bound first so every worker knows every address
+    peer_listeners, addresses = listen_peers(workers)
+    processes = [multiprocessing.Process(target=worker_process, daemon=True,
+                                         args=(make_chat, i, host, port, peer_listener, addresses, os.getpid()))
+                 for i, peer_listener in enumerate(peer_listeners)]
+    for process in processes:
+        process.start()
+
+    # Each worker holds its own copy of its peer listener
+    for peer_listener in peer_listeners:
+        peer_listener.close()
+    return processes